@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# pylint: disable=line-too-long
+"""Benchmark collect.py against local stand-ins of Urbiotica, Keystone and Orion APIs"""
+
+import argparse
+import gzip
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+from dataclasses import dataclass, field
+
+import limiter.limiter  # type: ignore
+
+import collect
+
+# The fake servers must not count as time slept by the ETL
+server_sleep = time.sleep
+
+
+# pylint: disable=too-many-instance-attributes,missing-function-docstring
+@dataclass
+class FakeBackend:
+    """State shared by the fake Urbiotica, Keystone and Orion endpoints"""
+    spots: int = 50
+    zones: int = 5
+    # Backlog of the spots, in days since the last occupancyModified
+    days: float = 1.0
+    events_per_day: int = 96
+    # Delay added to each response, in seconds
+    latency: float = 0.0
+    # Fraction of vehicle_ctrl and /v2/op/update requests that fail with 500
+    error_rate: float = 0.0
+    seed: int = 0
+
+    entities: Dict[str, Any] = field(default_factory=dict)
+    requests: Dict[str, int] = field(default_factory=dict)
+    received: int = 0
+    received_bytes: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self):
+        self.random = random.Random(self.seed)
+        modified = (datetime.now(timezone.utc) - timedelta(days=self.days)).isoformat()
+        for index in range(self.spots):
+            entityid = f'pomid:{self.pomid(index)}'
+            self.entities[entityid] = {
+                'id': entityid,
+                'type': 'ParkingSpot',
+                'occupancyModified': {'type': 'DateTime', 'value': modified, 'metadata': {}},
+            }
+
+    @staticmethod
+    def pomid(index: int) -> int:
+        """pomid of the spot with the given index"""
+        return 10000 + index
+
+    def count(self, endpoint: str):
+        """Count a request to the endpoint"""
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def fail(self) -> bool:
+        """Decide whether the current request should fail"""
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def projects(self) -> List[Any]:
+        return [{'projectid': 'bench', 'name': 'Bench', 'description': 'Benchmark project', 'timezone': 'Europe/Madrid'}]
+
+    def zone_list(self) -> List[Any]:
+        return [{
+            'zoneid': zoneid,
+            'description': f'Zone {zoneid}',
+            'lat_ne': '38.70', 'lat_sw': '38.69',
+            'long_ne': '-0.47', 'long_sw': '-0.48',
+        } for zoneid in range(self.zones)]
+
+    def devices(self, zoneid: int) -> List[Any]:
+        return [{'elementid': f'element{index}', 'zoneid': zoneid}
+                for index in range(self.spots) if index % self.zones == zoneid]
+
+    def spot_list(self) -> List[Any]:
+        return [{
+            'pomid': self.pomid(index),
+            'name': f'Spot {index}',
+            'latitude': str(38.690 + (index % self.zones) * 0.001 + index * 0.00001),
+            'longitude': str(-0.480 + (index % self.zones) * 0.001 + index * 0.00001),
+            'elementid': f'element{index}',
+        } for index in range(self.spots)]
+
+    def vehicles(self, pomid: int, start: int, end: int) -> List[Any]:
+        """Synthetic vehicle_ctrl events, evenly spaced, in random order"""
+        step = max(1, 86400 // max(1, self.events_per_day))
+        first = (start // step + 1) * step
+        measurements = [{'lstamp': str(ts * 1000), 'value': str((ts // step + pomid) % 2)}
+                        for ts in range(first, end, step)]
+        self.random.shuffle(measurements)
+        return [{'pomid': pomid, 'measurements': measurements}]
+
+    def rotations(self, pomid: int, start: datetime, end: datetime) -> List[Any]:
+        """Synthetic finished rotations, one per hour"""
+        rotations = list()
+        current = start
+        while current + timedelta(hours=1) <= end:
+            rotations.append({
+                'start': (current + timedelta(minutes=5)).isoformat(),
+                'end': (current + timedelta(minutes=30 + pomid % 20)).isoformat(),
+            })
+            current += timedelta(hours=1)
+        return [{'pomid': pomid, 'rotations': rotations}]
+
+    def update(self, body: Any):
+        """Apply an /v2/op/update append"""
+        with self.lock:
+            self.received += len(body['entities'])
+            for entity in body['entities']:
+                current = self.entities.setdefault(entity['id'], {'id': entity['id'], 'type': entity['type']})
+                current.update({key: value for key, value in entity.items() if key not in ('id', 'type')})
+
+    def query(self, entitytype: str, attrs: Optional[str], offset: int, limit: int):
+        """Page of GET /v2/entities, and total count"""
+        with self.lock:
+            matches = [entity for entity in self.entities.values() if entity['type'] == entitytype]
+        page = matches[offset:offset+limit]
+        if attrs:
+            keep = set(attrs.split(',')) | {'id', 'type'}
+            page = [{key: value for key, value in entity.items() if key in keep} for entity in page]
+        return page, len(matches)
+
+
+def handler(backend: FakeBackend):
+    """Build a request handler class bound to the backend"""
+
+    class Handler(BaseHTTPRequestHandler):
+        """Routes requests to the fake backend"""
+
+        # pylint: disable=redefined-builtin
+        def log_message(self, format, *args):
+            """Silence the default access log"""
+
+        def reply(self, status: int, body: Any = None, headers: Optional[Dict[str, str]] = None):
+            """Send a response, body can be bytes or anything json-serializable"""
+            data = b'' if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode('utf-8'))
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        # pylint: disable=invalid-name,too-many-return-statements
+        def do_GET(self):
+            """Urbiotica API, and Orion entity queries"""
+            server_sleep(backend.latency)
+            url = urlparse(self.path)
+            parts = url.path.strip('/').split('/')
+            query = parse_qs(url.query)
+            if parts[:2] == ['v2', 'auth']:
+                backend.count('urbiotica_auth')
+                return self.reply(200, b'"benchmark-token"')
+            if parts[:2] == ['v2', 'organisms']:
+                path = parts[5:]
+                if len(parts) == 4:
+                    backend.count('urbiotica_projects')
+                    return self.reply(200, backend.projects())
+                if path == ['zones']:
+                    backend.count('urbiotica_zones')
+                    return self.reply(200, backend.zone_list())
+                if path == ['spots']:
+                    backend.count('urbiotica_spots')
+                    return self.reply(200, backend.spot_list())
+                if len(path) == 3 and path[0] == 'zones' and path[2] == 'devices':
+                    backend.count('urbiotica_devices')
+                    return self.reply(200, backend.devices(int(path[1])))
+                if len(path) == 4 and path[0] == 'spots' and path[2] == 'phenomenons':
+                    backend.count('urbiotica_vehicles')
+                    if backend.fail():
+                        return self.reply(500, b'simulated failure')
+                    return self.reply(200, backend.vehicles(int(path[1]), int(query['start'][0]), int(query['end'][0])))
+                if len(path) == 6 and path[0] == 'spots' and path[2] == 'rotations':
+                    backend.count('urbiotica_rotations')
+                    return self.reply(200, backend.rotations(int(path[1]), datetime.fromisoformat(path[4]), datetime.fromisoformat(path[5])))
+                return self.reply(404, b'"not found"')
+            if parts[:2] == ['v2', 'entities']:
+                if len(parts) == 3:
+                    backend.count('orion_get')
+                    entity = backend.entities.get(parts[2], None)
+                    if entity is None:
+                        return self.reply(404, {'error': 'NotFound'})
+                    return self.reply(200, entity)
+                backend.count('orion_query')
+                page, total = backend.query(query.get('type', [''])[0], query.get('attrs', [None])[0],
+                                            int(query.get('offset', ['0'])[0]), int(query.get('limit', ['20'])[0]))
+                return self.reply(200, page, {'Fiware-Total-Count': str(total)})
+            return self.reply(404, b'"not found"')
+
+        # pylint: disable=invalid-name
+        def do_POST(self):
+            """Keystone authentication and Orion batch updates"""
+            server_sleep(backend.latency)
+            url = urlparse(self.path)
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.headers.get('Content-Encoding', '') == 'gzip':
+                data = gzip.decompress(data)
+            if url.path == '/v3/auth/tokens':
+                backend.count('keystone')
+                expires = (datetime.now(timezone.utc) + timedelta(hours=1)).isoformat()
+                return self.reply(201, {'token': {'expires_at': expires}}, {'X-Subject-Token': 'benchmark-token'})
+            if url.path == '/v2/op/update':
+                backend.count('orion_update')
+                with backend.lock:
+                    backend.received_bytes += len(data)
+                if backend.fail():
+                    return self.reply(500, b'simulated failure')
+                backend.update(json.loads(data))
+                return self.reply(204)
+            return self.reply(404, b'"not found"')
+
+    return Handler
+
+
+@dataclass
+class SleepCounter:
+    """Accumulates the time spent in time.sleep by any thread"""
+    total: float = 0.0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def install(self):
+        """Wrap time.sleep, also in the limiter module that imported it by name"""
+        original = time.sleep
+
+        def sleep(seconds: float):
+            with self.lock:
+                self.total += seconds
+            original(seconds)
+
+        time.sleep = sleep
+        limiter.limiter.sleep = sleep
+
+
+def run(backend: FakeBackend, collect_args: List[str]) -> Dict[str, Any]:
+    """Run collect.main against the fake backend, and return the measurements"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler(backend))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+    sys.argv = [
+        'collect.py',
+        '--api-url', url,
+        '--api-organism', 'bench',
+        '--api-username', 'bench',
+        '--api-password', 'bench',
+        '--keystone-url', url,
+        '--orion-url', url,
+        '--orion-service', 'bench',
+        '--orion-subservice', '/bench',
+        '--orion-username', 'bench',
+        '--orion-password', 'bench',
+    ] + collect_args
+    sleeps = SleepCounter()
+    sleeps.install()
+    tracemalloc.start()
+    started = time.monotonic()
+    result = 'OK'
+    try:
+        collect.main()
+    # pylint: disable=broad-except
+    except Exception as err:
+        result = f'KO: {err!r}'
+    elapsed = time.monotonic() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    server.shutdown()
+    return {
+        'result': result,
+        'elapsed': elapsed,
+        'entities': backend.received,
+        'entities_per_second': backend.received / elapsed if elapsed > 0 else 0,
+        'bytes_sent': backend.received_bytes,
+        'requests': dict(sorted(backend.requests.items())),
+        'sleep': sleeps.total,
+        'peak_memory': peak,
+        'metrics': collect.metrics.summary(),
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]):
+    """Print the relative change of the main measurements against a baseline"""
+    for key in ('elapsed', 'entities_per_second', 'bytes_sent', 'sleep', 'peak_memory'):
+        before, after = baseline.get(key, 0), current.get(key, 0)
+        change = (after - before) / before * 100 if before else 0
+        print(f'{key:>20}: {before:14.2f} -> {after:14.2f} ({change:+.1f}%)')
+    for key in sorted(set(baseline.get('requests', {})) | set(current.get('requests', {}))):
+        before, after = baseline.get('requests', {}).get(key, 0), current.get('requests', {}).get(key, 0)
+        print(f'{key:>20}: {before:14d} -> {after:14d}')
+
+
+def main():
+    """Benchmark entry point"""
+    argparser = argparse.ArgumentParser(
+        description=__doc__,
+        epilog='Arguments after "--" are passed to collect.py, e.g. -- --workers 4')
+    argparser.add_argument('--spots', type=int, default=50, help='Number of spots')
+    argparser.add_argument('--zones', type=int, default=5, help='Number of zones')
+    argparser.add_argument('--days', type=float, default=1.0, help='Days of backlog of each spot')
+    argparser.add_argument('--events-per-day', type=int, default=96, help='vehicle_ctrl events per spot and day')
+    argparser.add_argument('--latency', type=float, default=0.0, help='Delay of every response, in seconds')
+    argparser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of data requests that fail')
+    argparser.add_argument('--seed', type=int, default=0, help='Random seed')
+    argparser.add_argument('--output', default=None, help='Save the measurements to this JSON file')
+    argparser.add_argument('--baseline', default=None, help='Compare with measurements saved by a previous run')
+    argparser.add_argument('--verbose', action='store_true', default=False, help='Show the ETL logs')
+    argparser.add_argument('collect_args', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    options = argparser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if options.verbose else logging.CRITICAL,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    collect_args = options.collect_args
+    if collect_args and collect_args[0] == '--':
+        collect_args = collect_args[1:]
+    backend = FakeBackend(spots=options.spots, zones=options.zones, days=options.days,
+                          events_per_day=options.events_per_day, latency=options.latency,
+                          error_rate=options.error_rate, seed=options.seed)
+    result = run(backend, collect_args)
+    result['settings'] = {key: value for key, value in vars(options).items()
+                          if key not in ('output', 'baseline', 'verbose', 'collect_args')}
+    result['settings']['collect_args'] = collect_args
+    print(json.dumps(result, indent=2))
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as outfile:
+            json.dump(result, outfile, indent=2)
+    if options.baseline:
+        with open(options.baseline, 'r', encoding='utf-8') as infile:
+            compare(result, json.load(infile))
+
+
+if __name__ == "__main__":
+    main()
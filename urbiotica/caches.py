@@ -0,0 +1,197 @@
+# pylint: disable=line-too-long
+"""In-memory and on-disk caches of the topology and of the state already written"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from typing import Dict, Any, List, Optional
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from checkpoints import CheckpointStore, SpotState, ZoneState
+
+
+JsonDict = Dict[str, Any]
+JsonList = List[JsonDict]
+
+
+@dataclass
+class MetadataCache:
+    """Local JSON file caching the responses of the urbiotica topology endpoints.
+
+    New entries are kept in memory until save is called, once per discovery.
+    """
+    path: str
+    # Entries older than this are fetched again
+    ttl: float = 24 * 60 * 60
+    # If True, ignore the current entries (they are replaced as they are fetched again)
+    refresh: bool = False
+    entries: Dict[str, Any] = field(default_factory=dict)
+    # True if there are entries not saved yet
+    dirty: bool = False
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def open(self):
+        """Load the cache file, if it exists"""
+        if self.refresh or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as infile:
+                self.entries = json.load(infile)
+        except (OSError, ValueError) as err:
+            logging.warning('Failed to read metadata cache %s: %s', self.path, err)
+
+    def get(self, key: str) -> Optional[Any]:
+        """Cached response for the key, None if missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key, None)
+        if entry is None or time.time() - entry['fetched'] > self.ttl:
+            return None
+        return entry['data']
+
+    def put(self, key: str, data: Any):
+        """Cache a response (see save)"""
+        with self.lock:
+            self.entries[key] = {'fetched': time.time(), 'data': data}
+            self.dirty = True
+
+    def save(self):
+        """Write the cache file, if there are new entries"""
+        with self.lock:
+            if not self.dirty:
+                return
+            # Shards may share the file, so each write goes through its own temporary file
+            try:
+                handle, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                                   prefix=os.path.basename(self.path) + '.', suffix='.tmp')
+                try:
+                    with os.fdopen(handle, 'w', encoding='utf-8') as outfile:
+                        json.dump(self.entries, outfile)
+                    os.replace(tmpname, self.path)
+                except BaseException:
+                    os.unlink(tmpname)
+                    raise
+                self.dirty = False
+            except OSError as err:
+                logging.warning('Failed to write metadata cache %s: %s', self.path, err)
+
+
+def zone_area(zone_poms: JsonList) -> List[List[float]]:
+    """Rectangle around the POMs of a zone, as a list of [latitude, longitude]"""
+    # shapely is slow to import, and only needed when zones are loaded
+    from shapely.geometry import Polygon # type: ignore # pylint: disable=import-outside-toplevel
+    points = [[float(pom['latitude']),
+               float(pom['longitude'])] for pom in zone_poms]
+    area = Polygon(points).buffer(
+        0.0001).minimum_rotated_rectangle.exterior.coords
+    return [[item[0], item[1]] for item in area]
+
+
+@dataclass
+class ZoneCache:
+    """Keeps the last state of each zone sent, to skip the zones that did not change.
+
+    The area of a zone is only computed again when the coordinates
+    of its POMs change. If refresh is True, all zones are sent.
+    """
+    store: Optional[CheckpointStore] = None
+    refresh: bool = False
+    states: Dict[str, ZoneState] = field(default_factory=dict)
+
+    def open(self):
+        """Load the states from the store, if any"""
+        if self.store is not None:
+            self.states = self.store.load_zones()
+
+    def update(self, zone: JsonDict, zone_poms: JsonList) -> Optional[ZoneState]:
+        """New state of the zone, or None if it did not change"""
+        zoneid = str(zone['zoneid'])
+        coords = sorted((str(pom['latitude']), str(pom['longitude'])) for pom in zone_poms)
+        geometry = hashlib.sha1(json.dumps(coords).encode('utf-8')).hexdigest()
+        attrs = [zone['description'], zone['lat_ne'], zone['lat_sw'], zone['long_ne'], zone['long_sw']]
+        fingerprint = hashlib.sha1(json.dumps([geometry, attrs]).encode('utf-8')).hexdigest()
+        previous = self.states.get(zoneid, None)
+        if previous is not None and previous.fingerprint == fingerprint and not self.refresh:
+            return None
+        if previous is not None and previous.geometry == geometry:
+            area = previous.area
+        else:
+            area = zone_area(zone_poms)
+        return ZoneState(geometry, area, fingerprint)
+
+    def save(self, zoneid: str, state: ZoneState):
+        """Record the state of a zone, once sent"""
+        self.states[zoneid] = state
+        if self.store is not None:
+            self.store.save_zone(zoneid, state)
+
+
+@dataclass
+class SpotStateCache:
+    """Keeps the last state of each ParkingSpot written, to skip writing it again.
+
+    Keeps up to capacity states in memory, evicting the least recently
+    used, backed by the checkpoint store, where the changed states are
+    saved by snapshot. If refresh is True, the static attributes saved
+    are ignored, so they are written again.
+    """
+    store: Optional[CheckpointStore] = None
+    capacity: int = 10000
+    refresh: bool = False
+    states: 'OrderedDict[str, SpotState]' = field(default_factory=OrderedDict)
+    # States changed since the last snapshot
+    dirty: Dict[str, SpotState] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def get(self, entityid: str) -> Optional[SpotState]:
+        """Last state written of the entity, if known"""
+        with self.lock:
+            state = self.states.get(entityid, None) or self.dirty.get(entityid, None)
+            if state is not None:
+                self._remember(entityid, state)
+                return state
+        if self.store is None:
+            return None
+        state = self.store.load_spot_state(entityid)
+        if state is None:
+            return None
+        if self.refresh:
+            state = state._replace(static='')
+        with self.lock:
+            # Unless written meanwhile
+            state = self.states.get(entityid, state)
+            self._remember(entityid, state)
+        return state
+
+    def update(self, entityid: str, modified: int, static: str = ''):
+        """Record that the entity was written, with static attributes hashing to static if given"""
+        with self.lock:
+            previous = self.states.get(entityid, None) or self.dirty.get(entityid, None)
+            if previous is not None:
+                modified = max(modified, previous.modified)
+                static = static or previous.static
+            state = SpotState(modified, static)
+            if state != previous:
+                self.dirty[entityid] = state
+            self._remember(entityid, state)
+            full = len(self.dirty) >= self.capacity
+        if full:
+            self.snapshot()
+
+    def snapshot(self):
+        """Save the states changed since the last snapshot to the store"""
+        with self.lock:
+            dirty, self.dirty = self.dirty, dict()
+        if self.store is not None and dirty:
+            self.store.save_spot_states(dirty)
+
+    def _remember(self, entityid: str, state: SpotState):
+        self.states[entityid] = state
+        self.states.move_to_end(entityid)
+        while len(self.states) > self.capacity:
+            self.states.popitem(last=False)
@@ -0,0 +1,202 @@
+# pylint: disable=line-too-long
+"""Local sqlite store of the progress of the ETL between runs"""
+
+import json
+import sqlite3
+import threading
+
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Protocol, NamedTuple
+from dataclasses import dataclass, field
+
+
+# pylint: disable=too-few-public-methods
+class Checkpoints(Protocol):
+    """Checkpoints represents where the latest event sent of each pom is recorded"""
+    def save(self, pomid: int, lstamp: datetime):
+        """Record the lstamp for the pom, unless there is a later one already"""
+
+
+class SpotStats(NamedTuple):
+    """Polling statistics of a pom"""
+    # Epoch of the end of the last successful poll
+    polled: float
+    # Estimated events per second
+    rate: float
+
+
+class ZoneState(NamedTuple):
+    """State of a zone, as last sent"""
+    # Hash of the coordinates of its POMs, and the area computed from them
+    geometry: str
+    area: List[List[float]]
+    # Hash of all the data in the OnStreetParking entity
+    fingerprint: str
+
+
+class SpotState(NamedTuple):
+    """State of a ParkingSpot, as last written to the store"""
+    # Epoch seconds of the latest occupancyModified written
+    modified: int
+    # Hash of the static attributes written (see SpotIterator.encoded)
+    static: str
+
+
+# Tables of the checkpoint store, and what they are used for
+TABLES = {
+    # Latest lstamp sent of each pom (CheckpointStore.load)
+    'checkpoints': 'pomid INTEGER PRIMARY KEY, lstamp TEXT NOT NULL',
+    # Polling statistics (SpotScheduler)
+    'spot_stats': 'pomid INTEGER PRIMARY KEY, polled REAL NOT NULL, rate REAL NOT NULL',
+    # Zones sent with --load-zones (ZoneCache)
+    'zones': 'zoneid TEXT PRIMARY KEY, geometry TEXT NOT NULL, area TEXT NOT NULL, fingerprint TEXT NOT NULL',
+    # Spots written with --skip-unchanged (SpotStateCache)
+    'spot_states': 'entityid TEXT PRIMARY KEY, modified INTEGER NOT NULL, static TEXT NOT NULL',
+    # Progress of each --backfill (BackfillProgress)
+    'backfills': 'pomid INTEGER NOT NULL, start TEXT NOT NULL, end TEXT NOT NULL, lstamp TEXT NOT NULL, PRIMARY KEY (pomid, start, end)',
+    # Intervals aggregated with --aggregate-interval
+    'aggregates': 'entityid TEXT PRIMARY KEY, until TEXT NOT NULL',
+}
+
+
+@dataclass
+class CheckpointStore:
+    """Local sqlite store of the latest lstamp successfully sent for each pomid,
+    and of the rest of the state kept between runs (see TABLES)"""
+    path: str
+    conn: Optional[sqlite3.Connection] = None
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def open(self):
+        """Open the database, creating the tables if needed"""
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.conn:
+            for table, columns in TABLES.items():
+                self.conn.execute(f'CREATE TABLE IF NOT EXISTS {table} ({columns})')
+
+    def close(self):
+        """Close the database"""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def load(self) -> Dict[str, datetime]:
+        """Latest lstamp of each pom, keyed by entity ID"""
+        assert self.conn is not None
+        with self.lock:
+            rows = self.conn.execute('SELECT pomid, lstamp FROM checkpoints').fetchall()
+        return {f'pomid:{pomid}': datetime.fromisoformat(lstamp) for pomid, lstamp in rows}
+
+    def save(self, pomid: int, lstamp: datetime):
+        """Record the lstamp for the pom, unless there is a later one already"""
+        assert self.conn is not None
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT INTO checkpoints (pomid, lstamp) VALUES (?, ?) '
+                'ON CONFLICT(pomid) DO UPDATE SET lstamp = excluded.lstamp '
+                'WHERE excluded.lstamp > checkpoints.lstamp',
+                (pomid, lstamp.astimezone(timezone.utc).isoformat()))
+
+    def load_stats(self) -> Dict[int, SpotStats]:
+        """Polling statistics of each pom (see SpotScheduler)"""
+        assert self.conn is not None
+        with self.lock:
+            rows = self.conn.execute('SELECT pomid, polled, rate FROM spot_stats').fetchall()
+        return {pomid: SpotStats(polled, rate) for pomid, polled, rate in rows}
+
+    def save_stats(self, pomid: int, stats: SpotStats):
+        """Record the polling statistics of the pom"""
+        assert self.conn is not None
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT INTO spot_stats (pomid, polled, rate) VALUES (?, ?, ?) '
+                'ON CONFLICT(pomid) DO UPDATE SET polled = excluded.polled, rate = excluded.rate',
+                (pomid, stats.polled, stats.rate))
+
+    def load_zones(self) -> Dict[str, ZoneState]:
+        """Last state of each zone sent (see ZoneCache)"""
+        assert self.conn is not None
+        with self.lock:
+            rows = self.conn.execute('SELECT zoneid, geometry, area, fingerprint FROM zones').fetchall()
+        return {zoneid: ZoneState(geometry, json.loads(area), fingerprint) for zoneid, geometry, area, fingerprint in rows}
+
+    def save_zone(self, zoneid: str, state: ZoneState):
+        """Record the state of a zone sent"""
+        assert self.conn is not None
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT INTO zones (zoneid, geometry, area, fingerprint) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(zoneid) DO UPDATE SET geometry = excluded.geometry, area = excluded.area, fingerprint = excluded.fingerprint',
+                (zoneid, state.geometry, json.dumps(state.area), state.fingerprint))
+
+    def load_spot_state(self, entityid: str) -> Optional[SpotState]:
+        """Last state of a ParkingSpot written (see SpotStateCache), if known"""
+        assert self.conn is not None
+        with self.lock:
+            row = self.conn.execute('SELECT modified, static FROM spot_states WHERE entityid = ?', (entityid,)).fetchone()
+        return SpotState(*row) if row is not None else None
+
+    def save_spot_states(self, states: Dict[str, SpotState]):
+        """Record the last state written of several ParkingSpots"""
+        assert self.conn is not None
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT INTO spot_states (entityid, modified, static) VALUES (?, ?, ?) '
+                'ON CONFLICT(entityid) DO UPDATE SET modified = MAX(modified, excluded.modified), '
+                "static = CASE WHEN excluded.static = '' THEN static ELSE excluded.static END",
+                [(entityid, state.modified, state.static) for entityid, state in states.items()])
+
+    def load_backfill(self, start: datetime, end: datetime) -> Dict[int, datetime]:
+        """Latest lstamp sent of each pom by the backfill of the range between start and end"""
+        assert self.conn is not None
+        with self.lock:
+            rows = self.conn.execute('SELECT pomid, lstamp FROM backfills WHERE start = ? AND end = ?',
+                                     (start.astimezone(timezone.utc).isoformat(), end.astimezone(timezone.utc).isoformat())).fetchall()
+        return {pomid: datetime.fromisoformat(lstamp) for pomid, lstamp in rows}
+
+    def save_backfill(self, start: datetime, end: datetime, pomid: int, lstamp: datetime):
+        """Record the lstamp sent for the pom by the backfill of the range, unless there is a later one already"""
+        assert self.conn is not None
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT INTO backfills (pomid, start, end, lstamp) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(pomid, start, end) DO UPDATE SET lstamp = excluded.lstamp '
+                'WHERE excluded.lstamp > backfills.lstamp',
+                (pomid, start.astimezone(timezone.utc).isoformat(), end.astimezone(timezone.utc).isoformat(),
+                 lstamp.astimezone(timezone.utc).isoformat()))
+
+    def load_aggregates(self) -> Dict[str, datetime]:
+        """End of the last interval aggregated, by entity ID"""
+        assert self.conn is not None
+        with self.lock:
+            rows = self.conn.execute('SELECT entityid, until FROM aggregates').fetchall()
+        return {entityid: datetime.fromisoformat(until) for entityid, until in rows}
+
+    def save_aggregate(self, entityid: str, until: datetime):
+        """Record the end of the last interval aggregated"""
+        assert self.conn is not None
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT INTO aggregates (entityid, until) VALUES (?, ?) '
+                'ON CONFLICT(entityid) DO UPDATE SET until = excluded.until',
+                (entityid, until.astimezone(timezone.utc).isoformat()))
+
+
+@dataclass
+class BackfillProgress:
+    """Checkpoints of a backfill of the range between start and end.
+
+    They are kept apart from the live checkpoints, so that the backfill
+    can be resumed, and runs alongside the live collection without moving it.
+    """
+    store: CheckpointStore
+    start: datetime
+    end: datetime
+
+    def load(self) -> Dict[int, datetime]:
+        """Latest lstamp sent of each pom"""
+        return self.store.load_backfill(self.start, self.end)
+
+    def save(self, pomid: int, lstamp: datetime):
+        """Record the lstamp sent for the pom"""
+        self.store.save_backfill(self.start, self.end, pomid, lstamp)
@@ -2,51 +2,165 @@
 # pylint: disable=line-too-long
 """Load ParkingSpot data from Urbiotica API"""
 
+import asyncio
+import cProfile
+import pstats
 import itertools
 import math
 import logging
 import sys
 import traceback
 import json
+import os
 import time
-
+import random
+import threading
+import zlib
+import hashlib
+import gzip
+import tempfile
+import signal
+import heapq
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime, timedelta, timezone
-from operator import itemgetter
-from typing import Dict, Any, List, Generator, Optional, Protocol, Sequence
-from collections import defaultdict
-from dataclasses import dataclass
+from typing import Dict, Any, AsyncGenerator, Callable, Deque, List, Generator, Iterable, Optional, Protocol, Sequence, Set, NamedTuple, Tuple
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
 
+import numpy as np
 import requests
 import urllib3 # type: ignore
 import configargparse # type: ignore
 
 from dateutil import parser # type: ignore
-from limiter import Limiter, get_limiter, limit_rate # type: ignore
-from shapely.geometry import Polygon # type: ignore
+from limiter import Limiter, get_limiter # type: ignore
+
+from instrumentation import metered, metered_async, metrics
+from stores import EncodedEntity, FileStore, PostgresStore, Spool, Store, encode_batch, replay
+from checkpoints import BackfillProgress, CheckpointStore, Checkpoints, SpotState, SpotStats
+from caches import JsonDict, JsonList, MetadataCache, SpotStateCache, ZoneCache, zone_area
 
 
 # -------------------
 # Orion-related stuff
 # -------------------
 
-class Store(Protocol):
-    """Store represents any persistence backend"""
-    def open(self):
-        """Ready the store for saving data"""
-    def send_batch(self, subservice: str, entities: Sequence[Any]) -> None:
-        """Saves a batch of entities to the backend"""
-    def close(self):
-        """Closes the backend connection"""
-
 # pylint: disable=redefined-outer-name
 class Session(Protocol):
     """Session represents a requests.Session"""
     def get(self, url: str, headers: Optional[Dict[str, str]]=None, params: Optional[Dict[str, str]]=None, verify: Optional[bool]=None) -> requests.Response:
         """Performs an http GET"""
-    def post(self, url: str, headers: Optional[Dict[str, str]]=None, json: Any=None, verify: Optional[bool]=None) -> requests.Response:
+    def post(self, url: str, headers: Optional[Dict[str, str]]=None, json: Any=None, data: Optional[bytes]=None, verify: Optional[bool]=None) -> requests.Response:
         """Perform an HTTP POST"""
 
 
+@dataclass
+class AsyncResponse:
+    """Response of an AsyncSession, already read, with the attributes of requests.Response used by the ETL"""
+    status_code: int
+    headers: Any
+    content: bytes
+
+    @property
+    def text(self) -> str:
+        """Body of the response, as text"""
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self) -> Any:
+        """Body of the response, parsed as JSON. Raises requests' JSONDecodeError, like requests.Response"""
+        try:
+            return json.loads(self.content)
+        except json.JSONDecodeError as err:
+            raise requests.exceptions.JSONDecodeError(err.msg, err.doc, err.pos) from err
+
+    def raise_for_status(self):
+        """Raise requests' HTTPError if the response is a 4xx or 5xx, like requests.Response"""
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f'{self.status_code} error: {self.text[:200]}')
+
+
+# pylint: disable=too-few-public-methods
+class AsyncSession(Protocol):
+    """Same as Session, for asyncio. Connection errors are raised as requests exceptions"""
+    async def get(self, url: str, headers: Optional[Dict[str, str]]=None, params: Optional[Dict[str, str]]=None, verify: Optional[bool]=None) -> AsyncResponse:
+        """Performs an http GET"""
+    async def post(self, url: str, headers: Optional[Dict[str, str]]=None, json: Any=None, data: Optional[bytes]=None, verify: Optional[bool]=None) -> AsyncResponse:
+        """Perform an HTTP POST"""
+
+
+# --------------
+# HTTP transport
+# --------------
+
+class TimeoutSession(requests.Session):
+    """requests.Session with a default (connect, read) timeout for every request"""
+
+    def __init__(self, timeout: Tuple[float, float]):
+        super().__init__()
+        self.timeout = timeout
+
+    # pylint: disable=arguments-differ
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def new_session(pool_size: int = 10, retries: int = 2, connect_timeout: float = 10,
+                read_timeout: float = 60) -> TimeoutSession:
+    """Session with pooled keep-alive connections, timeouts and retries.
+
+    Only connection errors are retried by the session: those requests
+    never reached the server, so they do not count against rate limits.
+    """
+    session = TimeoutSession((connect_timeout, read_timeout))
+    retry = urllib3.util.Retry(total=retries, connect=retries, read=0, status=0,
+                               redirect=retries, backoff_factor=0.5)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                            max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+@dataclass
+class AiohttpSession:
+    """AsyncSession on top of an aiohttp ClientSession"""
+    session: Any
+    # Exceptions raised by aiohttp for network errors
+    errors: Tuple[type, ...]
+
+    @classmethod
+    def new(cls, pool_size: int = 10, connect_timeout: float = 10,
+            read_timeout: float = 60) -> 'AiohttpSession':
+        """Session with up to pool_size keep-alive connections, and timeouts. Must be created inside the event loop"""
+        # Optional dependency, only needed with --asyncio
+        import aiohttp # type: ignore # pylint: disable=import-outside-toplevel
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size), timeout=timeout)
+        return cls(session, (aiohttp.ClientError, asyncio.TimeoutError))
+
+    async def request(self, method: str, url: str, verify: Optional[bool], **kwargs) -> AsyncResponse:
+        """Send a request and read the whole response"""
+        try:
+            async with self.session.request(method, url, ssl=None if verify is not False else False, **kwargs) as res:
+                return AsyncResponse(res.status, res.headers.copy(), await res.read())
+        except self.errors as err:
+            raise requests.exceptions.ConnectionError(f'{method} {url}: {err!r}') from err
+
+    async def get(self, url: str, headers: Optional[Dict[str, str]]=None, params: Optional[Dict[str, str]]=None, verify: Optional[bool]=None) -> AsyncResponse:
+        return await self.request('GET', url, verify, headers=headers, params=params)
+
+    async def post(self, url: str, headers: Optional[Dict[str, str]]=None, json: Any=None, data: Optional[bytes]=None, verify: Optional[bool]=None) -> AsyncResponse:
+        # pylint: disable=redefined-outer-name
+        return await self.request('POST', url, verify, headers=headers, json=json, data=data)
+
+    async def close(self):
+        await self.session.close()
+
+
 # Define classes
 @dataclass(frozen=True)
 class CustomException(Exception):
@@ -87,9 +201,50 @@ class OrionStore:
     retries: int
     session: Session
     token: Dict[str, str]
+    # Guards token creation and renewal when batches are sent from several threads
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    # Rate limit for requests to the context broker, unlimited if None
+    bucket: Optional[Limiter] = None
+    # Upper bound of the delay between retries
+    max_backoff: float = 60.0
+    # Expiration of each token, as reported by keystone
+    token_expiry: Dict[str, datetime] = field(default_factory=dict)
+    # Tokens are renewed this many seconds before they expire
+    token_margin: float = 300.0
+    # File where tokens are kept between runs, if any
+    token_cache: Optional[str] = None
+    # Send batch updates gzip-compressed (requires a proxy or broker that accepts them)
+    compress: bool = False
+    # Session for the async variants of the requests, if any
+    async_session: Optional[AsyncSession] = None
+    # Called whenever orion answers a batch with 429 or 5xx, before retrying (see Batcher.throttle)
+    on_throttle: Optional[Callable[[], None]] = None
 
     def open(self):
-        """Open the store. For OrionStore, it's just a no-op"""
+        """Open the store. Loads the still valid tokens from the token cache, if any"""
+        if self.token_cache is None or not os.path.exists(self.token_cache):
+            return
+        try:
+            with open(self.token_cache, 'r', encoding='utf-8') as infile:
+                cached = json.load(infile)
+        except (OSError, ValueError) as err:
+            logging.warning('Failed to read token cache %s: %s', self.token_cache, err)
+            return
+        prefix = self.token_cache_key('')
+        for key, item in cached.items():
+            if not key.startswith(prefix):
+                continue
+            subservice = key[len(prefix):]
+            try:
+                token, expiry = item['token'], parser.isoparse(item['expires_at'])
+            except (KeyError, TypeError, ValueError) as err:
+                # A malformed entry is a cache miss, the token is requested again
+                logging.warning('Ignoring malformed cached token for subservice "%s": %s', subservice, err)
+                continue
+            if not self.token_expires(expiry):
+                logging.info('Using cached token for subservice "%s", valid until %s', subservice, expiry)
+                self.token[subservice] = token
+                self.token_expiry[subservice] = expiry
 
     def close(self):
         """Close the store. For OrionStore, it's a no-op"""
@@ -136,10 +291,18 @@ class OrionStore:
             logging.error('Failed to get auth token (subservice "%s") (%d) (%s)', subservice, res.status_code, res.text)
             raise NetworkException(msg='Failed to get auth token', url=req_url, status_code=res.status_code, text=res.text)
 
-        self.token[subservice] = res.headers["X-Subject-Token"]
+        self.save_token(subservice, res)
         logging.info('Authentication token for subservice "%s" was created successfully', subservice)
 
-    def renew_token(self, subservice: str):
+    def renew_token(self, subservice: str, rejected: Optional[str] = None):
+        """Renew the token of the subservice, unless it is no longer the rejected one (renewed by another thread)"""
+        with self.lock:
+            if rejected is not None and self.token.get(subservice, None) != rejected:
+                logging.debug('Token for subservice "%s" was already renewed', subservice)
+                return
+            self._renew_token(subservice)
+
+    def _renew_token(self, subservice: str):
         headers = {
             'Content-Type': 'application/json'
         }
@@ -164,17 +327,117 @@ class OrionStore:
             logging.error('Failed to renew token (subservice "%s") (%d) (%s)', subservice, res.status_code, res.text)
             raise NetworkException(msg='Failed to renew toen', url=req_url, status_code=res.status_code, text=res.text)
 
-        self.token[subservice] = res.headers["X-Subject-Token"]
+        self.save_token(subservice, res)
         logging.info('Authentication token for subservice "%s" was renewed successfully', subservice)
 
+    def ensure_token(self, subservice: str):
+        """Make sure there is a valid token for the subservice, authenticating only once across threads"""
+        with self.lock:
+            if subservice not in self.token:
+                self.get_auth_token_subservice(subservice)
+            elif self.token_expires(self.token_expiry.get(subservice, None)):
+                logging.info('Token for subservice "%s" is about to expire', subservice)
+                self.get_auth_token_subservice(subservice)
+
+    def token_expires(self, expiry: Optional[datetime]) -> bool:
+        """True if the token expiration is known, and falls within token_margin"""
+        if expiry is None:
+            return False
+        return expiry - datetime.now(timezone.utc) < timedelta(seconds=self.token_margin)
+
+    def token_cache_key(self, subservice: str) -> str:
+        """Key of the token in the cache file, tokens are only reused for the same user and service"""
+        return f'{self.endpoint_keystone}|{self.service}|{self.user}|{subservice}'
+
+    def save_token(self, subservice: str, res: requests.Response):
+        """Keep the token from a keystone response, and its expiration time"""
+        self.token[subservice] = res.headers["X-Subject-Token"]
+        self.token_expiry.pop(subservice, None)
+        try:
+            self.token_expiry[subservice] = parser.isoparse(res.json()['token']['expires_at'])
+        except (ValueError, KeyError, TypeError) as err:
+            logging.warning('Failed to read token expiration (subservice "%s"): %s', subservice, err)
+        if self.token_cache is None or subservice not in self.token_expiry:
+            return
+        cached = dict()
+        if os.path.exists(self.token_cache):
+            try:
+                with open(self.token_cache, 'r', encoding='utf-8') as infile:
+                    cached = json.load(infile)
+            except (OSError, ValueError):
+                cached = dict()
+        cached[self.token_cache_key(subservice)] = {
+            'token': self.token[subservice],
+            'expires_at': self.token_expiry[subservice].isoformat(),
+        }
+        # The file holds credentials, mkstemp makes sure only the owner can read it.
+        # Shards may share the file, so each write goes through its own temporary file
+        try:
+            handle, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.token_cache)),
+                                               prefix=os.path.basename(self.token_cache) + '.', suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'w', encoding='utf-8') as outfile:
+                    json.dump(cached, outfile)
+                os.replace(tmpname, self.token_cache)
+            except BaseException:
+                os.unlink(tmpname)
+                raise
+        except OSError as err:
+            logging.warning('Failed to write token cache %s: %s', self.token_cache, err)
+
+    def limit(self):
+        """Context manager that waits for the rate limit bucket, and times the request"""
+        return metered(self.bucket, 'orion')
+
+    def retry_delay(self, attempt: int, res: Optional[Any]) -> float:
+        """
+        Seconds to wait before retrying a failed request
+        :param attempt: number of the failed attempt, starting at 0
+        :param res: the failed response, None if there was none. If it has a Retry-After header, it is honoured.
+        """
+        delay = None
+        retry_after = res.headers.get('Retry-After', None) if res is not None and res.headers is not None else None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    delay = None
+        if delay is None:
+            # Exponential backoff with full jitter
+            delay = random.uniform(0, min(self.max_backoff, self.seconds_sleep * 2 ** attempt))
+        delay = max(0.0, min(self.max_backoff, delay))
+        logging.info('Retrying in %.2f seconds', delay)
+        metrics.count('orion_retries')
+        return delay
+
+    def throttled(self, status_code: int):
+        """Let on_throttle know if orion is overloaded, judging by the status of a failed batch"""
+        if self.on_throttle is not None and (status_code == 429 or status_code >= 500):
+            self.on_throttle()
+
+    def backoff(self, attempt: int, res: Optional[requests.Response]):
+        """Wait before retrying a failed request (see retry_delay)"""
+        delay = self.retry_delay(attempt, res)
+        with metrics.timer('orion_backoff_sleep'):
+            time.sleep(delay)
+
+    async def backoff_async(self, attempt: int, res: Optional[AsyncResponse]):
+        """Same as backoff, without blocking the event loop"""
+        delay = self.retry_delay(attempt, res)
+        with metrics.timer('orion_backoff_sleep'):
+            await asyncio.sleep(delay)
+
     def batch_url(self):
         """URL for batch requests to orion"""
         return self.endpoint_cb + '/v2/op/update'
 
-    def batch_creation_update(self, subservice: str, entities: Sequence[Any]):
+    def batch_creation_update(self, subservice: str, body: bytes):
         """
         Send a POST /v2/op/update batch
-        :param entities: the entities to be included in the batch (up to page_size, but construction)
+        :param body: the serialized batch (see encode_batch)
         :return: response
         """
         headers = {
@@ -183,14 +446,70 @@ class OrionStore:
             'X-Auth-Token': self.token[subservice],
             'Content-Type': 'application/json'
         }
+        if self.compress:
+            body = gzip.compress(body, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+            metrics.count('orion_compressed_bytes', len(body))
 
-        body = {
-            'actionType': 'append',
-            'entities': entities
+        req_url = self.batch_url()
+        with self.limit():
+            return self.session.post(req_url, data=body, headers=headers, verify=False)
+
+    async def batch_creation_update_async(self, subservice: str, body: bytes) -> AsyncResponse:
+        """Same as batch_creation_update, with the async session"""
+        assert self.async_session is not None
+        headers = {
+            'Fiware-Service': self.service,
+            'Fiware-ServicePath': subservice,
+            'X-Auth-Token': self.token[subservice],
+            'Content-Type': 'application/json'
         }
+        if self.compress:
+            body = gzip.compress(body, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+            metrics.count('orion_compressed_bytes', len(body))
 
-        req_url = self.batch_url()
-        return self.session.post(req_url, json=body, headers=headers, verify=False)
+        async with metered_async(self.bucket, 'orion'):
+            return await self.async_session.post(self.batch_url(), data=body, headers=headers, verify=False)
+
+    async def send_batch_async(self, subservice: str, entities: Sequence[Any]):
+        """Same as send_batch, with the async session. Tokens are requested in a thread, with the sync session"""
+        logging.info('Subservice: "%s", %d entities', subservice, len(entities))
+        await asyncio.get_running_loop().run_in_executor(None, self.ensure_token, subservice)
+        body = encode_batch(entities)
+        started = time.monotonic()
+
+        retries, attempt = self.retries, 0
+        while True:
+            try:
+                token = self.token[subservice]
+                res = await self.batch_creation_update_async(subservice, body)
+                if res.status_code == 401:
+                    await asyncio.get_running_loop().run_in_executor(None, self.renew_token, subservice, token)
+                    res = await self.batch_creation_update_async(subservice, body)
+            except requests.exceptions.RequestException as err:
+                logging.error('Error in batch operation: %s', err)
+                if retries < 0:
+                    raise NetworkException(msg=f'Error in batch operation: {err}', url=self.batch_url(), status_code=0, text='') from err
+                retries -= 1
+                await self.backoff_async(attempt, None)
+                attempt += 1
+                continue
+
+            if res.status_code == 204:
+                break
+            logging.error('Error in batch operation (%d): %s', res.status_code, res.text)
+            self.throttled(res.status_code)
+            if retries < 0 or res.status_code == 413:
+                raise NetworkException(msg='Error in batch operation', url=self.batch_url(), status_code=res.status_code, text=res.text)
+            retries -= 1
+            await self.backoff_async(attempt, res)
+            attempt += 1
+
+        metrics.observe('orion_batch', time.monotonic() - started)
+        metrics.count('orion_entities', len(entities))
+        metrics.count('orion_bytes', len(body))
+        logging.info('Update batch of %d entities', len(entities))
 
     def send_batch(self, subservice: str, entities: Sequence[Any]):
         """
@@ -199,66 +518,183 @@ class OrionStore:
         :return: True if update was ok, False otherwise
         """
         logging.info('Subservice: "%s", %d entities', subservice, len(entities))
-        if subservice not in self.token.keys():
-            self.get_auth_token_subservice(subservice)
+        self.ensure_token(subservice)
+        body = encode_batch(entities)
+        started = time.monotonic()
 
-        done, retries = False, self.retries
+        done, retries, attempt = False, self.retries, 0
         while not done:
-            res = self.batch_creation_update(subservice, entities)
-            if res.status_code == 401:
-                self.renew_token(subservice)
-                res = self.batch_creation_update(subservice, entities)
+            try:
+                token = self.token[subservice]
+                res = self.batch_creation_update(subservice, body)
+                if res.status_code == 401:
+                    self.renew_token(subservice, token)
+                    res = self.batch_creation_update(subservice, body)
+            except requests.exceptions.RequestException as err:
+                logging.error('Error in batch operation: %s', err)
+                if retries < 0:
+                    raise NetworkException(msg=f'Error in batch operation: {err}', url=self.batch_url(), status_code=0, text='') from err
+                retries -= 1
+                self.backoff(attempt, None)
+                attempt += 1
+                continue
 
             if res.status_code == 204:
                 done = True
             else:
                 logging.error('Error in batch operation (%d): %s', res.status_code, res.text)
-                if retries < 0:
+                self.throttled(res.status_code)
+                # Retrying a payload that is too large is pointless
+                if retries < 0 or res.status_code == 413:
                     raise NetworkException(msg='Error in batch operation', url=self.batch_url(), status_code=res.status_code, text=res.text)
                 retries -= 1
-                time.sleep(self.seconds_sleep)
+                self.backoff(attempt, res)
+                attempt += 1
 
+        metrics.observe('orion_batch', time.monotonic() - started)
+        metrics.count('orion_entities', len(entities))
+        metrics.count('orion_bytes', len(body))
         logging.info('Update batch of %d entities', len(entities))
-        time.sleep(self.seconds_sleep)
 
     def get_url(self, entityid: str) -> str:
         return self.endpoint_cb + '/v2/entities/' + entityid
 
-    def get_entity(self, subservice: str, entityid: str, entitytype: str) -> Any:
-        """Get an entity by ID and type"""
-        logging.info('GET entity %s subservice: "%s"', entityid, subservice)
-        if subservice not in self.token.keys():
-            self.get_auth_token_subservice(subservice)
+    def query_url(self) -> str:
+        return self.endpoint_cb + '/v2/entities'
 
-        req_url = self.get_url(entityid)
-        headers = {
+    def get_headers(self, subservice: str) -> Dict[str, str]:
+        return {
             'Fiware-Service': self.service,
             'Fiware-ServicePath': subservice,
             'X-Auth-Token': self.token[subservice]
         }
-        params = {"type": entitytype}
-        retries = self.retries
+
+    def get_request(self, subservice: str, req_url: str, params: Dict[str, str]) -> requests.Response:
+        """Authenticated GET to orion, retried on failure. A 404 is returned to the caller"""
+        self.ensure_token(subservice)
+        retries, attempt = self.retries, 0
+        while True:
+            headers = {
+                'Fiware-Service': self.service,
+                'Fiware-ServicePath': subservice,
+                'X-Auth-Token': self.token[subservice]
+            }
+            try:
+                with self.limit():
+                    res = self.session.get(req_url, headers=headers, params=params, verify=False)
+                if res.status_code == 401:
+                    self.renew_token(subservice, headers['X-Auth-Token'])
+                    headers['X-Auth-Token'] = self.token[subservice]
+                    with self.limit():
+                        res = self.session.get(req_url, headers=headers, params=params, verify=False)
+            except requests.exceptions.RequestException as err:
+                logging.error('Error in get operation: %s', err)
+                if retries < 0:
+                    raise NetworkException(msg=f'Error in get operation: {err}', url=req_url, status_code=0, text='') from err
+                retries -= 1
+                self.backoff(attempt, None)
+                attempt += 1
+                continue
+
+            if res.status_code in (200, 404):
+                return res
+
+            logging.error('Error in get operation (%d): %s', res.status_code, res.text)
+            if retries < 0:
+                raise NetworkException(msg='Error in get operation', url=req_url, status_code=res.status_code, text=res.text)
+            retries -= 1
+            self.backoff(attempt, res)
+            attempt += 1
+
+    def get_entity(self, subservice: str, entityid: str, entitytype: str) -> Any:
+        """Get an entity by ID and type, None if it does not exist"""
+        logging.info('GET entity %s subservice: "%s"', entityid, subservice)
+        res = self.get_request(subservice, self.get_url(entityid), {"type": entitytype})
+        if res.status_code == 404:
+            return None
+        return res.json()
+
+    async def get_request_async(self, subservice: str, req_url: str, params: Dict[str, str]) -> AsyncResponse:
+        """Same as get_request, with the async session"""
+        assert self.async_session is not None
+        await asyncio.get_running_loop().run_in_executor(None, self.ensure_token, subservice)
+        retries, attempt = self.retries, 0
         while True:
-            res = self.session.get(req_url, headers=headers, params=params, verify=False)
-            if res.status_code == 401:
-                self.renew_token(subservice)
-                res = self.session.get(req_url, headers=headers, params=params, verify=False)
+            headers = self.get_headers(subservice)
+            try:
+                async with metered_async(self.bucket, 'orion'):
+                    res = await self.async_session.get(req_url, headers=headers, params=params, verify=False)
+                if res.status_code == 401:
+                    await asyncio.get_running_loop().run_in_executor(None, self.renew_token, subservice, headers['X-Auth-Token'])
+                    async with metered_async(self.bucket, 'orion'):
+                        res = await self.async_session.get(req_url, headers=self.get_headers(subservice), params=params, verify=False)
+            except requests.exceptions.RequestException as err:
+                logging.error('Error in get operation: %s', err)
+                if retries < 0:
+                    raise NetworkException(msg=f'Error in get operation: {err}', url=req_url, status_code=0, text='') from err
+                retries -= 1
+                await self.backoff_async(attempt, None)
+                attempt += 1
+                continue
 
-            if res.status_code == 200:
-                return res.json()
+            if res.status_code in (200, 404):
+                return res
 
             logging.error('Error in get operation (%d): %s', res.status_code, res.text)
             if retries < 0:
                 raise NetworkException(msg='Error in get operation', url=req_url, status_code=res.status_code, text=res.text)
             retries -= 1
-            time.sleep(self.seconds_sleep)
+            await self.backoff_async(attempt, res)
+            attempt += 1
+
+    async def get_entity_async(self, subservice: str, entityid: str, entitytype: str) -> Any:
+        """Same as get_entity, with the async session"""
+        logging.info('GET entity %s subservice: "%s"', entityid, subservice)
+        res = await self.get_request_async(subservice, self.get_url(entityid), {"type": entitytype})
+        if res.status_code == 404:
+            return None
+        return res.json()
+
+    def load_checkpoints(self, subservice: str, page_size: int = 1000) -> Dict[str, datetime]:
+        """
+        Get the latest occupancyModified of every ParkingSpot in the subservice
+        :param page_size: number of entities per request (orion caps it at 1000)
+        :return: dict from entity ID to occupancyModified
+        """
+        logging.info('Loading occupancyModified of all ParkingSpots in subservice "%s"', subservice)
+        checkpoints: Dict[str, datetime] = dict()
+        offset = 0
+        while True:
+            params = {
+                'type': 'ParkingSpot',
+                'idPattern': '^pomid:',
+                'attrs': 'occupancyModified',
+                'options': 'count',
+                'limit': str(page_size),
+                'offset': str(offset),
+            }
+            res = self.get_request(subservice, self.query_url(), params)
+            if res.status_code != 200:
+                raise NetworkException(msg='Error in query operation', url=self.query_url(), status_code=res.status_code, text=res.text)
+            page = res.json()
+            for entity in page:
+                value = entity.get('occupancyModified', {}).get('value', None)
+                if value:
+                    checkpoints[entity['id']] = parser.isoparse(value)
+            offset += len(page)
+            total = int(res.headers.get('Fiware-Total-Count', offset))
+            if len(page) < page_size or offset >= total:
+                break
+        logging.info('Loaded occupancyModified of %d ParkingSpots', len(checkpoints))
+        return checkpoints
+
 
 # ---------------
 # Urbiotica stuff
 # ---------------
 
-JsonDict = Dict[str, Any]
-JsonList = List[JsonDict]
+# Requests per minute allowed by the urbiotica API
+API_RATE_LIMIT = 100
 
 
 @dataclass
@@ -270,33 +706,52 @@ class Api:
     token: str
     bucket: Limiter
     session: Session
+    # Cache for topology queries (projects, zones, devices, spots), if any
+    cache: Optional[MetadataCache] = None
+    # Tokens of the bucket consumed by each request. A cost of N leaves
+    # this process 1/N of the rate limit, e.g. when N processes share it.
+    # It can not exceed API_RATE_LIMIT, the capacity of the bucket.
+    cost: int = 1
+    # Session for the async variants of the queries, if any
+    async_session: Optional[AsyncSession] = None
 
     # pylint: disable=too-many-arguments
     @classmethod
     def login(cls, session: Session, endpoint: str, organism: str,
-              username: str, password: str):
+              username: str, password: str, cost: int = 1):
         """login with the provided credentials"""
         # API is rate limited to 100 requests per minute
-        bucket = get_limiter(rate=100.0 / 60.0, capacity=100)
-        with limit_rate(bucket):
-            auth = session.get(
-                f'{endpoint}/v2/auth/{organism}/{username}/{password}')
+        bucket = get_limiter(rate=API_RATE_LIMIT / 60.0, capacity=API_RATE_LIMIT)
+        api = cls(endpoint, organism, '', bucket, session, cost=cost)
+        api.authenticate(username, password)
+        return api
+
+    def authenticate(self, username: str, password: str):
+        """Get a new token, keeping the session and rate limit bucket"""
+        with metered(self.bucket, 'urbiotica', self.cost):
+            auth = self.session.get(
+                f'{self.endpoint}/v2/auth/{self.organism}/{username}/{password}')
         if auth is None:
             raise ValueError('Invalid auth endpoint')
         logging.info("Authentication successful")
-        return cls(endpoint, organism, auth.text.strip('"'), bucket, session)
+        self.token = auth.text.strip('"')
 
     def projects(self) -> Dict[str, 'Project']:
         """projects associated to the logged-in user"""
-        url = f'{self.endpoint}/v2/organisms/{self.organism}/projects'
-        with limit_rate(self.bucket):
-            prj = self.session.get(url, headers={'IDENTITY_KEY': self.token})
-        if prj is None:
-            raise ValueError("Invalid projects endpoint")
-        logging.debug("Received project list: %s", prj.text)
+        items = self.cache.get('projects') if self.cache is not None else None
+        if items is None:
+            url = f'{self.endpoint}/v2/organisms/{self.organism}/projects'
+            with metered(self.bucket, 'urbiotica', self.cost):
+                prj = self.session.get(url, headers={'IDENTITY_KEY': self.token})
+            if prj is None:
+                raise ValueError("Invalid projects endpoint")
+            logging.debug("Received project list (%d bytes)", len(prj.content))
+            items = prj.json()
+            if self.cache is not None:
+                self.cache.put('projects', items)
         return {
             item['projectid']: Project.new(self, item)
-            for item in prj.json()
+            for item in items
         }
 
     # pylint: disable=too-many-arguments
@@ -304,13 +759,175 @@ class Api:
                       attrib: str) -> JsonDict:
         """query some sub-path for a particular project, use attrib as key in returned dict"""
         url = f'{self.endpoint}/v2/organisms/{self.organism}/projects/{projectid}/{path}'
-        with limit_rate(self.bucket):
+        with metered(self.bucket, 'urbiotica', self.cost):
             its = self.session.get(url, headers={'IDENTITY_KEY': self.token})
         if its is None:
             raise ValueError("Invalid query endpoint")
-        logging.debug("Received %s info for project %s: %s", path, projectid, its.text)
+        logging.debug("Received %s info for project %s (%d bytes)", path, projectid, len(its.content))
+        return {item[attrib]: item for item in its.json()}
+
+    async def query_project_async(self, projectid: str, path: str,
+                                  attrib: str) -> JsonDict:
+        """Same as query_project, with the async session"""
+        assert self.async_session is not None
+        url = f'{self.endpoint}/v2/organisms/{self.organism}/projects/{projectid}/{path}'
+        async with metered_async(self.bucket, 'urbiotica', self.cost):
+            its = await self.async_session.get(url, headers={'IDENTITY_KEY': self.token})
+        its.raise_for_status()
+        logging.debug("Received %s info for project %s (%d bytes)", path, projectid, len(its.content))
         return {item[attrib]: item for item in its.json()}
 
+    def query_topology(self, projectid: str, path: str,
+                       attrib: str) -> JsonDict:
+        """Same as query_project, but using the metadata cache if there is one"""
+        if self.cache is None:
+            return self.query_project(projectid, path, attrib)
+        key = f'projects/{projectid}/{path}'
+        items = self.cache.get(key)
+        if items is None:
+            result = self.query_project(projectid, path, attrib)
+            self.cache.put(key, list(result.values()))
+            return result
+        return {item[attrib]: item for item in items}
+
+
+def isoformat_bulk(timestamps: np.ndarray) -> np.ndarray:
+    """Format epoch seconds as UTC ISO strings, same as datetime.isoformat of an aware datetime"""
+    return np.char.add(np.datetime_as_string(timestamps.astype('datetime64[s]'), unit='s'), '+00:00')
+
+
+def isoparse_bulk(items: Sequence[str]) -> np.ndarray:
+    """Parse ISO strings to epoch seconds. Strings without offset are taken as UTC."""
+    if all(len(item) == 19 or item[19:] in ('Z', '+00:00', '.000Z') for item in items):
+        return np.array([item[:19] for item in items], dtype='datetime64[s]').astype(np.int64)
+    # Strings with fractions or other offsets need a slower, per-item parse
+    result = list()
+    for item in items:
+        parsed = parser.isoparse(item)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        result.append(math.floor(parsed.timestamp()))
+    return np.array(result, dtype=np.int64)
+
+
+@dataclass
+class VehicleBatch:
+    """vehicle_ctrl events of a spot, as columns sorted by lstamp"""
+    pomid: int
+    # Epoch seconds of each event
+    lstamp: np.ndarray
+    # Value of each event (-1, 0, 1)
+    value: np.ndarray
+
+    @classmethod
+    def decode(cls, pomid: int, measurements: JsonList) -> 'VehicleBatch':
+        """Decode the measurements returned by the API"""
+        lstamp = np.array([item['lstamp'] for item in measurements], dtype=np.int64) // 1000
+        value = np.array([item['value'] for item in measurements]).astype(np.int8)
+        order = np.argsort(lstamp, kind='stable')
+        return cls(pomid, lstamp[order], value[order])
+
+    @classmethod
+    def concat(cls, pomid: int, batches: Sequence['VehicleBatch']) -> 'VehicleBatch':
+        """Merge several batches of the same spot into one"""
+        if not batches:
+            return cls(pomid, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int8))
+        batch = cls(pomid,
+                    np.concatenate([batch.lstamp for batch in batches]),
+                    np.concatenate([batch.value for batch in batches]))
+        order = np.argsort(batch.lstamp, kind='stable')
+        return cls(pomid, batch.lstamp[order], batch.value[order])
+
+    def __len__(self) -> int:
+        return len(self.lstamp)
+
+    def select(self, mask: np.ndarray) -> 'VehicleBatch':
+        """Events selected by a boolean mask or index array"""
+        return VehicleBatch(self.pomid, self.lstamp[mask], self.value[mask])
+
+    def after(self, lstamp: Optional[int]) -> 'VehicleBatch':
+        """Events later than lstamp"""
+        if lstamp is None:
+            return self
+        return self.select(self.lstamp > lstamp)
+
+    def timeinstants(self) -> List[str]:
+        """ISO string of each lstamp"""
+        return isoformat_bulk(self.lstamp).tolist()
+
+
+@dataclass
+class RotationBatch:
+    """Finished rotations of a spot, as columns sorted by start"""
+    pomid: int
+    # Epoch seconds of the start and end of each rotation
+    start: np.ndarray
+    end: np.ndarray
+
+    @classmethod
+    def decode(cls, pomid: int, rotations: JsonList) -> 'RotationBatch':
+        """Decode the rotations returned by the API"""
+        start = isoparse_bulk([item['start'] for item in rotations])
+        end = isoparse_bulk([item['end'] for item in rotations])
+        order = np.argsort(start, kind='stable')
+        return cls(pomid, start[order], end[order])
+
+    @classmethod
+    def concat(cls, pomid: int, batches: Sequence['RotationBatch'], unique: bool = False) -> 'RotationBatch':
+        """Merge several batches into one.
+
+        If unique, repeated rotations are dropped. Only use it for batches of
+        the same spot (e.g. overlapping windows), since rotations of different
+        spots can start and end at the same time.
+        """
+        if not batches:
+            return cls(pomid, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        start = np.concatenate([batch.start for batch in batches])
+        end = np.concatenate([batch.end for batch in batches])
+        if unique:
+            pairs = np.unique(np.stack([start, end], axis=1), axis=0)
+            return cls(pomid, pairs[:, 0], pairs[:, 1])
+        order = np.argsort(start, kind='stable')
+        return cls(pomid, start[order], end[order])
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def aggregate(self, start: int, end: int, interval: int, spots: int = 1) -> JsonList:
+        """Occupancy aggregates for each interval between start and end (epoch seconds).
+
+        For each interval, returns its start, the occupancy rate (fraction
+        of the time the spots were occupied), the turnover (rotations
+        started), and the mean, median and 90th percentile dwell time of the
+        rotations finished in the interval, in seconds (None if there were none).
+        """
+        edges = np.arange(start, end + 1, interval, dtype=np.int64)
+        count = len(edges) - 1
+        if count <= 0:
+            return list()
+        lower, upper = edges[:-1], edges[1:]
+        overlap = np.minimum(self.end[:, None], upper[None, :]) - np.maximum(self.start[:, None], lower[None, :])
+        occupancy = np.clip(overlap, 0, None).sum(axis=0) / (interval * max(1, spots))
+        started = (self.start - start) // interval
+        started = started[(self.start >= start) & (self.start < end)]
+        turnover = np.bincount(started, minlength=count)
+        finished = (self.end - start) // interval
+        inside = (self.end >= start) & (self.end < end)
+        dwell = (self.end - self.start)[inside]
+        finished = finished[inside]
+        rows = list()
+        for index in range(count):
+            times = dwell[finished == index]
+            rows.append({
+                'start': int(lower[index]),
+                'occupancy': float(occupancy[index]),
+                'turnover': int(turnover[index]),
+                'dwell_mean': float(times.mean()) if len(times) else None,
+                'dwell_median': float(np.median(times)) if len(times) else None,
+                'dwell_p90': float(np.percentile(times, 90)) if len(times) else None,
+            })
+        return rows
+
 
 @dataclass
 class Project:
@@ -330,43 +947,35 @@ class Project:
 
     def parkings(self) -> JsonDict:
         """Enumerate project parkings"""
-        return self.api.query_project(self.projectid, 'parkings', 'pomid')
+        return self.api.query_topology(self.projectid, 'parkings', 'pomid')
 
     def zones(self) -> JsonDict:
         """Enumerate project zones"""
-        return self.api.query_project(self.projectid, 'zones', 'zoneid')
+        return self.api.query_topology(self.projectid, 'zones', 'zoneid')
 
     def spots(self) -> JsonDict:
         """Enumerate project spots"""
-        return self.api.query_project(self.projectid, 'spots', 'pomid')
+        return self.api.query_topology(self.projectid, 'spots', 'pomid')
 
     def devices(self, zoneid: str) -> JsonDict:
         """Enumerate zone devices"""
-        return self.api.query_project(self.projectid, f'zones/{zoneid}/devices', 'elementid')
+        return self.api.query_topology(self.projectid, f'zones/{zoneid}/devices', 'elementid')
 
-    def rotations(self, pomid: str, from_dt: datetime,
-                  to_dt: datetime) -> JsonList:
+    def rotations(self, pomid: int, from_dt: datetime,
+                  to_dt: datetime) -> RotationBatch:
         """Enumerate spot rotations"""
         fromiso = datetime.isoformat(from_dt.replace(microsecond=0))
         toiso = datetime.isoformat(to_dt.replace(microsecond=0))
         poms = self.api.query_project(
             self.projectid,
             f'spots/{pomid}/rotations/finished/{fromiso}/{toiso}', 'pomid')
-        rotations = list(
-            itertools.chain(*(({
-                'pomid': pom['pomid'],
-                'start': parser.isoparse(item['start']),
-                'end': parser.isoparse(item['end'])
-            } for item in pom['rotations']) for pom in poms.values())))
-        return Project._sortby(rotations, 'start')
-
-    def vehicles(self, pomid: str, from_dt: datetime,
-                 to_dt: datetime) -> JsonList:
-        """Enumerate spot vehicle_ctrl events"""
-        from_ts = math.floor(from_dt.timestamp())
-        to_ts = math.ceil(to_dt.timestamp())
-        if to_ts - from_ts > 7*24*60*60:
-            to_ts = from_ts + 7*24*60*60
+        return RotationBatch.decode(pomid, list(itertools.chain(*(pom['rotations'] for pom in poms.values()))))
+
+    # Longest range of vehicle_ctrl events the API returns in a single query
+    VEHICLES_WINDOW = 7*24*60*60
+
+    def vehicles_window(self, pomid: int, from_ts: int, to_ts: int) -> Optional[VehicleBatch]:
+        """Enumerate spot vehicle_ctrl events within a single API window, None on failure"""
         try:
             poms = self.api.query_project(
                 self.projectid,
@@ -374,6 +983,7 @@ class Project:
                 'pomid')
         except requests.exceptions.RequestException as err:
             logging.error("Failed to fetch vehicles data: %s", err)
+            metrics.count('urbiotica_retries')
             try:
                 poms = self.api.query_project(
                     self.projectid,
@@ -381,24 +991,119 @@ class Project:
                     'pomid')
             except requests.exceptions.RequestException as err:
                 logging.error("Retry failed, giving up on vehicles: %s", err)
-                return []
-        measurements = list(
-            itertools.chain(*(({
-                'pomid':
-                pom['pomid'],
-                'lstamp':
-                datetime.fromtimestamp(int(item['lstamp']) // 1000,
-                                       tz=timezone.utc),
-                'value':
-                item['value']
-            } for item in pom['measurements']) for pom in poms.values())))
-        return Project._sortby(measurements, 'lstamp')
+                return None
+        batch = VehicleBatch.decode(pomid, list(itertools.chain(*(pom['measurements'] for pom in poms.values()))))
+        metrics.count('urbiotica_events', len(batch))
+        return batch
+
+    async def vehicles_window_async(self, pomid: int, from_ts: int, to_ts: int) -> Optional[VehicleBatch]:
+        """Same as vehicles_window, with the async session"""
+        path = f'spots/{pomid}/phenomenons/vehicle_ctrl?start={from_ts}&end={to_ts}'
+        try:
+            poms = await self.api.query_project_async(self.projectid, path, 'pomid')
+        except requests.exceptions.RequestException as err:
+            logging.error("Failed to fetch vehicles data: %s", err)
+            metrics.count('urbiotica_retries')
+            try:
+                poms = await self.api.query_project_async(self.projectid, path, 'pomid')
+            except requests.exceptions.RequestException as err:
+                logging.error("Retry failed, giving up on vehicles: %s", err)
+                return None
+        batch = VehicleBatch.decode(pomid, list(itertools.chain(*(pom['measurements'] for pom in poms.values()))))
+        metrics.count('urbiotica_events', len(batch))
+        return batch
+
+    # pylint: disable=too-many-arguments
+    def vehicles(self, pomid: int, from_dt: datetime,
+                 to_dt: datetime, prefetch: int = 1, strict: bool = False) -> Generator[VehicleBatch, None, None]:
+        """Enumerate spot vehicle_ctrl events, in order, one VehicleBatch per window.
+
+        Ranges longer than VEHICLES_WINDOW are split in several queries,
+        up to prefetch of them in flight at the same time. If a window
+        cannot be fetched, the events after it are not returned either,
+        so that the range can be resumed from the last event. If strict
+        is True, NetworkException is raised then, instead of stopping.
+        """
+        from_ts = math.floor(from_dt.timestamp())
+        to_ts = math.ceil(to_dt.timestamp())
+        windows = [(start, min(start + Project.VEHICLES_WINDOW, to_ts))
+                   for start in range(from_ts, to_ts, Project.VEHICLES_WINDOW)]
+        if len(windows) > 1:
+            logging.info("pomid %s is %s behind, fetching %d windows",
+                         pomid, timedelta(seconds=to_ts - from_ts), len(windows))
+        if prefetch > 1 and len(windows) > 1:
+            batches = self.prefetched(pomid, windows, prefetch)
+        else:
+            # Nothing to overlap, fetch in this thread
+            batches = (self.vehicles_window(pomid, start, end) for start, end in windows)
+        last: Optional[int] = None
+        try:
+            for batch in batches:
+                if batch is None:
+                    if strict:
+                        raise NetworkException(msg=f'Failed to fetch vehicles data of pomid {pomid}',
+                                               url=self.api.endpoint, status_code=0, text='')
+                    break
+                # Consecutive windows share their boundary, skip repeated events
+                batch = batch.after(last)
+                if len(batch) > 0:
+                    last = int(batch.lstamp[-1])
+                    yield batch
+        finally:
+            batches.close()
+
+    def prefetched(self, pomid: int, windows: List[Tuple[int, int]],
+                   prefetch: int) -> Generator[Optional[VehicleBatch], None, None]:
+        """vehicles_window of each window, in order, up to prefetch of them in flight at the same time"""
+        queued = iter(windows)
+        pending: Deque[Future] = deque()
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            try:
+                while True:
+                    for start, end in itertools.islice(queued, prefetch - len(pending)):
+                        pending.append(executor.submit(self.vehicles_window, pomid, start, end))
+                    if not pending:
+                        break
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    # pylint: disable=too-many-arguments
+    async def vehicles_async(self, pomid: int, from_dt: datetime, to_dt: datetime,
+                             prefetch: int = 1, strict: bool = False) -> AsyncGenerator[VehicleBatch, None]:
+        """Same as vehicles, with the windows fetched as tasks of the event loop"""
+        from_ts = math.floor(from_dt.timestamp())
+        to_ts = math.ceil(to_dt.timestamp())
+        windows = [(start, min(start + Project.VEHICLES_WINDOW, to_ts))
+                   for start in range(from_ts, to_ts, Project.VEHICLES_WINDOW)]
+        if len(windows) > 1:
+            logging.info("pomid %s is %s behind, fetching %d windows",
+                         pomid, timedelta(seconds=to_ts - from_ts), len(windows))
+        queued = iter(windows)
+        pending: Deque[asyncio.Task] = deque()
+        last: Optional[int] = None
+        try:
+            while True:
+                for start, end in itertools.islice(queued, max(1, prefetch) - len(pending)):
+                    pending.append(asyncio.create_task(self.vehicles_window_async(pomid, start, end)))
+                if not pending:
+                    break
+                batch = await pending.popleft()
+                if batch is None:
+                    if strict:
+                        raise NetworkException(msg=f'Failed to fetch vehicles data of pomid {pomid}',
+                                               url=self.api.endpoint, status_code=0, text='')
+                    break
+                # Consecutive windows share their boundary, skip repeated events
+                batch = batch.after(last)
+                if len(batch) > 0:
+                    last = int(batch.lstamp[-1])
+                    yield batch
+        finally:
+            for task in pending:
+                task.cancel()
 
-    @staticmethod
-    def _sortby(items: JsonList, field: str) -> JsonList:
-        """Sort list by item attrib"""
-        items.sort(key=itemgetter(field))
-        return items
 
 
 @dataclass
@@ -421,33 +1126,81 @@ class SpotIterator:
     # Time range and events in that range
     from_ts: datetime
     to_ts: datetime
-    events: JsonList
+    events: Iterable[VehicleBatch]
 
     # pylint: disable=too-many-arguments,too-many-locals
     @classmethod
     def collect(cls, project: Project,
                 orion_cb: OrionStore, subservice: str, pom: JsonDict, device: JsonDict,
-                to_ts: datetime):
-        """Collect vehicle_ctrl events for the given pomid between most recent update, and to_ts"""
+                to_ts: datetime, checkpoints: Optional[Dict[str, datetime]] = None,
+                prefetch: int = 1, strict: bool = False):
+        """Collect vehicle_ctrl events for the given pomid between most recent update, and to_ts.
+
+        If checkpoints is provided (see OrionStore.load_checkpoints), the most
+        recent update is taken from it instead of querying orion for the entity.
+        The events are fetched lazily, while the entities are encoded,
+        up to prefetch API windows at a time (see Project.vehicles, also for strict).
+        """
+        pomid = pom['pomid']
+        logging.info("Collecting vehicle_ctrl events from pom %s (id %d)",
+                     pom['name'], pomid)
+        entityid = f'pomid:{pomid}'
+        from_ts = to_ts - timedelta(days=1)
+        if checkpoints is not None:
+            from_ts = checkpoints.get(entityid, from_ts)
+        else:
+            logging.info('Getting latest occupancyModified for entity %s',
+                         entityid)
+            entity = orion_cb.get_entity(subservice=subservice, entityid=entityid, entitytype="ParkingSpot")
+            if entity is not None and 'occupancyModified' in entity:
+                from_ts = parser.isoparse(entity['occupancyModified']['value'])
+        logging.info('Getting events for pomid %d between %s and %s', pomid,
+                     from_ts, to_ts)
+        events = project.vehicles(pomid, from_ts, to_ts, prefetch, strict)
+        return cls.new(pom, device, from_ts, to_ts, events)
+
+    # pylint: disable=too-many-arguments
+    @classmethod
+    async def collect_async(cls, project: Project,
+                            orion_cb: OrionStore, subservice: str, pom: JsonDict, device: JsonDict,
+                            to_ts: datetime, checkpoints: Optional[Dict[str, datetime]] = None,
+                            prefetch: int = 1, strict: bool = False):
+        """Same as collect, with the async sessions.
+
+        The events are fetched before returning, instead of lazily,
+        so that the entities can be encoded outside of the event loop.
+        """
         pomid = pom['pomid']
-        name = pom['name']
         logging.info("Collecting vehicle_ctrl events from pom %s (id %d)",
-                     name, pomid)
+                     pom['name'], pomid)
+        entityid = f'pomid:{pomid}'
+        from_ts = to_ts - timedelta(days=1)
+        if checkpoints is not None:
+            from_ts = checkpoints.get(entityid, from_ts)
+        else:
+            logging.info('Getting latest occupancyModified for entity %s',
+                         entityid)
+            entity = await orion_cb.get_entity_async(subservice=subservice, entityid=entityid, entitytype="ParkingSpot")
+            if entity is not None and 'occupancyModified' in entity:
+                from_ts = parser.isoparse(entity['occupancyModified']['value'])
+        logging.info('Getting events for pomid %d between %s and %s', pomid,
+                     from_ts, to_ts)
+        events = [batch async for batch in project.vehicles_async(pomid, from_ts, to_ts, prefetch, strict)]
+        return cls.new(pom, device, from_ts, to_ts, events)
+
+    # pylint: disable=too-many-arguments
+    @classmethod
+    def new(cls, pom: JsonDict, device: JsonDict, from_ts: datetime,
+            to_ts: datetime, events: Iterable[VehicleBatch]):
+        """SpotIterator for the given events of a POM"""
+        pomid = pom['pomid']
+        name = pom['name']
         deviceid = device['elementid']
         zoneid = device['zoneid']
         coords = [float(pom['latitude']), float(pom['longitude'])]
         entityid = f'pomid:{pomid}'
         deviceentityid = f'elementid:{deviceid}'
         zoneentityid = f'zoneid:{zoneid}'
-        logging.info('Getting latest occupancyModified for entity %s',
-                     entityid)
-        entity = orion_cb.get_entity(subservice=subservice, entityid=entityid, entitytype="ParkingSpot")
-        from_ts = to_ts - timedelta(days=1)
-        if entity is not None and 'occupancyModified' in entity:
-            from_ts = parser.isoparse(entity['occupancyModified']['value'])
-        logging.info('Getting events for pomid %d between %s and %s', pomid,
-                     from_ts, to_ts)
-        events = project.vehicles(pomid, from_ts, to_ts)
         return cls(pomid=pomid,
                    name=name,
                    deviceid=deviceid,
@@ -460,67 +1213,96 @@ class SpotIterator:
                    to_ts=to_ts,
                    events=events)
 
-    def __iter__(self) -> Generator[JsonDict, None, None]:
-        """Iterate on vehicle_ctrl events generating ParkingSpot entity updates"""
-        if self.events:
-            for event in self.events:
-                timeinstant = event['lstamp'].isoformat()
-                occupied = int(event['value'])
-                yield {
-                    'id': self.entityid,
-                    'type': 'ParkingSpot',
-                    'TimeInstant': {
-                        'type': 'DateTime',
-                        'value': timeinstant,
-                    },
-                    'occupancyModified': {
-                        'type': 'DateTime',
-                        'value': timeinstant,
-                    },
-                    'name': {
-                        'type': 'Text',
-                        'value': self.name
-                    },
-                    'status': {
-                        'type':
-                        'Text',
-                        'value':
-                        'free' if occupied == 0 else
-                        ('occupied' if occupied == 1 else 'unknown'),
-                    },
-                    'refOnStreetParking': {
-                        'type': 'Text',
-                        'value': self.zoneentityid
-                    },
-                    'refDevice': {
-                        'type': 'Text',
-                        'value': self.deviceentityid
-                    },
-                    'location': {
-                        'type': 'geo:json',
-                        'value': {
-                            'type': 'Point',
-                            # HACK: Urbo coordinate system is "swapped"
-                            'coordinates': [self.coords[1], self.coords[0]]
-                        }
-                    },
-                    'occupied': {
-                        'type': 'Number',
-                        'value': occupied if occupied >= 0 else None
-                    }
+    def static_attrs(self) -> JsonDict:
+        """Attributes of the ParkingSpot that do not depend on the event"""
+        return {
+            'name': {
+                'type': 'Text',
+                'value': self.name
+            },
+            'refOnStreetParking': {
+                'type': 'Text',
+                'value': self.zoneentityid
+            },
+            'refDevice': {
+                'type': 'Text',
+                'value': self.deviceentityid
+            },
+            'location': {
+                'type': 'geo:json',
+                'value': {
+                    'type': 'Point',
+                    # HACK: Urbo coordinate system is "swapped"
+                    'coordinates': [self.coords[1], self.coords[0]]
                 }
+            },
+        }
 
+    @staticmethod
+    def state_attrs(occupied: int) -> JsonDict:
+        """Attributes of the ParkingSpot that depend on the event value"""
+        return {
+            'status': {
+                'type':
+                'Text',
+                'value':
+                'free' if occupied == 0 else
+                ('occupied' if occupied == 1 else 'unknown'),
+            },
+            'occupied': {
+                'type': 'Number',
+                'value': occupied if occupied >= 0 else None
+            }
+        }
 
-def zone_to_entity(zone: JsonDict, zone_poms: JsonList, timeinstant: str):
-    """Turn Zone information into OnStreetParking entity"""
+    def encoded(self, written: Optional[SpotState] = None) -> Generator[EncodedEntity, None, None]:
+        """ParkingSpot entity updates of the vehicle_ctrl events, already serialized.
+
+        Each entity holds the TimeInstant and occupancyModified of the event,
+        the static attributes (see static_attrs) and the state attributes of
+        its value (see state_attrs). The attributes that do not change between
+        events are serialized once per spot, and each entity is built by
+        joining byte fragments.
+        If written is given (see SpotStateCache), the static attributes are
+        left out when they are the ones written, and else included only in
+        the first entity.
+        """
+        head = b'{"id":' + json.dumps(self.entityid).encode('utf-8') + b',"type":"ParkingSpot",'
+        static = json.dumps(self.static_attrs(), separators=(',', ':'))[1:-1].encode('utf-8')
+        static_hash = ''
+        if written is not None:
+            static_hash = hashlib.sha1(static).hexdigest()
+            if written.static == static_hash:
+                static, static_hash = b'', ''
+        states: Dict[int, bytes] = dict()
+        for batch in self.events:
+            for timeinstant, occupied in zip(batch.timeinstants(), batch.value.tolist()):
+                state = states.get(occupied, None)
+                if state is None:
+                    state = json.dumps(SpotIterator.state_attrs(occupied), separators=(',', ':'))[1:-1].encode('utf-8')
+                    states[occupied] = state
+                quoted = b'"' + timeinstant.encode('ascii') + b'"'
+                yield EncodedEntity(self.entityid, timeinstant, b''.join((
+                    head,
+                    b'"TimeInstant":{"type":"DateTime","value":', quoted,
+                    b'},"occupancyModified":{"type":"DateTime","value":', quoted,
+                    b'},', static, b',' if static else b'', state, b'}')), static_hash)
+                if written is not None:
+                    static, static_hash = b'', ''
+
+
+def zone_to_entity(zone: JsonDict, zone_poms: JsonList, timeinstant: str,
+                   area: Optional[List[List[float]]] = None):
+    """Turn Zone information into OnStreetParking entity.
+
+    The area of the zone is computed from its POMs, unless given.
+    """
     zoneid = zone['zoneid']
     name = zone['description']
     location = [(float(zone['lat_ne']) + float(zone['lat_sw'])) / 2,
                 (float(zone['long_ne']) + float(zone['long_sw'])) / 2]
-    points = [[float(pom['latitude']),
-               float(pom['longitude'])] for pom in zone_poms]
-    area = Polygon(points).buffer(
-        0.0001).minimum_rotated_rectangle.exterior.coords
+    if area is None:
+        area = zone_area(zone_poms)
     return {
         'id': f'zoneid:{zoneid}',
         'type': 'OnStreetParking',
@@ -555,6 +1337,526 @@ def zone_to_entity(zone: JsonDict, zone_poms: JsonList, timeinstant: str):
     }
 
 
+def aggregate_to_entity(entityid: str, entitytype: str, ref: JsonDict,
+                        row: JsonDict, interval: int) -> JsonDict:
+    """Turn an aggregate row (see RotationBatch.aggregate) into an entity.
+
+    ref holds the attributes that refer to the spot or zone aggregated.
+    """
+    return {
+        'id': entityid,
+        'type': entitytype,
+        'TimeInstant': {
+            'type': 'DateTime',
+            'value': datetime.fromtimestamp(row['start'], tz=timezone.utc).isoformat()
+        },
+        **ref,
+        'aggregationPeriod': {
+            'type': 'Number',
+            'value': interval
+        },
+        'occupancyRate': {
+            'type': 'Number',
+            'value': row['occupancy']
+        },
+        'turnover': {
+            'type': 'Number',
+            'value': row['turnover']
+        },
+        'dwellTimeMean': {
+            'type': 'Number',
+            'value': row['dwell_mean']
+        },
+        'dwellTimeMedian': {
+            'type': 'Number',
+            'value': row['dwell_median']
+        },
+        'dwellTimeP90': {
+            'type': 'Number',
+            'value': row['dwell_p90']
+        },
+    }
+
+
+@dataclass
+class RunStats:
+    """Totals of a collection run, shared by all the workers"""
+    spots: int = 0
+    failed: int = 0
+    entities: int = 0
+    batches: int = 0
+    unsent: int = 0
+    dropped: int = 0
+    spooled: int = 0
+    drained: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add(self, **counters: int):
+        """Accumulate counters, e.g. stats.add(spots=1, failed=1)"""
+        with self.lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def totals(self) -> Dict[str, int]:
+        """All the counters, by name"""
+        with self.lock:
+            return {name: value for name, value in vars(self).items() if isinstance(value, int)}
+
+
+def compact_events(batches: Iterable[VehicleBatch], stats: RunStats,
+                   keepalive: Optional[timedelta] = None) -> Generator[VehicleBatch, None, None]:
+    """Drop vehicle_ctrl events that repeat the value of the previous one.
+
+    If keepalive is given, a repeated event is still kept when that much
+    time has passed since the last kept one. The last event is always
+    kept, so that occupancyModified keeps track of the collected range.
+    """
+    last_value: Optional[int] = None
+    last_lstamp = 0
+    skipped: Optional[VehicleBatch] = None
+    dropped = 0
+    for batch in batches:
+        if len(batch) == 0:
+            continue
+        if skipped is not None:
+            # The previous skipped event was not the last one
+            dropped += 1
+            skipped = None
+        if keepalive is None:
+            previous = np.empty(len(batch), dtype=batch.value.dtype)
+            previous[1:] = batch.value[:-1]
+            keep = batch.value != previous
+            keep[0] = last_value is None or int(batch.value[0]) != last_value
+        else:
+            # Keep-alive depends on the last event kept, it can't be vectorized
+            period = keepalive.total_seconds()
+            keep = np.zeros(len(batch), dtype=bool)
+            for index, (lstamp, value) in enumerate(zip(batch.lstamp.tolist(), batch.value.tolist())):
+                if last_value is None or value != last_value or lstamp - last_lstamp >= period:
+                    keep[index] = True
+                    last_value, last_lstamp = value, lstamp
+        last_value = int(batch.value[-1])
+        if not keep[-1]:
+            # Hold back the last event, in case it is the last one of the range
+            skipped = batch.select(slice(len(batch) - 1, None))
+        dropped += int(len(batch) - np.count_nonzero(keep) - (1 if skipped is not None else 0))
+        kept = batch.select(keep)
+        if len(kept) > 0:
+            last_lstamp = int(kept.lstamp[-1])
+            yield kept
+    if skipped is not None:
+        yield skipped
+    stats.add(dropped=dropped)
+
+
+def skip_written(batches: Iterable[VehicleBatch], modified: int) -> Generator[VehicleBatch, None, None]:
+    """Drop vehicle_ctrl events at or before modified (epoch seconds), already written to the store"""
+    for batch in batches:
+        kept = batch.after(modified)
+        if len(kept) < len(batch):
+            metrics.count('written_events', len(batch) - len(kept))
+        if len(kept) > 0:
+            yield kept
+
+
+def unwritten(spot: 'SpotIterator', spot_states: Optional[SpotStateCache]) -> Optional[SpotState]:
+    """Skip the events of the spot already written, returning its state for SpotIterator.encoded.
+
+    Returns None if spot_states is None, and an empty state if the spot
+    was never written, so that only its first entity has static attributes.
+    """
+    if spot_states is None:
+        return None
+    written = spot_states.get(spot.entityid)
+    if written is None:
+        return SpotState(0, '')
+    spot.events = skip_written(spot.events, written.modified)
+    return written
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class Batcher:
+    """Accumulates entities from any number of POMs and sends them in batches.
+
+    A batch is sent when it reaches the current batch size or max_bytes
+    of payload, or when its oldest entity has waited for max_delay seconds
+    (checked by a timer, so that no more entities need to be added).
+    The batch size adapts to the store: it grows while batches are sent
+    within target_latency, and halves when they are slower, or fail with
+    413 (the batch is then split and resent), and on every 429 or 5xx
+    response, even if the batch succeeds when retried (see throttle).
+
+    Batches are sent one at a time, in order, without holding the lock,
+    so entities keep being queued while a batch is being sent. Once a batch fails, later
+    events of the same entities are discarded, so that neither orion nor
+    the checkpoint_store move past the lost events. If there is a spool,
+    failed batches and the later events of their entities are saved to
+    it instead, until they are sent by drain.
+
+    The state of each entity sent is recorded in spot_states, if given
+    (see SpotStateCache).
+    """
+    store: Store
+    subservice: str
+    stats: RunStats
+    checkpoint_store: Optional[Checkpoints] = None
+    spot_states: Optional[SpotStateCache] = None
+    max_entities: int = 100
+    max_bytes: int = 800000
+    max_delay: float = 5.0
+    target_latency: float = 2.0
+
+    batch_size: int = 0
+    pending: List[EncodedEntity] = field(default_factory=list)
+    pending_bytes: int = 0
+    pending_since: float = 0
+    # Entities with failed batches, and the earliest event lost for each
+    failed_ids: Dict[str, str] = field(default_factory=dict)
+    spool: Optional[Spool] = None
+    # Entities in the spool, and the latest event spooled for each
+    spooled: Dict[str, str] = field(default_factory=dict)
+    # Sends poll once the pending batch is due
+    timer: Optional[threading.Timer] = None
+    # Guards the pending batch and the state of the entities
+    lock: threading.RLock = field(default_factory=threading.RLock, repr=False, compare=False)
+    # Held while sending, so that batches are sent in order
+    send_lock: threading.RLock = field(default_factory=threading.RLock, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.batch_size <= 0:
+            self.batch_size = self.max_entities
+        if self.spool is not None:
+            # Events of entities already spooled must follow them
+            self.spooled = self.spool.load(self.subservice)
+            self.failed_ids.update(self.spooled)
+
+    def add(self, entity: EncodedEntity):
+        """Queue an encoded entity (see EncodedEntity), sending the batch if it is full"""
+        size = len(entity.data) + 1
+        while True:
+            with self.lock:
+                if entity.id in self.failed_ids:
+                    if self.spool is None:
+                        self.stats.add(unsent=1)
+                        return
+                    if entity.modified <= self.spooled.get(entity.id, ''):
+                        # Already in the spool
+                        return
+                if not self._full(size):
+                    if not self.pending:
+                        self.pending_since = time.monotonic()
+                        self._schedule()
+                    self.pending.append(entity)
+                    self.pending_bytes += size
+                    break
+            # Send the full batch without the lock, then check again
+            self.flush(only_if_full=True, size=size)
+        self.poll()
+
+    def poll(self):
+        """Send the pending batch if it has waited long enough"""
+        with self.lock:
+            due = self.pending and time.monotonic() - self.pending_since >= self.max_delay
+        if due:
+            self.flush()
+
+    def flush(self, only_if_full: bool = False, size: int = 0):
+        """Send all pending entities.
+
+        If only_if_full, send them only if an entity of size bytes does not
+        fit in the batch, as another thread may have sent it meanwhile.
+        """
+        with self.send_lock:
+            with self.lock:
+                if only_if_full and not self._full(size):
+                    return
+                entities, self.pending, self.pending_bytes = self.pending, list(), 0
+            if entities:
+                self._send(entities)
+
+    def throttle(self):
+        """Halve the batch size, orion is overloaded (see OrionStore.on_throttle)"""
+        with self.lock:
+            self.batch_size = max(1, self.batch_size // 2)
+            logging.debug("Orion is overloaded, next batch size %d", self.batch_size)
+
+    def close(self):
+        """Send the remaining entities, try to drain the spool, and save the states sent"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        self.flush()
+        if self.spooled:
+            self.drain()
+        if self.spot_states is not None:
+            self.spot_states.snapshot()
+
+    def drain(self) -> bool:
+        """Send the spooled batches, oldest first. Returns True if the spool is empty."""
+        assert self.spool is not None
+        with self.send_lock:
+            # Pending events of spooled entities go to the spool first
+            self.flush()
+            for path in self.spool.batches(self.subservice):
+                entities = list(replay(path))
+                try:
+                    self.store.send_batch(self.subservice, entities)
+                # pylint: disable=broad-except
+                except Exception as err:
+                    logging.warning("Failed to send spooled batch %s, will retry later: %s", path, err)
+                    return False
+                logging.info("Sent spooled batch of %d entities from %s", len(entities), path)
+                self.stats.add(entities=len(entities), batches=1, drained=len(entities))
+                self._checkpoint(entities, set())
+                os.remove(path)
+            with self.lock:
+                for entityid in self.spooled:
+                    self.failed_ids.pop(entityid, None)
+                self.spooled = dict()
+            return True
+
+    def recover(self, entityid: str) -> Optional[str]:
+        """Accept events of a failed entity again.
+
+        Returns the modification time of the earliest event lost,
+        or None if no batch of the entity has failed.
+        """
+        with self.send_lock:
+            with self.lock:
+                # Spooled events are not lost, they are sent by drain
+                if entityid not in self.failed_ids or self.spool is not None:
+                    return None
+            # Pending events after the lost ones must not be sent
+            self.flush()
+            with self.lock:
+                return self.failed_ids.pop(entityid)
+
+    def _full(self, size: int) -> bool:
+        """Whether an entity of size bytes does not fit in the pending batch. Call with the lock held."""
+        if not self.pending:
+            return False
+        return len(self.pending) >= self.batch_size or self.pending_bytes + size > self.max_bytes
+
+    def _schedule(self):
+        """Start a timer that polls once the pending batch is due. Call with the lock held."""
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.max_delay <= 0:
+            # add sends right away
+            return
+        self.timer = threading.Timer(self.max_delay, self.poll)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _send(self, entities: List[EncodedEntity]):
+        """Send a batch, adapting the batch size to the outcome. Call with the send_lock held."""
+        with self.lock:
+            skipped = [entity for entity in entities if entity.id in self.failed_ids]
+            entities = [entity for entity in entities if entity.id not in self.failed_ids]
+        if skipped:
+            if self.spool is not None:
+                self._spool(skipped)
+            else:
+                self.stats.add(unsent=len(skipped))
+            if not entities:
+                return
+        started = time.monotonic()
+        try:
+            self.store.send_batch(self.subservice, entities)
+        # pylint: disable=broad-except
+        except Exception as err:
+            with self.lock:
+                self.batch_size = max(1, self.batch_size // 2)
+            if getattr(err, 'status_code', None) == 413 and len(entities) > 1:
+                logging.warning("Batch of %d entities too large, splitting", len(entities))
+                half = len(entities) // 2
+                self._send(entities[:half])
+                self._send(entities[half:])
+                return
+            logging.error("Failed to send batch of %d entities: %s", len(entities), err)
+            with self.lock:
+                for entity in entities:
+                    self.failed_ids.setdefault(entity.id, entity.modified)
+            if self.spool is not None:
+                self._spool(entities)
+            else:
+                self.stats.add(unsent=len(entities))
+            return
+        latency = time.monotonic() - started
+        with self.lock:
+            if latency > self.target_latency:
+                self.batch_size = max(1, self.batch_size // 2)
+            else:
+                self.batch_size = min(self.max_entities, self.batch_size + max(1, self.max_entities // 10))
+            failed = set(self.failed_ids)
+        logging.debug("Batch of %d entities sent in %.2f seconds, next batch size %d",
+                      len(entities), latency, self.batch_size)
+        self.stats.add(entities=len(entities), batches=1)
+        self._checkpoint(entities, failed)
+
+    def _checkpoint(self, entities: Sequence[EncodedEntity], skip: Iterable[str]):
+        """Save the latest event sent of each POM to the checkpoint store and spot states, except for skipped entities"""
+        if self.checkpoint_store is None and self.spot_states is None:
+            return
+        skipped = set(skip)
+        latest: Dict[str, str] = dict()
+        static: Dict[str, str] = dict()
+        for entity in entities:
+            if entity.id.startswith('pomid:') and entity.id not in skipped:
+                latest[entity.id] = entity.modified
+                if entity.static:
+                    static[entity.id] = entity.static
+        for entityid, lstamp in latest.items():
+            modified = parser.isoparse(lstamp)
+            if self.checkpoint_store is not None:
+                self.checkpoint_store.save(int(entityid[len('pomid:'):]), modified)
+            if self.spot_states is not None:
+                self.spot_states.update(entityid, math.floor(modified.timestamp()), static.get(entityid, ''))
+
+    def _spool(self, entities: List[EncodedEntity]):
+        """Save entities that can not be sent yet to the spool"""
+        assert self.spool is not None
+        try:
+            self.spool.put(self.subservice, entities)
+        except OSError as err:
+            logging.error("Failed to spool %d entities: %s", len(entities), err)
+            self.stats.add(unsent=len(entities))
+            return
+        with self.lock:
+            for entity in entities:
+                self.spooled[entity.id] = max(entity.modified, self.spooled.get(entity.id, ''))
+        self.stats.add(spooled=len(entities))
+
+
+class Collected(NamedTuple):
+    """Outcome of the collection of a POM"""
+    # Range collected
+    start: datetime
+    end: datetime
+    # Time the next collection should start from
+    latest: datetime
+    # Number of entities queued
+    entities: int
+
+
+def collect_pom(params: JsonDict, batcher: Batcher, stats: RunStats,
+                compact: bool = False, keepalive: Optional[timedelta] = None) -> Optional[Collected]:
+    """Collect the events of a single POM and queue them in the batcher.
+
+    Any error is logged and counted, so that one failing spot does not
+    abort the collection of the rest. If compact is True, only the events
+    that change the state of the spot are sent (see compact_events).
+
+    Returns the range collected and the number of entities queued,
+    or None if the collection failed. The next collection should start
+    from the last event queued, or the start of the range if there were none.
+    """
+    pomid = params['pom']['pomid']
+    try:
+        spot = SpotIterator.collect(**params)
+        collected = queue_spot(spot, batcher, stats, compact, keepalive)
+        stats.add(spots=1)
+        return collected
+    # pylint: disable=broad-except
+    except Exception as err:
+        logging.exception("Failed to collect pomid %s: %s", pomid, err)
+        stats.add(spots=1, failed=1)
+        return None
+
+
+def queue_spot(spot: SpotIterator, batcher: Batcher, stats: RunStats,
+               compact: bool = False, keepalive: Optional[timedelta] = None) -> Collected:
+    """Queue the events of a spot in the batcher (see collect_pom)"""
+    written = unwritten(spot, batcher.spot_states)
+    if compact:
+        spot.events = compact_events(spot.events, stats, keepalive)
+    last: Optional[str] = None
+    entities = 0
+    for entity in spot.encoded(written):
+        batcher.add(entity)
+        last = entity.modified
+        entities += 1
+    latest = spot.from_ts if last is None else parser.isoparse(last)
+    if written is not None and written.modified > latest.timestamp():
+        # The events skipped were written already
+        latest = datetime.fromtimestamp(written.modified, tz=timezone.utc)
+    return Collected(spot.from_ts, spot.to_ts, latest, entities)
+
+
+# pylint: disable=too-many-arguments
+async def collect_pom_async(params: JsonDict, batcher: Batcher, stats: RunStats, feeder: ThreadPoolExecutor,
+                            compact: bool = False, keepalive: Optional[timedelta] = None) -> Optional[Collected]:
+    """Same as collect_pom, fetching the events with the async sessions.
+
+    The events are queued in the batcher from the feeder thread, so that
+    the event loop goes on while the batcher sends a batch.
+    """
+    pomid = params['pom']['pomid']
+    try:
+        spot = await SpotIterator.collect_async(**params)
+        collected = await asyncio.get_running_loop().run_in_executor(
+            feeder, queue_spot, spot, batcher, stats, compact, keepalive)
+        stats.add(spots=1)
+        return collected
+    # pylint: disable=broad-except
+    except Exception as err:
+        logging.exception("Failed to collect pomid %s: %s", pomid, err)
+        stats.add(spots=1, failed=1)
+        return None
+
+
+@dataclass
+class LoopStore:
+    """Store that sends batches with OrionStore.send_batch_async, in an event loop running in another thread"""
+    orion_cb: OrionStore
+    loop: asyncio.AbstractEventLoop
+
+    def open(self):
+        """The OrionStore is already open"""
+
+    def send_batch(self, subservice: str, entities: Sequence[Any]):
+        """Send the batch in the event loop, and wait for it"""
+        asyncio.run_coroutine_threadsafe(self.orion_cb.send_batch_async(subservice, entities), self.loop).result()
+
+    def close(self):
+        """The OrionStore is closed by its owner"""
+
+
+def discover(api: Api, workers: int) -> List[Tuple[Project, JsonDict, JsonDict, JsonDict]]:
+    """Enumerate zones, devices and spots of every project.
+
+    Queries that are not in the metadata cache are made concurrently,
+    sharing the api rate limit bucket. The responses fetched are saved to
+    the cache at the end, even if some query failed.
+    """
+    try:
+        return discover_projects(api, workers)
+    finally:
+        if api.cache is not None:
+            api.cache.save()
+
+
+def discover_projects(api: Api, workers: int) -> List[Tuple[Project, JsonDict, JsonDict, JsonDict]]:
+    """See discover"""
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        projects = list(api.projects().values())
+        zones = [executor.submit(project.zones) for project in projects]
+        spots = [executor.submit(project.spots) for project in projects]
+        devices = [
+            [executor.submit(project.devices, zoneid) for zoneid in project_zones.result().keys()]
+            for project, project_zones in zip(projects, zones)
+        ]
+        result = list()
+        for project, project_zones, project_spots, project_devices in zip(projects, zones, spots, devices):
+            merged: JsonDict = dict()
+            for zone_devices in project_devices:
+                merged.update(zone_devices.result())
+            result.append((project, project_zones.result(), merged, project_spots.result()))
+        return result
+
+
 # pylint: disable=too-many-locals
 def main():
     """Main ETL function"""
@@ -619,8 +1921,124 @@ def main():
                default=1,
                type=int,
                choices=range(1, 100),
-               help='Orion sleep between batches',
+               help='Orion base delay between retries, doubled on each retry',
                env_var="ORION_SLEEP")
+    argparser.add('--orion-token-cache',
+               required=False,
+               default=None,
+               help='File to keep orion tokens between runs',
+               env_var="ORION_TOKEN_CACHE")
+    argparser.add('--orion-rate',
+               required=False,
+               default=10.0,
+               type=float,
+               help='Maximum requests per second to orion (at least 1)',
+               env_var="ORION_RATE")
+    argparser.add('--orion-gzip',
+               required=False,
+               help='Compress batch updates to orion with gzip',
+               dest='orion_gzip',
+               action='store_true',
+               default=False,
+               env_var="ORION_GZIP")
+    argparser.add('--http-pool-size',
+               required=False,
+               default=0,
+               type=int,
+               help='Connections kept open to each API (default depends on --workers and --prefetch)',
+               env_var="HTTP_POOL_SIZE")
+    argparser.add('--http-retries',
+               required=False,
+               default=2,
+               type=int,
+               help='Retries of requests that fail to connect',
+               env_var="HTTP_RETRIES")
+    argparser.add('--connect-timeout',
+               required=False,
+               default=10.0,
+               type=float,
+               help='Seconds to wait for a connection to either API',
+               env_var="CONNECT_TIMEOUT")
+    argparser.add('--read-timeout',
+               required=False,
+               default=60.0,
+               type=float,
+               help='Seconds to wait for a response from either API',
+               env_var="READ_TIMEOUT")
+    argparser.add('--store',
+               required=False,
+               default='orion',
+               choices=('orion', 'postgres', 'file'),
+               help='Where entities are sent: orion, a postgres table (--store-dsn) or a NDJSON file (--store-path)',
+               env_var="STORE")
+    argparser.add('--store-dsn',
+               required=False,
+               default=None,
+               help='With --store postgres, connection string of the database',
+               env_var="STORE_DSN")
+    argparser.add('--store-table',
+               required=False,
+               default='urbiotica_entities',
+               help='With --store postgres, table the entities are loaded to',
+               env_var="STORE_TABLE")
+    argparser.add('--store-path',
+               required=False,
+               default=None,
+               help='With --store file, NDJSON file the entities are appended to (compressed if it ends in .gz)',
+               env_var="STORE_PATH")
+    argparser.add('--replay',
+               required=False,
+               default=None,
+               help='Send the entities in this file (saved by --store file) to orion, instead of collecting',
+               env_var="REPLAY")
+    argparser.add('--backfill',
+                required=False,
+                help='Collect again the events between --from and --to, instead of the latest ones',
+                dest='backfill',
+                action='store_true',
+                default=False,
+                env_var="BACKFILL")
+    argparser.add('--from',
+                required=False,
+                default=None,
+                type=parser.isoparse,
+                help='With --backfill, start of the range to collect (ISO 8601, UTC if no offset is given)',
+                dest='backfill_from',
+                env_var="BACKFILL_FROM")
+    argparser.add('--to',
+                required=False,
+                default=None,
+                type=parser.isoparse,
+                help='With --backfill, end of the range to collect (ISO 8601, UTC if no offset is given)',
+                dest='backfill_to',
+                env_var="BACKFILL_TO")
+    argparser.add('--pomids',
+                required=False,
+                default=None,
+                help='With --backfill, comma-separated pomids to collect',
+                env_var="POMIDS")
+    argparser.add('--zoneids',
+                required=False,
+                default=None,
+                help='With --backfill, comma-separated zoneids whose POMs are collected',
+                env_var="ZONEIDS")
+    argparser.add('--backfill-share',
+                required=False,
+                default=0.5,
+                type=float,
+                help='With --backfill, share of the urbiotica rate limit used, between 0 and 1. With --reserve-backfill, share left to a backfill',
+                env_var="BACKFILL_SHARE")
+    argparser.add('--reserve-backfill',
+                required=False,
+                action='store_true',
+                default=False,
+                help='Leave --backfill-share of the urbiotica rate limit to a backfill running alongside',
+                env_var="RESERVE_BACKFILL")
+    argparser.add('--spool-dir',
+               required=False,
+               default=None,
+               help='Directory to keep batches that could not be sent, until a later run sends them',
+               env_var="SPOOL_DIR")
     argparser.add('--load-zones',
                 required=False,
                 help='load zones (OnStreetParkings) besides POMs (ParkingSpots)',
@@ -628,12 +2046,288 @@ def main():
                 action='store_true',
                 default=False,
                 env_var="LOAD_ZONES")
+    argparser.add('--aggregate-interval',
+                required=False,
+                default=0,
+                type=int,
+                help='Send occupancy aggregates of each spot and zone every this many seconds, computed from rotations (0 to disable)',
+                env_var="AGGREGATE_INTERVAL")
+    argparser.add('--aggregate-delay',
+                required=False,
+                default=3600,
+                type=int,
+                help='Seconds to wait after an interval ends before aggregating it, so that its rotations have finished',
+                env_var="AGGREGATE_DELAY")
+    argparser.add('--shard-count',
+                required=False,
+                default=1,
+                type=int,
+                help='Number of processes the POMs are split between',
+                env_var="SHARD_COUNT")
+    argparser.add('--shard-index',
+                required=False,
+                default=0,
+                type=int,
+                help='POMs collected by this process, from 0 to --shard-count - 1',
+                env_var="SHARD_INDEX")
+    argparser.add('--workers',
+                required=False,
+                default=1,
+                type=int,
+                help='Number of POMs collected concurrently',
+                env_var="WORKERS")
+    argparser.add('--asyncio',
+                required=False,
+                help='Collect the POMs in an asyncio event loop, instead of threads (requires aiohttp)',
+                dest='asyncio',
+                action='store_true',
+                default=False,
+                env_var="ASYNCIO")
+    argparser.add('--batch-size',
+                required=False,
+                default=100,
+                type=int,
+                help='Maximum number of entities per batch update',
+                env_var="BATCH_SIZE")
+    argparser.add('--batch-bytes',
+                required=False,
+                default=800000,
+                type=int,
+                help='Maximum payload size of a batch update, in bytes',
+                env_var="BATCH_BYTES")
+    argparser.add('--batch-delay',
+                required=False,
+                default=5.0,
+                type=float,
+                help='Maximum time an entity waits for its batch to be sent, in seconds',
+                env_var="BATCH_DELAY")
+    argparser.add('--batch-latency',
+                required=False,
+                default=2.0,
+                type=float,
+                help='Batch updates slower than this (in seconds) reduce the batch size',
+                env_var="BATCH_LATENCY")
+    argparser.add('--prefetch',
+                required=False,
+                default=2,
+                type=int,
+                help='Number of 7-day windows of vehicle_ctrl events fetched ahead for each POM',
+                env_var="PREFETCH")
+    argparser.add('--compact-events',
+                required=False,
+                help='Only send vehicle_ctrl events that change the state of the spot',
+                dest='compact_events',
+                action='store_true',
+                default=False,
+                env_var="COMPACT_EVENTS")
+    argparser.add('--keepalive',
+                required=False,
+                default=0,
+                type=int,
+                help='With --compact-events, send a repeated event if the spot has not been updated for this many seconds',
+                env_var="KEEPALIVE")
+    argparser.add('--skip-unchanged',
+                required=False,
+                help='Skip the events already written, and send the static attributes of each spot only when they change',
+                dest='skip_unchanged',
+                action='store_true',
+                default=False,
+                env_var="SKIP_UNCHANGED")
+    argparser.add('--spot-state-cache',
+                required=False,
+                default=10000,
+                type=int,
+                help='With --skip-unchanged, number of spot states kept in memory',
+                env_var="SPOT_STATE_CACHE")
+    argparser.add('--metadata-cache',
+                required=False,
+                default=None,
+                help='Path to a local file to cache projects, zones, devices and spots',
+                env_var="METADATA_CACHE")
+    argparser.add('--metadata-ttl',
+                required=False,
+                default=86400,
+                type=int,
+                help='Seconds before cached projects, zones, devices and spots are fetched again',
+                env_var="METADATA_TTL")
+    argparser.add('--refresh-metadata',
+                required=False,
+                help='Ignore the cached projects, zones, devices and spots',
+                dest='refresh_metadata',
+                action='store_true',
+                default=False,
+                env_var="REFRESH_METADATA")
+    argparser.add('--refresh-state',
+                required=False,
+                help='Ignore the zones and static spot attributes already written, and send them again',
+                dest='refresh_state',
+                action='store_true',
+                default=False,
+                env_var="REFRESH_STATE")
+    argparser.add('--checkpoint-db',
+                required=False,
+                default=None,
+                help='Path to a local sqlite database to keep the latest update of each POM',
+                env_var="CHECKPOINT_DB")
+    argparser.add('--metrics-file',
+                required=False,
+                default=None,
+                help='Write a summary of the run to this file: prometheus textfile if it ends in .prom, JSON otherwise',
+                env_var="METRICS_FILE")
+    argparser.add('--daemon',
+                required=False,
+                help='Keep running, polling each POM every --poll-interval seconds',
+                dest='daemon',
+                action='store_true',
+                default=False,
+                env_var="DAEMON")
+    argparser.add('--poll-interval',
+                required=False,
+                default=60.0,
+                type=float,
+                help='Minimum seconds between polls of the same POM, with --daemon or --max-staleness',
+                env_var="POLL_INTERVAL")
+    argparser.add('--max-staleness',
+                required=False,
+                default=0.0,
+                type=float,
+                help='Poll idle POMs less often than busy ones, but at least every this many seconds',
+                env_var="MAX_STALENESS")
+    argparser.add('--discovery-interval',
+                required=False,
+                default=3600.0,
+                type=float,
+                help='With --daemon, seconds between discoveries of projects, zones and spots',
+                env_var="DISCOVERY_INTERVAL")
+    argparser.add('--listen',
+                required=False,
+                default=None,
+                help='With --daemon, HOST:PORT to listen for pushed vehicle_ctrl events',
+                env_var="LISTEN")
+    argparser.add('--listen-token',
+                required=False,
+                default=None,
+                help='Bearer token required to push events to --listen',
+                env_var="LISTEN_TOKEN")
+    argparser.add('--profile',
+                required=False,
+                default=None,
+                help='Save a cProfile of the run, including every thread, to this file',
+                env_var="PROFILE")
     options = argparser.parse_args()
+    if options.orion_rate < 1:
+        argparser.error('--orion-rate must be at least 1')
+    if options.shard_count < 1 or not 0 <= options.shard_index < options.shard_count:
+        argparser.error('--shard-index must be between 0 and --shard-count - 1')
+    if options.store == 'postgres' and not options.store_dsn:
+        argparser.error('--store postgres requires --store-dsn')
+    if options.store == 'file' and not options.store_path:
+        argparser.error('--store file requires --store-path')
+    if options.listen and not options.daemon:
+        argparser.error('--listen requires --daemon')
+    if options.asyncio and (options.daemon or options.replay):
+        argparser.error('--asyncio can not be used with --daemon or --replay')
+    if options.backfill:
+        if options.daemon or options.replay:
+            argparser.error('--backfill can not be used with --daemon or --replay')
+        if options.backfill_from is None or options.backfill_to is None:
+            argparser.error('--backfill requires --from and --to')
+        if not options.checkpoint_db:
+            argparser.error('--backfill requires --checkpoint-db, to save its progress')
+        if options.backfill_from.tzinfo is None:
+            options.backfill_from = options.backfill_from.replace(tzinfo=timezone.utc)
+        if options.backfill_to.tzinfo is None:
+            options.backfill_to = options.backfill_to.replace(tzinfo=timezone.utc)
+        if options.backfill_from >= options.backfill_to:
+            argparser.error('--from must be earlier than --to')
+        if not 0 < options.backfill_share <= 1:
+            argparser.error('--backfill-share must be greater than 0, and at most 1')
+    if options.reserve_backfill:
+        if options.backfill:
+            argparser.error('--reserve-backfill can not be used with --backfill')
+        if not 0 < options.backfill_share < 1:
+            argparser.error('--backfill-share must be between 0 and 1 with --reserve-backfill')
+    if api_cost(options) > API_RATE_LIMIT:
+        # Requests would never fit in the rate limit bucket
+        argparser.error(f'--shard-count and --backfill-share leave this process less than 1 of the {API_RATE_LIMIT} urbiotica requests per minute')
+    if options.max_staleness > 0 and not options.daemon and not options.checkpoint_db:
+        argparser.error('--max-staleness requires --checkpoint-db, unless --daemon')
+    if options.aggregate_interval > 0 and not options.checkpoint_db:
+        argparser.error('--aggregate-interval requires --checkpoint-db')
+
+    metrics.reset()
+    stats = RunStats()
+    profiler = Profiler(options.profile) if options.profile else None
+    if profiler is not None:
+        profiler.start()
+    try:
+        if options.replay:
+            run_replay(options, stats)
+        elif options.backfill:
+            run_backfill(options, stats)
+        elif options.daemon:
+            daemon(options, stats)
+        else:
+            run(options, stats)
+    finally:
+        if profiler is not None:
+            profiler.save()
+        if options.metrics_file:
+            metrics.write(options.metrics_file, **stats.totals())
+
 
+@dataclass
+class Profiler:
+    """cProfile of every thread of the run, saved to a single file.
+
+    Before python 3.12, a cProfile.Profile only sees the thread that
+    enabled it, so every thread started afterwards (workers, batcher
+    timers, executors of the event loop) gets its own, and they are
+    merged when saved.
+    """
+    path: str
+    profiles: List[cProfile.Profile] = field(default_factory=list)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def start(self):
+        """Profile this thread, and the threads started from now on"""
+        self._enable()
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._thread)
+
+    def save(self):
+        """Stop profiling and save the merged profile"""
+        threading.setprofile(None)
+        with self.lock:
+            profiles, self.profiles = self.profiles, list()
+        profiles[0].disable()
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(self.path)
+
+    def _thread(self, _frame, _event, _arg):
+        """Called on the first event of each new thread, replaces itself with a cProfile"""
+        self._enable()
+
+    def _enable(self):
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+
+def pool_size(options: configargparse.Namespace) -> int:
+    """Connections to keep open to each API"""
+    if options.http_pool_size > 0:
+        return options.http_pool_size
+    # Every worker may have a request in flight to each API, plus the prefetched windows
+    return max(10, options.workers * max(1, options.prefetch) + 1)
+
+
+def new_orion_store(options: configargparse.Namespace) -> OrionStore:
+    """Open the orion store"""
     logging.info("Authenticating to url %s, service %s, username %s",
                  options.keystone_url, options.orion_service,
                  options.orion_username)
-
     orion_cb = OrionStore(
         endpoint_keystone=options.keystone_url,
         endpoint_cb=options.orion_url,
@@ -642,30 +2336,90 @@ def main():
         password=options.orion_password,
         seconds_sleep=options.orion_sleep,
         retries=options.orion_retries,
-        session=requests.Session(),
-        token=dict())
+        session=new_session(pool_size(options), options.http_retries, options.connect_timeout, options.read_timeout),
+        token=dict(),
+        token_cache=options.orion_token_cache,
+        bucket=get_limiter(rate=options.orion_rate, capacity=max(1, math.ceil(options.orion_rate))),
+        compress=options.orion_gzip)
     orion_cb.open()
-    api = Api.login(requests.Session(), options.api_url, options.api_organism,
-                    options.api_username, options.api_password)
+    return orion_cb
+
+
+def new_store(options: configargparse.Namespace, orion_cb: OrionStore) -> Store:
+    """Open the store selected by --store"""
+    if options.store == 'postgres':
+        store: Store = PostgresStore(options.store_dsn, table=options.store_table)
+    elif options.store == 'file':
+        store = FileStore(options.store_path)
+    else:
+        return orion_cb
+    store.open()
+    return store
+
+
+def connect(options: configargparse.Namespace) -> Tuple[OrionStore, Api]:
+    """Authenticate to orion and urbiotica"""
+    orion_cb = new_orion_store(options)
+    api = Api.login(new_session(pool_size(options), options.http_retries, options.connect_timeout, options.read_timeout),
+                    options.api_url, options.api_organism,
+                    options.api_username, options.api_password,
+                    cost=api_cost(options))
+    if options.metadata_cache:
+        ttl = options.metadata_ttl
+        if options.daemon:
+            # Otherwise the next discoveries would reuse the entries of the first one
+            ttl = min(ttl, options.discovery_interval / 2)
+        api.cache = MetadataCache(options.metadata_cache, ttl=ttl,
+                                  refresh=options.refresh_metadata)
+        api.cache.open()
+    return orion_cb, api
+
+
+def api_cost(options: configargparse.Namespace) -> int:
+    """Tokens of the urbiotica rate limit consumed by each request (see Api.cost).
+
+    The rate limit is split between the shards, and a backfill only
+    takes --backfill-share of it, while runs with --reserve-backfill take
+    the rest. Shares are rounded down to a fraction 1/N, so that together
+    they never exceed the limit.
+    """
+    share = 1.0
+    if options.backfill:
+        share = options.backfill_share
+    elif options.reserve_backfill:
+        share = 1 - options.backfill_share
+    # Tolerate the float error of e.g. 3 / 0.3
+    return max(1, math.ceil(options.shard_count / share - 1e-9))
+
 
+def shard_of(pomid: int, shard_count: int) -> int:
+    """Shard a POM belongs to, stable across runs and hosts"""
+    return zlib.crc32(str(pomid).encode('ascii')) % shard_count
+
+
+def topology(options: configargparse.Namespace, api: Api, orion_cb: OrionStore) -> Tuple[JsonList, JsonDict, Dict[str, JsonList]]:
+    """Discover the spots to collect.
+
+    Returns the collection parameters of each POM of this shard (see
+    SpotIterator.collect and shard_of), all the zones, and all the POMs
+    of each zone.
+    """
     all_zones = dict()
     poms_by_zone = defaultdict(list)
     pom_params = list()
     now_ts = datetime.now()
 
-    for project in api.projects().values():
-        zones = project.zones()
+    for project, zones, devices, spots in discover(api, options.workers):
         all_zones.update(zones)
-        devices = dict()
-        for zoneid in zones.keys():
-            devices.update(project.devices(zoneid))
-        for pom in project.spots().values():
+        for pom in spots.values():
             # Some projects have POMs without element IDs, probably errors.
             elementid = pom.get('elementid', '')
             if elementid == '':
                 logging.warning("Found POM without ElementID: %s", json.dumps(pom))
                 continue
             poms_by_zone[devices[elementid]['zoneid']].append(pom)
+            if shard_of(pom['pomid'], options.shard_count) != options.shard_index:
+                continue
             pom_params.append({
                 'project': project,
                 'orion_cb': orion_cb,
@@ -673,23 +2427,800 @@ def main():
                 'pom': pom,
                 'device': devices[pom['elementid']],
                 'to_ts': now_ts,
+                'prefetch': options.prefetch,
             })
+    return pom_params, all_zones, poms_by_zone
+
 
-    batchSize = 20
-    for pom in pom_params:
-        entities = list(SpotIterator.collect(**pom))
-        for base in range(0, len(entities), batchSize):
-            logging.info(f'sending batch {base} to {base+batchSize}')
-            orion_cb.send_batch(options.orion_subservice, entities[base:base+batchSize])
-
-    if options.load_zones:
-        logging.info("Loading zones")
-        entities = list()
-        timeinstant = datetime.utcnow().isoformat()
-        for zoneid, zone in all_zones.items():
-            zone_poms = poms_by_zone[zoneid]
-            entities.append(zone_to_entity(zone, zone_poms, timeinstant))
-        orion_cb.send_batch(options.orion_subservice, entities)
+def load_checkpoints(options: configargparse.Namespace, orion_cb: OrionStore,
+                     pom_params: JsonList, checkpoint_store: Optional[CheckpointStore]):
+    """Add the latest update of each POM to its collection parameters.
+
+    Latest updates come from the local checkpoint store first, and
+    orion after that. Orion checkpoints are loaded all at once,
+    falling back to one request per spot if the query fails.
+    When the entities go to another store, orion is not queried.
+    """
+    local: Dict[str, datetime] = dict()
+    if checkpoint_store is not None:
+        local = checkpoint_store.load()
+    checkpoints: Optional[Dict[str, datetime]] = local
+    if options.store == 'orion' and any(f"pomid:{params['pom']['pomid']}" not in local for params in pom_params):
+        try:
+            checkpoints = {**orion_cb.load_checkpoints(options.orion_subservice), **local}
+        except NetworkException as err:
+            logging.warning("Failed to load checkpoints, will query each spot: %s", err)
+            checkpoints = None
+    for params in pom_params:
+        if checkpoints is not None or f"pomid:{params['pom']['pomid']}" in local:
+            params['checkpoints'] = local if checkpoints is None else checkpoints
+
+
+@dataclass
+class SpotScheduler:
+    """Decides when each pom is polled, from its staleness and event frequency.
+
+    The event rate of each pom is a moving average of the events per
+    second found by its polls. A pom is due when one event is expected
+    since its latest update or poll (its staleness), but not before
+    min_interval, and always once staleness reaches max_staleness.
+    Due poms are polled in order of expected pending events.
+    """
+    min_interval: float = 60
+    max_staleness: float = 3600
+    # Weight of the latest poll in the moving average
+    smoothing: float = 0.3
+    stats: Dict[int, SpotStats] = field(default_factory=dict)
+    store: Optional[CheckpointStore] = None
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def open(self):
+        """Load the statistics from the store, if any"""
+        if self.store is not None:
+            self.stats = self.store.load_stats()
+
+    def rate(self, pomid: int) -> float:
+        """Estimated events per second. Poms never polled are assumed busy."""
+        with self.lock:
+            stats = self.stats.get(pomid, None)
+        if stats is None:
+            return 1 / self.min_interval
+        return max(stats.rate, 1 / self.max_staleness)
+
+    def staleness(self, pomid: int, watermark: float, now: float) -> float:
+        """Seconds since the latest update of the pom, or its last poll"""
+        with self.lock:
+            stats = self.stats.get(pomid, None)
+        return now - max(watermark, stats.polled if stats is not None else 0)
+
+    def interval(self, pomid: int) -> float:
+        """Seconds between polls of the pom"""
+        return min(self.max_staleness, max(self.min_interval, 1 / self.rate(pomid)))
+
+    def due(self, pomid: int, watermark: float, now: float) -> bool:
+        """True if the pom should be polled now"""
+        return self.staleness(pomid, watermark, now) >= self.interval(pomid)
+
+    def priority(self, pomid: int, watermark: float, now: float) -> float:
+        """Expected number of events not collected yet"""
+        return self.rate(pomid) * self.staleness(pomid, watermark, now)
+
+    def update(self, pomid: int, collected: Collected):
+        """Record a successful poll"""
+        now = collected.end.timestamp()
+        window = max(1.0, now - collected.start.timestamp())
+        with self.lock:
+            previous = self.stats.get(pomid, None)
+            rate = collected.entities / window
+            if previous is not None:
+                rate = self.smoothing * rate + (1 - self.smoothing) * previous.rate
+            stats = SpotStats(now, rate)
+            self.stats[pomid] = stats
+        if self.store is not None:
+            self.store.save_stats(pomid, stats)
+
+
+def checkpoint_of(params: JsonDict) -> float:
+    """Epoch of the latest update in the collection parameters of a POM, 0 if unknown"""
+    latest = (params.get('checkpoints', None) or {}).get(f"pomid:{params['pom']['pomid']}", None)
+    return latest.timestamp() if latest is not None else 0
+
+
+def prioritise(scheduler: SpotScheduler, pom_params: JsonList) -> JsonList:
+    """Collection parameters of the POMs that are due, most pending events first"""
+    now = time.time()
+    due = [params for params in pom_params
+           if scheduler.due(params['pom']['pomid'], checkpoint_of(params), now)]
+    due.sort(key=lambda params: scheduler.priority(params['pom']['pomid'], checkpoint_of(params), now),
+             reverse=True)
+    logging.info("Scheduled %d of %d spots", len(due), len(pom_params))
+    return due
+
+
+def send_zones(options: configargparse.Namespace, store: Store, zone_cache: ZoneCache,
+               all_zones: JsonDict, poms_by_zone: Dict[str, JsonList]):
+    """Update the OnStreetParking entities of the zones that changed, in batches of --batch-size"""
+    changed = list()
+    timeinstant = datetime.utcnow().isoformat()
+    for zoneid, zone in all_zones.items():
+        zone_poms = poms_by_zone[zoneid]
+        state = zone_cache.update(zone, zone_poms)
+        if state is not None:
+            changed.append((str(zoneid), state, zone_to_entity(zone, zone_poms, timeinstant, state.area)))
+    logging.info("Loading %d of %d zones", len(changed), len(all_zones))
+    size = max(1, options.batch_size)
+    for start in range(0, len(changed), size):
+        batch = changed[start:start + size]
+        store.send_batch(options.orion_subservice, [entity for _, _, entity in batch])
+        for zoneid, state, _ in batch:
+            zone_cache.save(zoneid, state)
+
+
+# Rotations that started this long before an interval are fetched, in case they overlap it
+ROTATIONS_LOOKBACK = 24*60*60
+
+
+def spot_rotations(params: JsonDict, from_ts: int, to_ts: int) -> RotationBatch:
+    """Rotations of a spot finished between from_ts and to_ts, in windows of VEHICLES_WINDOW"""
+    project, pomid = params['project'], params['pom']['pomid']
+    windows = list()
+    for start in range(from_ts, to_ts, Project.VEHICLES_WINDOW):
+        end = min(start + Project.VEHICLES_WINDOW, to_ts)
+        windows.append(project.rotations(pomid, datetime.fromtimestamp(start, tz=timezone.utc),
+                                         datetime.fromtimestamp(end, tz=timezone.utc)))
+    return RotationBatch.concat(pomid, windows, unique=True)
+
+
+def aggregate_zone(options: configargparse.Namespace, executor: ThreadPoolExecutor, zone_params: JsonList,
+                   from_ts: int, to_ts: int, with_zone: bool) -> JsonList:
+    """Aggregate entities of the spots of a zone (and the zone itself, if with_zone) between from_ts and to_ts"""
+    interval = options.aggregate_interval
+    batches = list(executor.map(lambda params: spot_rotations(params, from_ts - ROTATIONS_LOOKBACK, to_ts),
+                                zone_params))
+    entities = list()
+    for params, batch in zip(zone_params, batches):
+        entityid = f"pomid:{params['pom']['pomid']}"
+        ref = {'refParkingSpot': {'type': 'Text', 'value': entityid}}
+        for row in batch.aggregate(from_ts, to_ts, interval):
+            entities.append(aggregate_to_entity(f'aggregate:{entityid}', 'ParkingSpotAggregate', ref, row, interval))
+    if with_zone and zone_params:
+        entityid = f"zoneid:{zone_params[0]['device']['zoneid']}"
+        ref = {
+            'refOnStreetParking': {'type': 'Text', 'value': entityid},
+            'totalSpotNumber': {'type': 'Number', 'value': len(zone_params)},
+        }
+        zone_batch = RotationBatch.concat(0, batches)
+        for row in zone_batch.aggregate(from_ts, to_ts, interval, spots=len(zone_params)):
+            entities.append(aggregate_to_entity(f'aggregate:{entityid}', 'OnStreetParkingAggregate', ref, row, interval))
+    return entities
+
+
+def aggregate_rotations(options: configargparse.Namespace, store: Store,
+                        checkpoint_store: Optional[CheckpointStore], pom_params: JsonList):
+    """Send occupancy aggregates of the intervals completed since the last ones, for each spot and zone.
+
+    Intervals are aggregated once they ended --aggregate-delay seconds ago,
+    so that the rotations in progress have finished. Spots are processed
+    by zone, and the end of the last interval aggregated is kept for each
+    zone in the checkpoint store. When sharded, only spots are aggregated,
+    since a shard does not have all the spots of a zone.
+    """
+    interval = options.aggregate_interval
+    until = math.floor((time.time() - options.aggregate_delay) / interval) * interval
+    done = checkpoint_store.load_aggregates() if checkpoint_store is not None else dict()
+    by_zone: Dict[str, JsonList] = defaultdict(list)
+    for params in pom_params:
+        by_zone[str(params['device']['zoneid'])].append(params)
+    with_zone = options.shard_count == 1
+    key_suffix = '' if with_zone else f':shard-{options.shard_index}-of-{options.shard_count}'
+    with ThreadPoolExecutor(max_workers=max(1, options.workers)) as executor:
+        for zoneid, zone_params in by_zone.items():
+            key = f'zoneid:{zoneid}{key_suffix}'
+            # The first time, aggregate the last day
+            since = done.get(key, None)
+            from_ts = math.floor(since.timestamp()) if since is not None else until - ROTATIONS_LOOKBACK
+            # Whole intervals only, or the last one would be skipped
+            from_ts = from_ts // interval * interval
+            if from_ts >= until:
+                continue
+            try:
+                with metrics.timer('aggregate'):
+                    entities = aggregate_zone(options, executor, zone_params, from_ts, until, with_zone)
+                logging.info("Sending %d occupancy aggregates of zone %s", len(entities), zoneid)
+                size = max(1, options.batch_size)
+                for start in range(0, len(entities), size):
+                    store.send_batch(options.orion_subservice, entities[start:start + size])
+            # pylint: disable=broad-except
+            except Exception as err:
+                logging.error("Failed to aggregate rotations of zone %s, will retry in the next run: %s", zoneid, err)
+                metrics.count('aggregate_failures')
+                continue
+            metrics.count('aggregate_entities', len(entities))
+            if checkpoint_store is not None:
+                checkpoint_store.save_aggregate(key, datetime.fromtimestamp(until, tz=timezone.utc))
+
+
+# pylint: disable=too-many-arguments
+def collect_async(options: configargparse.Namespace, pom_params: JsonList, api: Api, orion_cb: OrionStore,
+                  batcher: Batcher, stats: RunStats, keepalive: Optional[timedelta]) -> List[Tuple[int, Optional[Collected]]]:
+    """Collect the POMs in an event loop, up to --workers at a time.
+
+    Requests to urbiotica and orion go through an aiohttp session, and wait
+    for the same rate limit buckets as the threads. The batcher is fed from
+    a single thread, and sends batches to orion (if that is the store)
+    through the event loop too.
+    """
+    def restore(store: Store):
+        with batcher.send_lock:
+            batcher.store = store
+
+    async def collect_all() -> List[Tuple[int, Optional[Collected]]]:
+        session = AiohttpSession.new(pool_size(options), options.connect_timeout, options.read_timeout)
+        api.async_session = orion_cb.async_session = session
+        store = batcher.store
+        if store is orion_cb:
+            batcher.store = LoopStore(orion_cb, asyncio.get_running_loop())
+        slots = asyncio.Semaphore(max(1, options.workers))
+
+        async def collect(params: JsonDict, feeder: ThreadPoolExecutor) -> Tuple[int, Optional[Collected]]:
+            async with slots:
+                return params['pom']['pomid'], await collect_pom_async(params, batcher, stats, feeder,
+                                                                        options.compact_events, keepalive)
+
+        try:
+            with ThreadPoolExecutor(max_workers=1) as feeder:
+                return list(await asyncio.gather(*(collect(params, feeder) for params in pom_params)))
+        finally:
+            # Wait for a batch being sent through the loop (e.g. by the batcher timer) before closing it
+            await asyncio.get_running_loop().run_in_executor(None, restore, store)
+            api.async_session = orion_cb.async_session = None
+            await session.close()
+
+    return asyncio.run(collect_all())
+
+
+def spool_dir(options: configargparse.Namespace) -> str:
+    """Spool directory of this shard"""
+    if options.shard_count > 1:
+        return os.path.join(options.spool_dir, f'shard-{options.shard_index}-of-{options.shard_count}')
+    return options.spool_dir
+
+
+def new_batcher(options: configargparse.Namespace, store: Store, stats: RunStats,
+                checkpoint_store: Optional[CheckpointStore], progress: Optional[BackfillProgress] = None) -> Batcher:
+    """Batcher configured from the command line options.
+
+    For a backfill, the progress is saved instead of the checkpoints, and
+    neither the spool nor the spot states (see --skip-unchanged) are used,
+    since they belong to the live collection.
+    """
+    spot_states: Optional[SpotStateCache] = None
+    if options.skip_unchanged and progress is None:
+        spot_states = SpotStateCache(checkpoint_store, capacity=max(1, options.spot_state_cache),
+                                     refresh=options.refresh_state)
+    batcher = Batcher(store=store,
+                      subservice=options.orion_subservice,
+                      stats=stats,
+                      checkpoint_store=checkpoint_store if progress is None else progress,
+                      spot_states=spot_states,
+                      max_entities=options.batch_size,
+                      max_bytes=options.batch_bytes,
+                      max_delay=options.batch_delay,
+                      target_latency=options.batch_latency,
+                      spool=Spool(spool_dir(options)) if options.spool_dir and progress is None else None)
+    if isinstance(store, OrionStore):
+        store.on_throttle = batcher.throttle
+    return batcher
+
+
+# pylint: disable=too-many-arguments
+def collect_poms(options: configargparse.Namespace, pom_params: JsonList, api: Api, orion_cb: OrionStore,
+                 batcher: Batcher, stats: RunStats) -> List[Tuple[int, Optional[Collected]]]:
+    """Collect the POMs into the batcher, --workers at a time, in threads or with --asyncio.
+
+    Returns the pomid and outcome of each POM (see collect_pom), in the same order.
+    """
+    # All workers share the api rate limit bucket, so concurrency
+    # overlaps the requests but never exceeds the urbiotica budget.
+    keepalive = timedelta(seconds=options.keepalive) if options.keepalive > 0 else None
+    if options.asyncio:
+        return collect_async(options, pom_params, api, orion_cb, batcher, stats, keepalive)
+    with ThreadPoolExecutor(max_workers=max(1, options.workers)) as executor:
+        futures = [(params['pom']['pomid'], executor.submit(collect_pom, params, batcher, stats, options.compact_events, keepalive))
+                   for params in pom_params]
+    return [(pomid, future.result()) for pomid, future in futures]
+
+
+def run(options: configargparse.Namespace, stats: RunStats):
+    """Run the ETL with the given command line options"""
+    orion_cb, api = connect(options)
+    pom_params, all_zones, poms_by_zone = topology(options, api, orion_cb)
+
+    checkpoint_store: Optional[CheckpointStore] = None
+    if options.checkpoint_db:
+        checkpoint_store = CheckpointStore(options.checkpoint_db)
+        checkpoint_store.open()
+    store = new_store(options, orion_cb)
+    batcher = new_batcher(options, store, stats, checkpoint_store)
+    if batcher.spooled:
+        # Before loading checkpoints, so that they include the spooled events
+        batcher.drain()
+    load_checkpoints(options, orion_cb, pom_params, checkpoint_store)
+    scheduler: Optional[SpotScheduler] = None
+    collect_params = pom_params
+    if options.max_staleness > 0:
+        scheduler = SpotScheduler(min_interval=options.poll_interval,
+                                  max_staleness=options.max_staleness,
+                                  store=checkpoint_store)
+        scheduler.open()
+        collect_params = prioritise(scheduler, pom_params)
+
+    started = time.monotonic()
+    results = collect_poms(options, collect_params, api, orion_cb, batcher, stats)
+    batcher.close()
+    if scheduler is not None:
+        for pomid, collected in results:
+            if collected is not None:
+                scheduler.update(pomid, collected)
+    logging.info("Collected %d spots (%d failed), %d entities in %d batches (%d unsent, %d dropped), %.1f seconds",
+                 stats.spots, stats.failed, stats.entities, stats.batches, stats.unsent, stats.dropped,
+                 time.monotonic() - started)
+    if batcher.spooled:
+        logging.warning("%d entities spooled in %s, they will be sent in the next run", stats.spooled, spool_dir(options))
+
+    # Zones are shared by all shards, only the first one loads them
+    if options.load_zones and options.shard_index == 0:
+        zone_cache = ZoneCache(checkpoint_store, refresh=options.refresh_state)
+        zone_cache.open()
+        send_zones(options, store, zone_cache, all_zones, poms_by_zone)
+
+    if options.aggregate_interval > 0:
+        aggregate_rotations(options, store, checkpoint_store, pom_params)
+
+    store.close()
+    if checkpoint_store is not None:
+        checkpoint_store.close()
+    if stats.failed > 0 or stats.unsent > 0:
+        raise CustomException(msg=f'{stats.failed} of {stats.spots} spots failed, {stats.unsent} entities unsent')
+
+
+def selected(options: configargparse.Namespace, pom_params: JsonList) -> JsonList:
+    """Collection parameters of the POMs in --pomids or --zoneids, all of them if neither is given"""
+    pomids = {int(pomid) for pomid in options.pomids.split(',') if pomid.strip()} if options.pomids else set()
+    zoneids = {zoneid.strip() for zoneid in options.zoneids.split(',') if zoneid.strip()} if options.zoneids else set()
+    if not pomids and not zoneids:
+        return pom_params
+    return [params for params in pom_params
+            if params['pom']['pomid'] in pomids or str(params['device']['zoneid']) in zoneids]
+
+
+def run_backfill(options: configargparse.Namespace, stats: RunStats):
+    """Collect and send again the events of the selected POMs between --from and --to.
+
+    The progress of each POM is saved in its own table of the checkpoint
+    store, so that an interrupted backfill resumes where it stopped, and
+    the live checkpoints are left alone.
+    """
+    orion_cb, api = connect(options)
+    pom_params, _, _ = topology(options, api, orion_cb)
+    pom_params = selected(options, pom_params)
+    start, end = options.backfill_from, options.backfill_to
+    checkpoint_store = CheckpointStore(options.checkpoint_db)
+    checkpoint_store.open()
+    progress = BackfillProgress(checkpoint_store, start, end)
+    done = progress.load()
+    backfill_params = list()
+    for params in pom_params:
+        pomid = params['pom']['pomid']
+        since = done.get(pomid, start)
+        if since >= end:
+            continue
+        params['to_ts'] = end
+        params['checkpoints'] = {f'pomid:{pomid}': since}
+        # So that a spot is only done when its whole range was fetched
+        params['strict'] = True
+        backfill_params.append(params)
+    logging.info("Backfilling %d spots between %s and %s (%d already done)",
+                 len(backfill_params), start, end, len(pom_params) - len(backfill_params))
+
+    store = new_store(options, orion_cb)
+    batcher = new_batcher(options, store, stats, checkpoint_store, progress)
+    started = time.monotonic()
+    results = collect_poms(options, backfill_params, api, orion_cb, batcher, stats)
+    batcher.close()
+    for pomid, collected in results:
+        # The range of a spot is done once all its events were sent
+        if collected is not None and f'pomid:{pomid}' not in batcher.failed_ids:
+            progress.save(pomid, end)
+    logging.info("Backfilled %d spots (%d failed), %d entities in %d batches (%d unsent, %d dropped), %.1f seconds",
+                 stats.spots, stats.failed, stats.entities, stats.batches, stats.unsent, stats.dropped,
+                 time.monotonic() - started)
+    store.close()
+    checkpoint_store.close()
+    if stats.failed > 0 or stats.unsent > 0:
+        raise CustomException(msg=f'{stats.failed} of {stats.spots} spots failed, {stats.unsent} entities unsent')
+
+
+def run_replay(options: configargparse.Namespace, stats: RunStats):
+    """Send the entities saved by a FileStore to orion"""
+    orion_cb = new_orion_store(options)
+    batcher = new_batcher(options, orion_cb, stats, None)
+    started = time.monotonic()
+    for entity in replay(options.replay):
+        batcher.add(entity)
+    batcher.close()
+    logging.info("Replayed %d entities in %d batches (%d unsent), %.1f seconds",
+                 stats.entities, stats.batches, stats.unsent, time.monotonic() - started)
+    if stats.unsent > 0:
+        raise CustomException(msg=f'{stats.unsent} entities unsent')
+
+
+def parse_push(payload: Any) -> Dict[int, JsonList]:
+    """vehicle_ctrl measurements of each pomid in a pushed payload.
+
+    The payload is an object, or a list of objects, with either the shape
+    of the vehicle_ctrl API response ({"pomid": ..., "measurements": [...]})
+    or a single event ({"pomid": ..., "lstamp": ..., "value": ...}).
+    Objects with a "phenomenon" other than vehicle_ctrl are ignored.
+    Raises KeyError, TypeError or ValueError if the payload is malformed.
+    """
+    items = payload if isinstance(payload, list) else [payload]
+    result: Dict[int, JsonList] = defaultdict(list)
+    for item in items:
+        if not isinstance(item, dict):
+            raise TypeError(f'Expected an object, got {type(item).__name__}')
+        if item.get('phenomenon', 'vehicle_ctrl') != 'vehicle_ctrl':
+            continue
+        pomid = int(item['pomid'])
+        measurements = item['measurements'] if 'measurements' in item else [item]
+        result[pomid].extend(parse_measurement(measurement) for measurement in measurements)
+    return result
+
+
+def parse_measurement(measurement: Any) -> JsonDict:
+    """lstamp (milliseconds) and value of a pushed vehicle_ctrl event, as integers"""
+    if not isinstance(measurement, dict):
+        raise TypeError(f'Expected an object, got {type(measurement).__name__}')
+    value = int(measurement['value'])
+    if value not in (-1, 0, 1):
+        raise ValueError(f'Invalid vehicle_ctrl value {value}')
+    return {'lstamp': int(measurement['lstamp']), 'value': value}
+
+
+class PushServer(ThreadingHTTPServer):
+    """HTTP server that forwards pushed events to a Daemon"""
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], service: 'Daemon', token: Optional[str] = None):
+        super().__init__(address, PushHandler)
+        self.service = service
+        self.token = token
+
+
+class PushHandler(BaseHTTPRequestHandler):
+    """Accepts vehicle_ctrl events pushed by urbiotica (see parse_push)"""
+    server: PushServer
+
+    def reply(self, status: int, message: str = ''):
+        """Send a plain text response"""
+        body = message.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # pylint: disable=invalid-name
+    def do_POST(self):
+        """Forward the events in the body to the daemon"""
+        metrics.count('push_requests')
+        if self.server.token and self.headers.get('Authorization', '') != f'Bearer {self.server.token}':
+            self.reply(401, 'Unauthorized')
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            events = parse_push(json.loads(self.rfile.read(length)))
+        except (KeyError, TypeError, ValueError) as err:
+            logging.warning("Rejected pushed events: %s", err)
+            self.reply(400, str(err))
+            return
+        try:
+            accepted = self.server.service.push(events)
+        # pylint: disable=broad-except
+        except Exception as err:
+            logging.exception("Failed to queue pushed events: %s", err)
+            self.reply(500, 'Internal error')
+            return
+        self.reply(200, f'{accepted}')
+
+    # pylint: disable=redefined-builtin
+    def log_message(self, format: str, *args: Any):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class Daemon:
+    """Collects every POM continuously, each one on its own schedule.
+
+    Sessions, tokens and topology are kept between polls. The scheduler
+    decides when each POM is polled again after its previous poll
+    finished, and when more POMs are due than workers are available,
+    which ones go first. The topology is discovered again (and the
+    urbiotica token renewed) every discovery_interval seconds.
+
+    Events can also be pushed (see PushServer). They are sent right away,
+    unless the POM is being polled; then it is polled again instead.
+    """
+    options: configargparse.Namespace
+    stats: RunStats
+    scheduler: SpotScheduler
+    discovery_interval: float = 3600
+
+    orion_cb: Optional[OrionStore] = None
+    store: Optional[Store] = None
+    api: Optional[Api] = None
+    checkpoint_store: Optional[CheckpointStore] = None
+    batcher: Optional[Batcher] = None
+    zone_cache: Optional[ZoneCache] = None
+    # Collection parameters and latest update of each POM
+    poms: Dict[int, JsonDict] = field(default_factory=dict)
+    watermarks: Dict[int, datetime] = field(default_factory=dict)
+    # (monotonic time, pomid) of the next poll of each idle POM
+    schedule: List[Tuple[float, int]] = field(default_factory=list)
+    # (-priority, pomid) of the POMs due for a poll
+    ready: List[Tuple[float, int]] = field(default_factory=list)
+    running: Dict[int, Future] = field(default_factory=dict)
+    next_discovery: float = 0
+    next_report: float = 0
+    next_drain: float = 0
+    next_aggregate: float = 0
+    aggregation: Optional[threading.Thread] = None
+    # POMs with events pushed while they were being polled
+    deferred: Set[int] = field(default_factory=set)
+    # POMs whose pushed events are being queued
+    pushing: Set[int] = field(default_factory=set)
+    server: Optional[PushServer] = None
+    # Guards the bookkeeping above; never held while sending to orion
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    # Serializes pushes, which are queued in the order they were received
+    push_lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    stop: threading.Event = field(default_factory=threading.Event, repr=False, compare=False)
+
+    def open(self):
+        """Authenticate and open the checkpoint store"""
+        self.orion_cb, self.api = connect(self.options)
+        if self.options.checkpoint_db:
+            self.checkpoint_store = CheckpointStore(self.options.checkpoint_db)
+            self.checkpoint_store.open()
+        self.scheduler.store = self.checkpoint_store
+        self.scheduler.open()
+        self.store = new_store(self.options, self.orion_cb)
+        self.zone_cache = ZoneCache(self.checkpoint_store, refresh=self.options.refresh_state)
+        self.zone_cache.open()
+        self.batcher = new_batcher(self.options, self.store, self.stats, self.checkpoint_store)
+        if self.batcher.spooled:
+            self.batcher.drain()
+        if self.options.listen:
+            host, port = self.options.listen.rsplit(':', 1)
+            self.server = PushServer((host, int(port)), self, self.options.listen_token)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logging.info("Listening for pushed events on %s", self.options.listen)
+
+    def close(self):
+        """Send the pending entities and close the checkpoint store"""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.batcher is not None:
+            self.batcher.close()
+        if self.store is not None:
+            self.store.close()
+        if self.checkpoint_store is not None:
+            self.checkpoint_store.close()
+
+    def discover(self):
+        """Refresh the topology, scheduling new POMs"""
+        assert self.api is not None and self.orion_cb is not None and self.store is not None
+        if self.poms:
+            self.api.authenticate(self.options.api_username, self.options.api_password)
+        pom_params, all_zones, poms_by_zone = topology(self.options, self.api, self.orion_cb)
+        added = [params for params in pom_params if params['pom']['pomid'] not in self.poms]
+        if added:
+            load_checkpoints(self.options, self.orion_cb, added, self.checkpoint_store)
+        now, epoch = time.monotonic(), time.time()
+        self.poms = {params['pom']['pomid']: params for params in pom_params}
+        for params in added:
+            pomid = params['pom']['pomid']
+            staleness = self.scheduler.staleness(pomid, checkpoint_of(params), epoch)
+            heapq.heappush(self.schedule, (now + max(0, self.scheduler.interval(pomid) - staleness), pomid))
+        logging.info("Discovered %d spots (%d new)", len(self.poms), len(added))
+        if self.options.load_zones and self.options.shard_index == 0:
+            assert self.zone_cache is not None
+            send_zones(self.options, self.store, self.zone_cache, all_zones, poms_by_zone)
+            # Refresh only applies to the first discovery
+            self.zone_cache.refresh = False
+
+    def watermark(self, pomid: int) -> float:
+        """Epoch of the latest update of the POM, 0 if unknown"""
+        latest = self.watermarks.get(pomid, None)
+        if latest is None:
+            return checkpoint_of(self.poms[pomid])
+        return latest.timestamp()
+
+    def params(self, pomid: int) -> JsonDict:
+        """Parameters for the next collection of the POM"""
+        assert self.batcher is not None
+        params = dict(self.poms[pomid], to_ts=datetime.now())
+        entityid = f'pomid:{pomid}'
+        # Recovering may flush the pending entities, outside the lock
+        lost = self.batcher.recover(entityid)
+        with self.lock:
+            if lost is not None:
+                # Resume from the earliest event that orion did not accept
+                self.watermarks[pomid] = parser.isoparse(lost) - timedelta(seconds=1)
+            if pomid in self.watermarks:
+                params['checkpoints'] = {entityid: self.watermarks[pomid]}
+        return params
+
+    def finished(self, now: float):
+        """Reschedule the POMs whose poll has finished"""
+        with self.lock:
+            for pomid, future in list(self.running.items()):
+                if not future.done():
+                    continue
+                del self.running[pomid]
+                collected = future.result()
+                if collected is not None:
+                    self.watermarks[pomid] = collected.latest
+                    self.scheduler.update(pomid, collected)
+                if pomid in self.poms:
+                    due = now if pomid in self.deferred else now + self.scheduler.interval(pomid)
+                    heapq.heappush(self.schedule, (due, pomid))
+                self.deferred.discard(pomid)
+
+    def launch(self, executor: ThreadPoolExecutor, now: float):
+        """Start polling the due POMs, most pending events first, up to the number of workers"""
+        epoch = time.time()
+        while self.schedule and self.schedule[0][0] <= now:
+            _, pomid = heapq.heappop(self.schedule)
+            # POMs removed from the topology are not scheduled again
+            if pomid in self.poms:
+                heapq.heappush(self.ready, (-self.scheduler.priority(pomid, self.watermark(pomid), epoch), pomid))
+        keepalive = timedelta(seconds=self.options.keepalive) if self.options.keepalive > 0 else None
+        while self.ready and len(self.running) < max(1, self.options.workers):
+            _, pomid = heapq.heappop(self.ready)
+            if pomid not in self.poms:
+                continue
+            with self.lock:
+                if pomid in self.pushing:
+                    # Try again once the pushed events are queued
+                    heapq.heappush(self.schedule, (now, pomid))
+                    continue
+                # Pushes wait for the poll from now on
+                self.running[pomid] = Future()
+            future = executor.submit(collect_pom, self.params(pomid), self.batcher,
+                                     self.stats, self.options.compact_events, keepalive)
+            with self.lock:
+                self.running[pomid] = future
+
+    def push(self, events: Dict[int, JsonList]) -> int:
+        """Send pushed events newer than the latest update of each POM.
+
+        Returns the number of events queued in the batcher.
+        """
+        accepted = 0
+        with self.push_lock:
+            for pomid, measurements in events.items():
+                metrics.count('push_events', len(measurements))
+                with self.lock:
+                    if pomid not in self.poms:
+                        logging.warning("Ignoring %d pushed events of unknown pomid %s", len(measurements), pomid)
+                        continue
+                    if pomid in self.running:
+                        # Sending now could reorder the events, poll again instead
+                        self.deferred.add(pomid)
+                        continue
+                    # Polls wait for the pushed events from now on
+                    self.pushing.add(pomid)
+                    params, latest = self.poms[pomid], self.watermark(pomid)
+                try:
+                    accepted += self._push(params, measurements, latest)
+                finally:
+                    with self.lock:
+                        self.pushing.discard(pomid)
+        return accepted
+
+    def _push(self, params: JsonDict, measurements: JsonList, latest: float) -> int:
+        """Queue the pushed events of a POM newer than latest, returns their number"""
+        assert self.batcher is not None
+        pomid = params['pom']['pomid']
+        batch = VehicleBatch.decode(pomid, measurements).after(math.floor(latest) if latest > 0 else None)
+        if len(batch) == 0:
+            return 0
+        spot = SpotIterator.new(params['pom'], params['device'],
+                                datetime.fromtimestamp(latest, tz=timezone.utc),
+                                datetime.now(), [batch])
+        written = unwritten(spot, self.batcher.spot_states)
+        if self.options.compact_events:
+            keepalive = timedelta(seconds=self.options.keepalive) if self.options.keepalive > 0 else None
+            spot.events = compact_events(spot.events, self.stats, keepalive)
+        for entity in spot.encoded(written):
+            self.batcher.add(entity)
+            with self.lock:
+                self.watermarks[pomid] = parser.isoparse(entity.modified)
+        return len(batch)
+
+    def aggregate(self, now: float):
+        """Start aggregating rotations in the background, unless the previous aggregation is still running"""
+        if self.aggregation is not None and self.aggregation.is_alive():
+            return
+        self.next_aggregate = now + self.options.aggregate_interval
+        self.aggregation = threading.Thread(target=aggregate_rotations, daemon=True,
+                                            args=(self.options, self.store, self.checkpoint_store,
+                                                  list(self.poms.values())))
+        self.aggregation.start()
+
+    def run(self):
+        """Poll until stopped"""
+        assert self.batcher is not None
+        with ThreadPoolExecutor(max_workers=max(1, self.options.workers)) as executor:
+            while not self.stop.is_set():
+                now = time.monotonic()
+                if now >= self.next_discovery:
+                    self.next_discovery = now + self.discovery_interval
+                    try:
+                        self.discover()
+                    # pylint: disable=broad-except
+                    except Exception as err:
+                        logging.exception("Failed to discover topology, keeping the previous one: %s", err)
+                        self.next_discovery = now + self.scheduler.min_interval
+                self.finished(now)
+                self.launch(executor, now)
+                self.batcher.poll()
+                if now >= self.next_drain:
+                    if self.batcher.spooled:
+                        self.batcher.drain()
+                    if self.batcher.spot_states is not None:
+                        self.batcher.spot_states.snapshot()
+                    self.next_drain = now + self.scheduler.min_interval
+                if self.options.aggregate_interval > 0 and self.poms and now >= self.next_aggregate:
+                    self.aggregate(now)
+                if self.options.metrics_file and now >= self.next_report:
+                    metrics.write(self.options.metrics_file, **self.stats.totals())
+                    self.next_report = now + self.scheduler.min_interval
+                # Wake up when a poll finishes, a POM is due or a batch must be sent
+                timeout = min(self.batcher.max_delay, self.next_discovery - now)
+                if self.schedule and not self.ready:
+                    timeout = min(timeout, self.schedule[0][0] - now)
+                if self.running:
+                    wait(list(self.running.values()), timeout=max(0.1, timeout), return_when=FIRST_COMPLETED)
+                else:
+                    self.stop.wait(max(0.1, timeout))
+            for future in self.running.values():
+                future.cancel()
+        if self.aggregation is not None:
+            self.aggregation.join()
+
+
+def daemon(options: configargparse.Namespace, stats: RunStats):
+    """Run the ETL continuously, until SIGINT or SIGTERM"""
+    scheduler = SpotScheduler(min_interval=options.poll_interval,
+                              max_staleness=max(options.poll_interval, options.max_staleness))
+    service = Daemon(options, stats, scheduler,
+                     discovery_interval=options.discovery_interval)
+
+    def shutdown(signum, _frame):
+        logging.info("Received signal %d, stopping", signum)
+        service.stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    service.open()
+    try:
+        service.run()
+    finally:
+        service.close()
 
 
 
@@ -0,0 +1,128 @@
+# pylint: disable=line-too-long
+"""Counters, timers and rate limits of the ETL run"""
+
+import json
+import os
+import time
+import threading
+
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from typing import Dict, Any, List, Optional
+from dataclasses import dataclass, field
+
+from limiter import Limiter, async_limit_rate, limit_rate # type: ignore
+
+
+# Counters of the entities sent by each store (see Metrics.summary)
+STORE_ENTITIES = ('orion_entities', 'postgres_entities', 'file_entities')
+
+
+@dataclass
+class Metrics:
+    """Counters and timers of the ETL run, shared by all threads"""
+    counters: Dict[str, float] = field(default_factory=dict)
+    # name -> [count, total seconds, max seconds]
+    timers: Dict[str, List[float]] = field(default_factory=dict)
+    started: float = field(default_factory=time.monotonic)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def count(self, name: str, value: float = 1):
+        """Increment a counter"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        """Add a duration to a timer"""
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def reset(self):
+        """Clear all counters and timers, and restart the clock"""
+        with self.lock:
+            self.counters = dict()
+            self.timers = dict()
+            self.started = time.monotonic()
+
+    @contextmanager
+    def timer(self, name: str):
+        """Time the body of a with statement"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started)
+
+    def summary(self, **extra: Any) -> Dict[str, Any]:
+        """Summary of the run, as a json-serializable dict"""
+        elapsed = time.monotonic() - self.started
+        with self.lock:
+            counters = dict(self.counters)
+            timers = {name: {'count': int(count), 'seconds': total, 'max': longest}
+                      for name, (count, total, longest) in self.timers.items()}
+        entities = sum(counters.get(name, 0) for name in STORE_ENTITIES)
+        return {
+            'elapsed': elapsed,
+            'entities_per_second': entities / elapsed if elapsed > 0 else 0,
+            'counters': counters,
+            'timers': timers,
+            **extra,
+        }
+
+    def write(self, path: str, **extra: Any):
+        """Write the summary to path, in prometheus textfile format if it ends in .prom, or JSON otherwise"""
+        summary = self.summary(**extra)
+        if path.endswith('.prom'):
+            lines = [
+                '# TYPE urbiotica_etl_elapsed_seconds gauge',
+                f"urbiotica_etl_elapsed_seconds {summary['elapsed']}",
+                '# TYPE urbiotica_etl_entities_per_second gauge',
+                f"urbiotica_etl_entities_per_second {summary['entities_per_second']}",
+            ]
+            numbers = {**summary['counters'], **{key: value for key, value in extra.items() if isinstance(value, (int, float))}}
+            for name, value in sorted(numbers.items()):
+                lines.append(f'# TYPE urbiotica_etl_{name}_total counter')
+                lines.append(f'urbiotica_etl_{name}_total {value}')
+            for name, timer in sorted(summary['timers'].items()):
+                lines.append(f'# TYPE urbiotica_etl_{name}_seconds summary')
+                lines.append(f"urbiotica_etl_{name}_seconds_count {timer['count']}")
+                lines.append(f"urbiotica_etl_{name}_seconds_sum {timer['seconds']}")
+                lines.append(f'# TYPE urbiotica_etl_{name}_max_seconds gauge')
+                lines.append(f"urbiotica_etl_{name}_max_seconds {timer['max']}")
+            content = '\n'.join(lines) + '\n'
+        else:
+            content = json.dumps(summary, indent=2)
+        # Write atomically, textfile collectors may read the file at any time
+        tmpname = path + '.tmp'
+        with open(tmpname, 'w', encoding='utf-8') as outfile:
+            outfile.write(content)
+        os.replace(tmpname, path)
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def metered(bucket: Optional[Limiter], name: str, cost: int = 1):
+    """Wait for cost tokens of the rate limit bucket (if any), and time both the wait and the body of the with statement"""
+    started = time.monotonic()
+    with (limit_rate(bucket, consume=cost) if bucket is not None else nullcontext()):
+        metrics.observe(f'{name}_limiter_wait', time.monotonic() - started)
+        metrics.count(f'{name}_requests')
+        with metrics.timer(f'{name}_request'):
+            yield
+
+
+@asynccontextmanager
+async def metered_async(bucket: Optional[Limiter], name: str, cost: int = 1):
+    """Same as metered, without blocking the event loop while waiting for the rate limit"""
+    started = time.monotonic()
+    if bucket is not None:
+        async with async_limit_rate(bucket, consume=cost):
+            pass
+    metrics.observe(f'{name}_limiter_wait', time.monotonic() - started)
+    metrics.count(f'{name}_requests')
+    with metrics.timer(f'{name}_request'):
+        yield
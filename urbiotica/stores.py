@@ -0,0 +1,192 @@
+# pylint: disable=line-too-long
+"""Entities, and the stores they are saved to other than orion"""
+
+import csv
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+from typing import Dict, Any, Generator, Iterator, List, Protocol, Sequence, NamedTuple, Tuple
+from dataclasses import dataclass, field
+
+from instrumentation import metrics
+
+
+class Store(Protocol):
+    """Store represents any persistence backend"""
+    def open(self):
+        """Ready the store for saving data"""
+    def send_batch(self, subservice: str, entities: Sequence[Any]) -> None:
+        """Saves a batch of entities (dicts or EncodedEntity) to the backend"""
+    def close(self):
+        """Closes the backend connection"""
+
+
+class EncodedEntity(NamedTuple):
+    """An entity already serialized to JSON"""
+    id: str
+    # occupancyModified or TimeInstant of the entity, used for checkpoints
+    modified: str
+    data: bytes
+    # Hash of the static attributes included in data, if any (see SpotStateCache)
+    static: str = ''
+
+
+def encode_entity(entity: Dict[str, Any]) -> EncodedEntity:
+    """Serialize an entity dict"""
+    modified = entity.get('occupancyModified', entity.get('TimeInstant', {})).get('value', '')
+    return EncodedEntity(entity['id'], modified, json.dumps(entity, separators=(',', ':')).encode('utf-8'))
+
+
+def encode_batch(entities: Sequence[Any]) -> bytes:
+    """Serialize a /v2/op/update body, joining already encoded entities without parsing them"""
+    parts = (entity.data if isinstance(entity, EncodedEntity) else encode_entity(entity).data for entity in entities)
+    return b'{"actionType":"append","entities":[' + b','.join(parts) + b']}'
+
+
+def decode_entity(entity: Any) -> Dict[str, Any]:
+    """Entity dict, parsing it if it is an EncodedEntity"""
+    return json.loads(entity.data) if isinstance(entity, EncodedEntity) else entity
+
+
+def entity_row(entity: Dict[str, Any]) -> Tuple[str, str, str, str]:
+    """Flatten an entity to (id, type, time instant, JSON object of attribute values)"""
+    timeinstant = entity.get('occupancyModified', entity.get('TimeInstant', {})).get('value', '')
+    attrs = {name: attr.get('value', None) for name, attr in entity.items() if name not in ('id', 'type')}
+    return entity['id'], entity['type'], timeinstant, json.dumps(attrs, separators=(',', ':'))
+
+
+@dataclass
+class PostgresStore:
+    """Store that bulk loads entities into a PostgreSQL (or TimescaleDB) table with COPY.
+
+    The table is created if it does not exist, with one row per entity
+    and time instant. Rows already in the table are skipped, so batches
+    can be loaded again safely. Requires the psycopg2 module.
+    """
+    dsn: str
+    table: str = 'urbiotica_entities'
+    conn: Any = None
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def open(self):
+        """Connect to the database, and create the table if needed"""
+        # Optional dependency, only needed for this store
+        import psycopg2 # type: ignore # pylint: disable=import-outside-toplevel
+        self.conn = psycopg2.connect(self.dsn)
+        with self.lock, self.conn, self.conn.cursor() as cursor:
+            cursor.execute(f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                           'entityid TEXT NOT NULL, entitytype TEXT NOT NULL, '
+                           'timeinstant TIMESTAMPTZ NOT NULL, subservice TEXT NOT NULL, '
+                           'attrs JSONB NOT NULL, PRIMARY KEY (entityid, timeinstant))')
+
+    def send_batch(self, subservice: str, entities: Sequence[Any]):
+        """COPY the entities into a temporary table, and insert the new ones"""
+        assert self.conn is not None
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for entity in entities:
+            entityid, entitytype, timeinstant, attrs = entity_row(decode_entity(entity))
+            writer.writerow((entityid, entitytype, timeinstant, subservice, attrs))
+        buffer.seek(0)
+        started = time.monotonic()
+        with self.lock, self.conn, self.conn.cursor() as cursor:
+            cursor.execute(f'CREATE TEMPORARY TABLE IF NOT EXISTS batch (LIKE {self.table}) ON COMMIT DELETE ROWS')
+            cursor.copy_expert('COPY batch FROM STDIN WITH (FORMAT csv)', buffer)
+            cursor.execute(f'INSERT INTO {self.table} SELECT DISTINCT ON (entityid, timeinstant) * FROM batch '
+                           'ON CONFLICT DO NOTHING')
+        metrics.observe('postgres_batch', time.monotonic() - started)
+        metrics.count('postgres_entities', len(entities))
+        logging.info('Loaded batch of %d entities into %s', len(entities), self.table)
+
+    def close(self):
+        """Close the connection"""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+@dataclass
+class FileStore:
+    """Store that appends entities to a local NDJSON file, one entity per line.
+
+    Each line is the same entity that would be sent to orion, so the
+    file can be replayed later (see replay). Files ending in .gz are
+    compressed.
+    """
+    path: str
+    outfile: Any = None
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def open(self):
+        """Open the file for appending"""
+        self.outfile = gzip.open(self.path, 'ab') if self.path.endswith('.gz') else open(self.path, 'ab')
+
+    def send_batch(self, subservice: str, entities: Sequence[Any]):
+        """Append the entities to the file"""
+        assert self.outfile is not None
+        data = b''.join((entity if isinstance(entity, EncodedEntity) else encode_entity(entity)).data + b'\n'
+                        for entity in entities)
+        with self.lock:
+            self.outfile.write(data)
+            self.outfile.flush()
+        metrics.count('file_entities', len(entities))
+        metrics.count('file_bytes', len(data))
+        logging.info('Saved batch of %d entities to %s', len(entities), self.path)
+
+    def close(self):
+        """Close the file"""
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+
+
+def replay(path: str) -> Generator[EncodedEntity, None, None]:
+    """Entities saved by a FileStore"""
+    with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as infile:
+        for line in infile:
+            line = line.strip()
+            if line:
+                entity = json.loads(line)
+                yield encode_entity(entity)._replace(data=line)
+
+
+@dataclass
+class Spool:
+    """Local directory of batches that could not be sent, one NDJSON file per batch (see replay)"""
+    path: str
+    sequence: Iterator[int] = field(default_factory=itertools.count, repr=False, compare=False)
+
+    def directory(self, subservice: str) -> str:
+        """Directory of the batches of the subservice"""
+        return os.path.join(self.path, urllib.parse.quote(subservice, safe=''))
+
+    def put(self, subservice: str, entities: Sequence[EncodedEntity]):
+        """Save a batch, atomically"""
+        directory = self.directory(subservice)
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.join(directory, f'{time.time_ns():020d}-{next(self.sequence):06d}.ndjson')
+        with open(name + '.tmp', 'wb') as outfile:
+            outfile.write(b''.join(entity.data + b'\n' for entity in entities))
+        os.replace(name + '.tmp', name)
+
+    def batches(self, subservice: str) -> List[str]:
+        """Files of the saved batches, oldest first"""
+        directory = self.directory(subservice)
+        if not os.path.isdir(directory):
+            return list()
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith('.ndjson')]
+
+    def load(self, subservice: str) -> Dict[str, str]:
+        """Latest modification time of each entity in the saved batches"""
+        latest: Dict[str, str] = dict()
+        for path in self.batches(subservice):
+            for entity in replay(path):
+                latest[entity.id] = max(entity.modified, latest.get(entity.id, ''))
+        return latest
@@ -0,0 +1,115 @@
+"""Fixtures shared by the tests of collect.py"""
+
+import os
+import sys
+import threading
+
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Sequence
+from dataclasses import dataclass, field
+
+import pytest
+
+# collect.py is a script, its modules are imported from its own directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import bench
+import collect
+import instrumentation
+import stores
+
+
+@dataclass
+class RecordingStore:
+    """Store that keeps the batches sent, and raises the given errors first"""
+    batches: List[List[Any]] = field(default_factory=list)
+    errors: List[Exception] = field(default_factory=list)
+
+    def open(self):
+        """Nothing to open"""
+
+    def send_batch(self, _subservice: str, entities: Sequence[Any]):
+        """Record the batch, unless an error is pending"""
+        if self.errors:
+            raise self.errors.pop(0)
+        self.batches.append(list(entities))
+
+    def close(self):
+        """Nothing to close"""
+
+    def sent(self) -> List[str]:
+        """Modification times of the entities sent, in order"""
+        return [entity.modified for batch in self.batches for entity in batch]
+
+
+def entity(pomid: int, minute: int) -> stores.EncodedEntity:
+    """Encoded ParkingSpot of the pom, modified at the given minute"""
+    modified = f'2024-01-01T00:{minute:02d}:00+00:00'
+    return stores.encode_entity({
+        'id': f'pomid:{pomid}',
+        'type': 'ParkingSpot',
+        'occupancyModified': {'type': 'DateTime', 'value': modified},
+    })
+
+
+@pytest.fixture
+def store() -> RecordingStore:
+    """Store that records the batches"""
+    return RecordingStore()
+
+
+@pytest.fixture
+def backend() -> bench.FakeBackend:
+    """State of the fake urbiotica, keystone and orion endpoints"""
+    return bench.FakeBackend(spots=6, zones=2, days=1, events_per_day=24)
+
+
+@contextmanager
+def serve(backend: bench.FakeBackend) -> Iterator[str]:
+    """Serve the fake endpoints of the backend, yields their base URL"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), bench.handler(backend))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def run(url: str, *args: str) -> Dict[str, float]:
+    """Run collect.main against the fake endpoints at url, with extra arguments.
+
+    Returns the metrics counters of the run.
+    """
+    argv = [
+        'collect.py',
+        '--api-url', url, '--api-organism', 'test',
+        '--api-username', 'test', '--api-password', 'test',
+        '--keystone-url', url, '--orion-url', url,
+        '--orion-service', 'test', '--orion-subservice', '/test',
+        '--orion-username', 'test', '--orion-password', 'test',
+        *args]
+    saved, sys.argv = sys.argv, argv
+    try:
+        collect.main()
+    finally:
+        sys.argv = saved
+    return dict(instrumentation.metrics.summary()['counters'])
+
+
+@pytest.fixture
+def url(backend: bench.FakeBackend) -> Iterator[str]:
+    """Base URL of the fake endpoints"""
+    with serve(backend) as base:
+        yield base
+
+
+@pytest.fixture
+def run_main(url: str):
+    """Run collect.main against the fake endpoints (see run)"""
+    def run_url(*args: str) -> Dict[str, float]:
+        return run(url, *args)
+
+    return run_url
@@ -0,0 +1,76 @@
+"""Occupancy aggregates computed from rotations"""
+
+import sqlite3
+
+import numpy as np
+
+import bench
+import collect
+
+
+def rotations(pomid: int, *pairs) -> collect.RotationBatch:
+    return collect.RotationBatch(pomid, np.array([start for start, _ in pairs], dtype=np.int64),
+                                 np.array([end for _, end in pairs], dtype=np.int64))
+
+
+def test_aggregate_of_a_spot():
+    batch = rotations(1, (0, 600), (1000, 1300), (1750, 2000))
+    rows = batch.aggregate(0, 2700, 900)
+    assert [row['start'] for row in rows] == [0, 900, 1800]
+    assert [row['turnover'] for row in rows] == [1, 2, 0]
+    assert rows[0]['occupancy'] == 600 / 900
+    # (1000, 1300) and the start of (1750, 2000)
+    assert rows[1]['occupancy'] == 350 / 900
+    assert rows[1]['dwell_mean'] == 300
+    assert rows[2]['dwell_median'] == 250
+    assert rows[2]['occupancy'] == 200 / 900
+
+
+def test_aggregate_skips_rotations_outside_the_range():
+    rows = rotations(1, (-300, 300), (800, 1000)).aggregate(0, 900, 900)
+    assert len(rows) == 1
+    assert rows[0]['turnover'] == 1
+    assert rows[0]['occupancy'] == 400 / 900
+    # (800, 1000) finishes after the interval
+    assert rows[0]['dwell_mean'] == 600
+    assert not rotations(1).aggregate(0, 600, 900)
+
+
+def test_concat_drops_repeated_rotations_of_a_spot_only():
+    first, second = rotations(1, (0, 600)), rotations(2, (0, 600))
+    assert len(collect.RotationBatch.concat(1, [first, first], unique=True)) == 1
+    zone = collect.RotationBatch.concat(0, [first, second])
+    rows = zone.aggregate(0, 900, 900, spots=2)
+    assert rows[0]['turnover'] == 2
+    assert rows[0]['occupancy'] == 1200 / 1800
+
+
+def test_aggregate_to_entity():
+    row = {'start': 0, 'occupancy': 0.5, 'turnover': 2, 'dwell_mean': 300.0, 'dwell_median': 300.0, 'dwell_p90': None}
+    ref = {'refParkingSpot': {'type': 'Text', 'value': 'pomid:1'}}
+    entity = collect.aggregate_to_entity('aggregate:pomid:1', 'ParkingSpotAggregate', ref, row, 900)
+    assert entity['id'] == 'aggregate:pomid:1'
+    assert entity['type'] == 'ParkingSpotAggregate'
+    assert entity['TimeInstant']['value'] == '1970-01-01T00:00:00+00:00'
+    assert entity['refParkingSpot'] == ref['refParkingSpot']
+    assert entity['aggregationPeriod']['value'] == 900
+    assert entity['occupancyRate']['value'] == 0.5
+    assert entity['turnover']['value'] == 2
+    assert entity['dwellTimeP90']['value'] is None
+
+
+def test_first_aggregation_covers_whole_intervals(run_main, backend: bench.FakeBackend, tmp_path):
+    interval = 7000
+    database = str(tmp_path / 'checkpoints.db')
+    run_main('--aggregate-interval', str(interval), '--aggregate-delay', '0', '--checkpoint-db', database)
+    aggregates = [entity for entity in backend.entities.values() if entity['type'] == 'ParkingSpotAggregate']
+    assert len(aggregates) == 6
+    zone = backend.entities['aggregate:zoneid:0']
+    assert zone['totalSpotNumber']['value'] == 3
+    # The latest interval sent ends where the checkpoint does
+    with sqlite3.connect(database) as conn:
+        until, = conn.execute("SELECT until FROM aggregates WHERE entityid = 'zoneid:0'").fetchone()
+    latest = collect.parser.isoparse(zone['TimeInstant']['value'])
+    assert latest.timestamp() == collect.parser.isoparse(until).timestamp() - interval
+    counters = run_main('--aggregate-interval', str(interval), '--aggregate-delay', '0', '--checkpoint-db', database)
+    assert counters.get('aggregate_entities', 0) <= 8
@@ -0,0 +1,49 @@
+"""Collection with asyncio, instead of threads"""
+
+import pytest
+import requests
+
+import bench
+import collect
+
+from conftest import run, serve
+
+pytest.importorskip('aiohttp')
+
+BACKFILL = ('--backfill', '--from', '2024-01-01T00:00:00Z', '--to', '2024-01-02T00:00:00Z')
+
+
+def new_backend() -> bench.FakeBackend:
+    return bench.FakeBackend(spots=6, zones=2, days=1, events_per_day=24)
+
+
+def test_async_response_behaves_like_requests():
+    response = collect.AsyncResponse(200, {}, b'{"a": 1}')
+    assert response.json() == {'a': 1}
+    assert response.text == '{"a": 1}'
+    response.raise_for_status()
+    with pytest.raises(requests.exceptions.JSONDecodeError):
+        collect.AsyncResponse(200, {}, b'{').json()
+    with pytest.raises(requests.exceptions.HTTPError):
+        collect.AsyncResponse(503, {}, b'unavailable').raise_for_status()
+
+
+def test_async_sends_the_same_entities_as_threads(tmp_path):
+    threads, tasks = new_backend(), new_backend()
+    with serve(threads) as url:
+        expected = run(url, *BACKFILL, '--checkpoint-db', str(tmp_path / 'threads.db'))
+    with serve(tasks) as url:
+        counters = run(url, *BACKFILL, '--checkpoint-db', str(tmp_path / 'tasks.db'), '--asyncio')
+    assert counters['orion_entities'] == expected['orion_entities'] == 6 * 23
+    assert tasks.entities == threads.entities
+
+
+def test_async_live_collection(tmp_path):
+    backend = new_backend()
+    before = {entityid: entity['occupancyModified']['value'] for entityid, entity in backend.entities.items()}
+    with serve(backend) as url:
+        counters = run(url, '--asyncio', '--checkpoint-db', str(tmp_path / 'checkpoints.db'))
+        assert 'orion_entities' not in run(url, '--asyncio', '--checkpoint-db', str(tmp_path / 'checkpoints.db'))
+    assert counters['urbiotica_events'] >= 6 * 23
+    assert all(backend.entities[entityid]['occupancyModified']['value'] > modified
+               for entityid, modified in before.items())
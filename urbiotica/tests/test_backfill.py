@@ -0,0 +1,42 @@
+"""Backfill of a past range of events"""
+
+import sqlite3
+
+import bench
+
+BACKFILL = ('--backfill', '--from', '2024-01-01T00:00:00Z', '--to', '2024-01-01T06:00:00Z', '--pomids', '10000,10001')
+
+
+def test_backfill_resumes_without_moving_live_checkpoints(run_main, backend: bench.FakeBackend, tmp_path):
+    database = str(tmp_path / 'checkpoints.db')
+    counters = run_main(*BACKFILL, '--checkpoint-db', database)
+    # One event an hour, after --from and before --to
+    assert counters['orion_entities'] == 10
+    assert backend.requests['urbiotica_vehicles'] == 2
+    assert backend.entities['pomid:10000']['occupancyModified']['value'] == '2024-01-01T05:00:00+00:00'
+    assert backend.entities['pomid:10002']['occupancyModified']['value'] != '2024-01-01T05:00:00+00:00'
+
+    # Already done
+    counters = run_main(*BACKFILL, '--checkpoint-db', database)
+    assert 'orion_entities' not in counters
+    assert backend.requests['urbiotica_vehicles'] == 2
+
+    with sqlite3.connect(database) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM backfills').fetchone() == (2,)
+        assert conn.execute('SELECT COUNT(*) FROM checkpoints').fetchone() == (0,)
+
+
+def test_backfill_alongside_live_runs(run_main, tmp_path):
+    database = str(tmp_path / 'checkpoints.db')
+    run_main('--checkpoint-db', database)
+    with sqlite3.connect(database) as conn:
+        live = conn.execute('SELECT * FROM checkpoints ORDER BY pomid').fetchall()
+    assert len(live) == 6
+
+    run_main(*BACKFILL, '--checkpoint-db', database)
+    with sqlite3.connect(database) as conn:
+        assert conn.execute('SELECT * FROM checkpoints ORDER BY pomid').fetchall() == live
+
+    # Resumes from its checkpoints, not from the backfilled state in orion
+    counters = run_main('--checkpoint-db', database)
+    assert counters.get('urbiotica_events', 0) <= 6
@@ -0,0 +1,179 @@
+"""Batching of entities sent to the store"""
+
+import threading
+import time
+
+from datetime import datetime, timezone
+
+import requests
+
+import collect
+
+from conftest import RecordingStore, entity
+
+
+def new_batcher(store, **kwargs) -> collect.Batcher:
+    return collect.Batcher(store=store, subservice='/test', stats=collect.RunStats(), **kwargs)
+
+
+def test_sends_full_batches_in_order(store: RecordingStore):
+    batcher = new_batcher(store, max_entities=3, max_delay=60)
+    for minute in range(7):
+        batcher.add(entity(minute, minute))
+    assert [len(batch) for batch in store.batches] == [3, 3]
+    batcher.close()
+    assert [len(batch) for batch in store.batches] == [3, 3, 1]
+    assert store.sent() == sorted(store.sent())
+    assert batcher.stats.entities == 7
+    assert batcher.stats.batches == 3
+
+
+def test_sends_when_max_bytes_is_reached(store: RecordingStore):
+    size = len(entity(1, 0).data) + 1
+    batcher = new_batcher(store, max_bytes=2 * size, max_delay=60)
+    for minute in range(3):
+        batcher.add(entity(minute, minute))
+    assert [len(batch) for batch in store.batches] == [2]
+    batcher.close()
+
+
+def test_timer_sends_partial_batch_after_max_delay(store: RecordingStore):
+    batcher = new_batcher(store, max_delay=0.1)
+    batcher.add(entity(1, 0))
+    assert not store.batches
+    deadline = time.monotonic() + 5
+    while not store.batches and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert [len(batch) for batch in store.batches] == [1]
+    batcher.close()
+
+
+def test_failed_entity_discards_later_events(store: RecordingStore):
+    store.errors.append(collect.NetworkException(msg='boom', url='', status_code=500, text=''))
+    batcher = new_batcher(store, max_entities=2, max_delay=60)
+    batcher.add(entity(1, 0))
+    batcher.add(entity(2, 0))
+    # The first batch failed, so later events of both poms are not sent
+    batcher.add(entity(1, 1))
+    batcher.add(entity(3, 0))
+    batcher.close()
+    assert [e.id for batch in store.batches for e in batch] == ['pomid:3']
+    assert batcher.stats.unsent == 3
+    assert batcher.recover('pomid:1') == '2024-01-01T00:00:00+00:00'
+    assert batcher.recover('pomid:1') is None
+
+
+def test_splits_batches_too_large(store: RecordingStore):
+    store.errors.append(collect.NetworkException(msg='too large', url='', status_code=413, text=''))
+    batcher = new_batcher(store, max_entities=4, max_delay=60)
+    for minute in range(4):
+        batcher.add(entity(minute, minute))
+    batcher.close()
+    assert [len(batch) for batch in store.batches] == [2, 2]
+    assert batcher.stats.unsent == 0
+
+
+def test_batch_size_adapts_to_latency(store: RecordingStore):
+    batcher = new_batcher(store, max_entities=10, max_delay=60, target_latency=-1)
+    for minute in range(11):
+        batcher.add(entity(minute, minute))
+    # Every batch is slower than the target
+    assert [len(batch) for batch in store.batches] == [10]
+    assert batcher.batch_size == 5
+    batcher.close()
+
+
+def test_adds_while_a_batch_is_being_sent():
+    sending, release = threading.Event(), threading.Event()
+
+    class SlowStore(RecordingStore):
+        def send_batch(self, subservice, entities):
+            sending.set()
+            release.wait(5)
+            super().send_batch(subservice, entities)
+
+    store = SlowStore()
+    batcher = new_batcher(store, max_entities=1, max_delay=60)
+    batcher.add(entity(1, 0))
+    sender = threading.Thread(target=batcher.add, args=(entity(2, 0),))
+    sender.start()
+    assert sending.wait(5)
+    # The lock is free while sending, so entities keep being queued
+    batcher.add(entity(3, 0))
+    assert [e.id for e in batcher.pending] == ['pomid:3']
+    release.set()
+    sender.join()
+    batcher.close()
+    assert [e.id for batch in store.batches for e in batch] == ['pomid:1', 'pomid:3', 'pomid:2']
+
+
+def test_concurrent_adds_send_full_batches():
+    class SlowStore(RecordingStore):
+        def send_batch(self, subservice, entities):
+            time.sleep(0.01)
+            super().send_batch(subservice, entities)
+
+    store = SlowStore()
+    batcher = new_batcher(store, max_entities=10, max_delay=60)
+
+    def add(pomid: int):
+        for minute in range(50):
+            batcher.add(entity(pomid, minute))
+
+    adders = [threading.Thread(target=add, args=(pomid,)) for pomid in range(4)]
+    for adder in adders:
+        adder.start()
+    for adder in adders:
+        adder.join()
+    batcher.close()
+    assert [len(batch) for batch in store.batches] == [10] * 20
+    for pomid in range(4):
+        sent = [e.modified for batch in store.batches for e in batch if e.id == f'pomid:{pomid}']
+        assert sent == sorted(sent)
+
+
+class Response:
+    """Enough of a requests.Response for OrionStore"""
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.headers = {}
+        self.text = ''
+
+
+class Session:
+    """Session that answers the orion batches with the given statuses"""
+    def __init__(self, *statuses: int):
+        self.statuses = list(statuses)
+
+    def post(self, url, **_kwargs):
+        assert url.endswith('/v2/op/update')
+        return Response(self.statuses.pop(0))
+
+
+def test_throttles_on_each_overloaded_response():
+    orion = collect.OrionStore('http://keystone', 'http://orion', 'user', 'password', 'service',
+                               seconds_sleep=0, retries=3, session=Session(429, 503, 204), token={'/test': 'token'},
+                               token_expiry={'/test': datetime.max.replace(tzinfo=timezone.utc)})
+    batcher = new_batcher(orion, max_entities=8, max_delay=60)
+    orion.on_throttle = batcher.throttle
+    batcher.add(entity(1, 0))
+    batcher.flush()
+    # Halved twice, although the batch was finally accepted and grows again
+    assert batcher.batch_size == 2 + 1
+    assert batcher.stats.entities == 1
+
+
+def test_batch_unsent_once_orion_retries_are_exhausted():
+    class Flaky(Session):
+        def post(self, url, **kwargs):
+            if not self.statuses:
+                raise requests.exceptions.ConnectionError('reset')
+            return super().post(url, **kwargs)
+
+    orion = collect.OrionStore('http://keystone', 'http://orion', 'user', 'password', 'service',
+                               seconds_sleep=0, retries=1, session=Flaky(), token={'/test': 'token'},
+                               token_expiry={'/test': datetime.max.replace(tzinfo=timezone.utc)})
+    batcher = new_batcher(orion, max_delay=60)
+    batcher.add(entity(1, 0))
+    batcher.close()
+    assert batcher.stats.unsent == 1
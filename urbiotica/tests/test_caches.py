@@ -0,0 +1,144 @@
+"""Caches of the topology and of the state already written"""
+
+import json
+import os
+import threading
+import time
+
+from typing import Tuple
+
+import pytest
+
+import bench
+import caches
+import checkpoints
+
+
+def test_metadata_cache_expires_entries(tmp_path):
+    cache = caches.MetadataCache(str(tmp_path / 'metadata.json'), ttl=60)
+    assert cache.get('zones') is None
+    cache.put('zones', [1, 2])
+    assert cache.get('zones') == [1, 2]
+    cache.entries['zones']['fetched'] = time.time() - 120
+    assert cache.get('zones') is None
+
+
+def test_metadata_cache_is_saved_once(tmp_path):
+    path = str(tmp_path / 'metadata.json')
+    cache = caches.MetadataCache(path)
+    cache.put('zones', [1, 2])
+    assert not os.path.exists(path)
+    cache.save()
+    modified = os.stat(path).st_mtime_ns
+    cache.save()
+    assert os.stat(path).st_mtime_ns == modified
+
+    loaded = caches.MetadataCache(path)
+    loaded.open()
+    assert loaded.get('zones') == [1, 2]
+    refreshed = caches.MetadataCache(path, refresh=True)
+    refreshed.open()
+    assert refreshed.get('zones') is None
+
+
+def test_metadata_cache_ignores_a_malformed_file(tmp_path):
+    path = tmp_path / 'metadata.json'
+    path.write_text('{', encoding='utf-8')
+    cache = caches.MetadataCache(str(path))
+    cache.open()
+    assert not cache.entries
+
+
+def test_metadata_cache_shared_by_several_writers(tmp_path, caplog):
+    path = str(tmp_path / 'metadata.json')
+
+    def write(shard: int):
+        for index in range(50):
+            cache = caches.MetadataCache(path)
+            cache.put(f'shard{shard}', [index] * 10000)
+            cache.save()
+
+    writers = [threading.Thread(target=write, args=(shard,)) for shard in range(4)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    with open(path, 'r', encoding='utf-8') as infile:
+        assert len(json.load(infile)) == 1
+    assert os.listdir(tmp_path) == ['metadata.json']
+    assert 'Failed to write' not in caplog.text
+
+
+def test_discovery_uses_the_metadata_cache(run_main, backend: bench.FakeBackend, tmp_path):
+    path = str(tmp_path / 'metadata.json')
+    run_main('--metadata-cache', path)
+    assert backend.requests['urbiotica_spots'] == 1
+    assert backend.requests['urbiotica_devices'] == 2
+    run_main('--metadata-cache', path)
+    assert backend.requests['urbiotica_spots'] == 1
+    assert backend.requests['urbiotica_devices'] == 2
+    run_main('--metadata-cache', path, '--refresh-metadata')
+    assert backend.requests['urbiotica_spots'] == 2
+
+
+def zone(description: str = 'Zone 1') -> caches.JsonDict:
+    return {'zoneid': 1, 'description': description, 'lat_ne': '1', 'lat_sw': '0', 'long_ne': '1', 'long_sw': '0'}
+
+
+def poms(*coords: Tuple[float, float]) -> caches.JsonList:
+    return [{'latitude': str(lat), 'longitude': str(long)} for lat, long in coords]
+
+
+TRIANGLE = ((0.1, 0.1), (0.2, 0.1), (0.1, 0.2))
+SQUARE = TRIANGLE + ((0.2, 0.2),)
+
+
+def test_zone_cache_skips_unchanged_zones(monkeypatch: pytest.MonkeyPatch, tmp_path):
+    areas = list()
+    zone_area = caches.zone_area
+
+    def counting(zone_poms):
+        areas.append(len(zone_poms))
+        return zone_area(zone_poms)
+
+    monkeypatch.setattr(caches, 'zone_area', counting)
+    store = checkpoints.CheckpointStore(str(tmp_path / 'checkpoints.db'))
+    store.open()
+    cache = caches.ZoneCache(store)
+    cache.open()
+    state = cache.update(zone(), poms(*TRIANGLE))
+    assert state is not None
+    # Not sent yet, so still changed
+    assert cache.update(zone(), poms(*TRIANGLE)) == state
+    cache.save('1', state)
+    assert cache.update(zone(), poms(*reversed(TRIANGLE))) is None
+    # New attributes, but the same area
+    renamed = cache.update(zone('Renamed'), poms(*TRIANGLE))
+    assert renamed is not None and renamed.area == state.area
+    assert areas == [3, 3]
+    assert cache.update(zone(), poms(*SQUARE)) is not None
+    assert areas == [3, 3, 4]
+    # Saved states outlive the run, unless refreshed
+    assert caches.ZoneCache(store, states=store.load_zones()).update(zone(), poms(*TRIANGLE)) is None
+    assert caches.ZoneCache(store, refresh=True, states=store.load_zones()).update(zone(), poms(*TRIANGLE)) == state
+    store.close()
+
+
+def test_unchanged_zones_are_sent_once(run_main, backend: bench.FakeBackend, monkeypatch: pytest.MonkeyPatch, tmp_path):
+    saved = list()
+    save = caches.ZoneCache.save
+
+    def recording(self, zoneid, state):
+        saved.append(zoneid)
+        save(self, zoneid, state)
+
+    monkeypatch.setattr(caches.ZoneCache, 'save', recording)
+    args = ('--load-zones', '--checkpoint-db', str(tmp_path / 'checkpoints.db'))
+    run_main(*args)
+    assert sorted(saved) == [str(zoneid) for zoneid in range(backend.zones)]
+    assert sum(entity['type'] == 'OnStreetParking' for entity in backend.entities.values()) == backend.zones
+    saved.clear()
+    run_main(*args)
+    assert not saved
+    run_main(*args, '--refresh-state')
+    assert len(saved) == backend.zones
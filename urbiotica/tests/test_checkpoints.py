@@ -0,0 +1,75 @@
+"""State kept between runs in the checkpoint store"""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import caches
+import checkpoints
+import collect
+
+from conftest import RecordingStore, entity
+
+
+@pytest.fixture
+def checkpoint_store(tmp_path):
+    store = checkpoints.CheckpointStore(str(tmp_path / 'checkpoints.db'))
+    store.open()
+    yield store
+    store.close()
+
+
+def test_creates_every_table(checkpoint_store: checkpoints.CheckpointStore):
+    assert checkpoint_store.conn is not None
+    tables = {name for name, in checkpoint_store.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert tables == set(checkpoints.TABLES)
+
+
+def test_checkpoints_only_move_forward(checkpoint_store: checkpoints.CheckpointStore):
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    checkpoint_store.save(1, now)
+    checkpoint_store.save(1, now - timedelta(hours=1))
+    checkpoint_store.save(2, now - timedelta(hours=1))
+    assert checkpoint_store.load() == {'pomid:1': now, 'pomid:2': now - timedelta(hours=1)}
+
+
+def test_backfill_progress_is_apart_from_checkpoints(checkpoint_store: checkpoints.CheckpointStore):
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    end = datetime(2023, 2, 1, tzinfo=timezone.utc)
+    progress = checkpoints.BackfillProgress(checkpoint_store, start, end)
+    progress.save(1, start + timedelta(days=1))
+    progress.save(1, start)
+    assert progress.load() == {1: start + timedelta(days=1)}
+    assert not checkpoints.BackfillProgress(checkpoint_store, start, end + timedelta(days=1)).load()
+    assert not checkpoint_store.load()
+
+
+def test_batcher_saves_the_latest_event_sent(checkpoint_store: checkpoints.CheckpointStore, store: RecordingStore):
+    batcher = collect.Batcher(store=store, subservice='/test', stats=collect.RunStats(),
+                              max_delay=60, checkpoint_store=checkpoint_store)
+    batcher.add(entity(1, 0))
+    batcher.add(entity(1, 7))
+    batcher.add(entity(2, 3))
+    batcher.close()
+    assert checkpoint_store.load() == {
+        'pomid:1': datetime(2024, 1, 1, 0, 7, tzinfo=timezone.utc),
+        'pomid:2': datetime(2024, 1, 1, 0, 3, tzinfo=timezone.utc),
+    }
+
+
+def test_spot_states_keep_the_static_hash(checkpoint_store: checkpoints.CheckpointStore):
+    checkpoint_store.save_spot_states({'pomid:1': checkpoints.SpotState(10, 'abc')})
+    checkpoint_store.save_spot_states({'pomid:1': checkpoints.SpotState(5, '')})
+    assert checkpoint_store.load_spot_state('pomid:1') == checkpoints.SpotState(10, 'abc')
+    assert checkpoint_store.load_spot_state('pomid:2') is None
+
+
+def test_spot_state_cache_snapshots_and_refreshes(checkpoint_store: checkpoints.CheckpointStore):
+    cache = caches.SpotStateCache(checkpoint_store, capacity=2)
+    cache.update('pomid:1', 10, 'abc')
+    assert checkpoint_store.load_spot_state('pomid:1') is None
+    cache.update('pomid:2', 20, 'def')
+    # Full, so snapshot
+    assert checkpoint_store.load_spot_state('pomid:1') == checkpoints.SpotState(10, 'abc')
+    assert caches.SpotStateCache(checkpoint_store).get('pomid:2') == checkpoints.SpotState(20, 'def')
+    assert caches.SpotStateCache(checkpoint_store, refresh=True).get('pomid:2') == checkpoints.SpotState(20, '')
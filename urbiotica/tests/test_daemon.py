@@ -0,0 +1,100 @@
+"""Continuous collection with --daemon"""
+
+import os
+import signal
+import threading
+import time
+
+from collections import Counter
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from typing import Iterator
+
+import configargparse
+import pytest
+
+import bench
+import collect
+
+from conftest import run
+
+
+@pytest.fixture
+def polls(monkeypatch: pytest.MonkeyPatch) -> Counter:
+    """Number of polls of each pomid"""
+    counter: Counter = Counter()
+    collect_pom = collect.collect_pom
+
+    def counting(params, *args, **kwargs):
+        counter[params['pom']['pomid']] += 1
+        return collect_pom(params, *args, **kwargs)
+
+    monkeypatch.setattr(collect, 'collect_pom', counting)
+    return counter
+
+
+@pytest.fixture
+def sigterm() -> Iterator[None]:
+    """Send SIGTERM to the daemon after two seconds, restoring the handlers afterwards"""
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    timer = threading.Timer(2, os.kill, (os.getpid(), signal.SIGTERM))
+    timer.start()
+    try:
+        yield
+    finally:
+        timer.cancel()
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+
+def test_daemon_polls_quiet_spots_once(backend: bench.FakeBackend, url: str, polls: Counter, sigterm, tmp_path):
+    started = time.monotonic()
+    counters = run(url, '--daemon', '--poll-interval', '0.5', '--max-staleness', '3600',
+                   '--checkpoint-db', str(tmp_path / 'checkpoints.db'))
+    assert time.monotonic() - started < 10
+    assert polls == {backend.pomid(index): 1 for index in range(backend.spots)}
+    # One event per hour, so every spot is up to date
+    recent = datetime.now(timezone.utc) - timedelta(hours=1)
+    for entity in backend.entities.values():
+        if entity['type'] == 'ParkingSpot':
+            assert datetime.fromisoformat(entity['occupancyModified']['value']) > recent
+    assert counters['orion_entities'] == backend.received
+
+
+def test_daemon_polls_again_after_max_staleness(backend: bench.FakeBackend, url: str, polls: Counter, sigterm):
+    counters = run(url, '--daemon', '--poll-interval', '0.5')
+    assert set(polls) == {backend.pomid(index) for index in range(backend.spots)}
+    assert min(polls.values()) >= 2
+    # Later polls start from the latest update, so nothing is sent twice
+    assert counters['orion_entities'] == backend.received
+    assert backend.received <= backend.spots * backend.events_per_day
+
+
+def idle_daemon() -> collect.Daemon:
+    """Daemon of pomids 1 and 2, without any connection"""
+    options = configargparse.Namespace(workers=1, keepalive=0, compact_events=False)
+    service = collect.Daemon(options, collect.RunStats(), collect.SpotScheduler(min_interval=60, max_staleness=3600))
+    service.poms = {pomid: {'pom': {'pomid': pomid}} for pomid in (1, 2)}
+    return service
+
+
+def test_finished_polls_are_rescheduled():
+    service = idle_daemon()
+    done: Future = Future()
+    done.set_result(None)
+    service.running = {1: done, 2: Future()}
+    service.finished(1000)
+    assert service.schedule == [(1060, 1)]
+    assert list(service.running) == [2]
+
+
+def test_events_pushed_while_polling_poll_again():
+    service = idle_daemon()
+    polling: Future = Future()
+    service.running = {1: polling}
+    assert service.push({1: [{'lstamp': 1000, 'value': 1}], 3: [{'lstamp': 1000, 'value': 1}]}) == 0
+    assert service.deferred == {1}
+    polling.set_result(None)
+    service.finished(1000)
+    assert service.schedule == [(1000, 1)]
+    assert not service.deferred
@@ -0,0 +1,53 @@
+"""ParkingSpot entities of the vehicle_ctrl events"""
+
+import json
+
+from datetime import datetime, timezone
+
+import collect
+
+from checkpoints import SpotState
+
+POM = {'pomid': 1, 'name': 'Spot 1', 'latitude': '38.69', 'longitude': '-0.48'}
+DEVICE = {'elementid': 'element1', 'zoneid': 7}
+
+
+def spot(*events) -> collect.SpotIterator:
+    batch = collect.VehicleBatch.decode(1, [{'lstamp': lstamp * 1000, 'value': value} for lstamp, value in events])
+    now = datetime.now(timezone.utc)
+    return collect.SpotIterator.new(POM, DEVICE, now, now, [batch])
+
+
+def test_encoded_entities():
+    entities = list(spot((0, 1), (60, 0), (120, -1)).encoded())
+    assert [entity.modified for entity in entities] == [
+        '1970-01-01T00:00:00+00:00', '1970-01-01T00:01:00+00:00', '1970-01-01T00:02:00+00:00']
+    assert all(entity.id == 'pomid:1' and entity.static == '' for entity in entities)
+    first = json.loads(entities[0].data)
+    assert first == {
+        'id': 'pomid:1',
+        'type': 'ParkingSpot',
+        'TimeInstant': {'type': 'DateTime', 'value': '1970-01-01T00:00:00+00:00'},
+        'occupancyModified': {'type': 'DateTime', 'value': '1970-01-01T00:00:00+00:00'},
+        'name': {'type': 'Text', 'value': 'Spot 1'},
+        'refOnStreetParking': {'type': 'Text', 'value': 'zoneid:7'},
+        'refDevice': {'type': 'Text', 'value': 'elementid:element1'},
+        'location': {'type': 'geo:json', 'value': {'type': 'Point', 'coordinates': [-0.48, 38.69]}},
+        'status': {'type': 'Text', 'value': 'occupied'},
+        'occupied': {'type': 'Number', 'value': 1},
+    }
+    assert json.loads(entities[1].data)['status']['value'] == 'free'
+    unknown = json.loads(entities[2].data)
+    assert unknown['status']['value'] == 'unknown'
+    assert unknown['occupied']['value'] is None
+
+
+def test_encoded_entities_skip_static_attributes_written():
+    entities = list(spot((0, 1), (60, 0)).encoded(SpotState(0, '')))
+    # Only the first entity of the spot carries them, with their hash
+    assert 'name' in json.loads(entities[0].data)
+    assert entities[0].static
+    assert 'name' not in json.loads(entities[1].data)
+    written = list(spot((0, 1)).encoded(SpotState(0, entities[0].static)))
+    assert 'name' not in json.loads(written[0].data)
+    assert written[0].static == ''
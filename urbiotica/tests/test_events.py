@@ -0,0 +1,91 @@
+"""Decoding of vehicle_ctrl events and rotations"""
+
+from datetime import timedelta
+
+import numpy as np
+import pytest
+
+import collect
+
+
+def test_isoparse_bulk_matches_isoparse():
+    items = ['2024-01-01T00:00:00', '2024-01-01T00:00:01Z', '2024-01-01T00:00:02+00:00', '2024-01-01T00:00:03.000Z']
+    assert collect.isoparse_bulk(items).tolist() == [1704067200, 1704067201, 1704067202, 1704067203]
+    # Fractions and other offsets take the slow path
+    items = ['2024-01-01T01:00:00+01:00', '2024-01-01T00:00:01.5Z']
+    assert collect.isoparse_bulk(items).tolist() == [1704067200, 1704067201]
+    assert collect.isoparse_bulk([]).tolist() == []
+
+
+def test_isoformat_bulk_matches_isoformat():
+    timestamps = np.array([0, 1704067200], dtype=np.int64)
+    assert collect.isoformat_bulk(timestamps).tolist() == ['1970-01-01T00:00:00+00:00', '2024-01-01T00:00:00+00:00']
+
+
+def test_vehicle_batch_decode_sorts_by_lstamp():
+    batch = collect.VehicleBatch.decode(1, [
+        {'lstamp': '3000', 'value': '1'},
+        {'lstamp': 1999, 'value': 0},
+        {'lstamp': '2500', 'value': '-1'},
+    ])
+    assert batch.lstamp.tolist() == [1, 2, 3]
+    assert batch.value.tolist() == [0, -1, 1]
+    assert batch.timeinstants() == ['1970-01-01T00:00:01+00:00', '1970-01-01T00:00:02+00:00', '1970-01-01T00:00:03+00:00']
+    assert batch.after(2).lstamp.tolist() == [3]
+    assert batch.after(None) is batch
+
+
+def test_vehicle_batch_concat():
+    first = collect.VehicleBatch.decode(1, [{'lstamp': 3000, 'value': 1}])
+    second = collect.VehicleBatch.decode(1, [{'lstamp': 1000, 'value': 0}, {'lstamp': 5000, 'value': 0}])
+    batch = collect.VehicleBatch.concat(1, [first, second])
+    assert batch.lstamp.tolist() == [1, 3, 5]
+    assert batch.value.tolist() == [0, 1, 0]
+    assert len(collect.VehicleBatch.concat(1, [])) == 0
+
+
+def test_vehicle_batch_decode_rejects_malformed_events():
+    with pytest.raises(KeyError):
+        collect.VehicleBatch.decode(1, [{'value': 1}])
+    with pytest.raises(ValueError):
+        collect.VehicleBatch.decode(1, [{'lstamp': 'soon', 'value': 1}])
+
+
+def test_rotation_batch_decode_sorts_by_start():
+    batch = collect.RotationBatch.decode(1, [
+        {'start': '2024-01-01T01:00:00Z', 'end': '2024-01-01T01:30:00Z'},
+        {'start': '2024-01-01T00:00:00+00:00', 'end': '2024-01-01T00:10:00+00:00'},
+    ])
+    assert batch.start.tolist() == [1704067200, 1704070800]
+    assert (batch.end - batch.start).tolist() == [600, 1800]
+
+
+def events(*pairs) -> collect.VehicleBatch:
+    return collect.VehicleBatch.decode(1, [{'lstamp': lstamp * 1000, 'value': value} for lstamp, value in pairs])
+
+
+def compacted(batches, keepalive=None):
+    stats = collect.RunStats()
+    kept = [(lstamp, value) for batch in collect.compact_events(batches, stats, keepalive)
+            for lstamp, value in zip(batch.lstamp.tolist(), batch.value.tolist())]
+    return kept, stats.dropped
+
+
+def test_compact_events_drops_repeated_values():
+    kept, dropped = compacted([events((1, 1), (2, 1), (3, 0), (4, 0)), events((5, 0), (6, 1), (7, 1), (8, 1))])
+    # The last event is kept, to keep track of the range collected
+    assert kept == [(1, 1), (3, 0), (6, 1), (8, 1)]
+    assert dropped == 4
+
+
+def test_compact_events_keeps_the_last_event_once():
+    kept, dropped = compacted([events((1, 1), (2, 1)), events(), events((3, 1))])
+    assert kept == [(1, 1), (3, 1)]
+    assert dropped == 1
+    assert compacted([]) == ([], 0)
+
+
+def test_compact_events_keepalive():
+    kept, dropped = compacted([events((0, 1), (30, 1), (60, 1), (90, 1), (100, 0), (110, 0))], timedelta(seconds=60))
+    assert kept == [(0, 1), (60, 1), (100, 0), (110, 0)]
+    assert dropped == 2
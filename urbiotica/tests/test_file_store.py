@@ -0,0 +1,42 @@
+"""Entities saved to a local file, and replayed to orion"""
+
+import copy
+import gzip
+
+import pytest
+
+import bench
+import stores
+
+from conftest import entity
+
+
+@pytest.mark.parametrize('name', ['entities.ndjson', 'entities.ndjson.gz'])
+def test_saved_entities_are_replayed_in_order(tmp_path, name):
+    path = str(tmp_path / name)
+    for minutes in ((1, 2), (3,)):
+        # Every run appends to the file
+        store = stores.FileStore(path)
+        store.open()
+        store.send_batch('/test', [entity(1, minute) for minute in minutes])
+        store.close()
+    assert list(stores.replay(path)) == [entity(1, minute) for minute in (1, 2, 3)]
+
+
+def test_replay_skips_blank_lines(tmp_path):
+    path = tmp_path / 'entities.ndjson.gz'
+    with gzip.open(path, 'wb') as outfile:
+        outfile.write(entity(1, 1).data + b'\n\n  \n' + entity(2, 1).data + b'\n')
+    assert [saved.id for saved in stores.replay(str(path))] == ['pomid:1', 'pomid:2']
+
+
+def test_collected_entities_are_saved_and_replayed(backend: bench.FakeBackend, run_main, tmp_path):
+    path = str(tmp_path / 'entities.ndjson.gz')
+    before = copy.deepcopy(backend.entities)
+    counters = run_main('--store', 'file', '--store-path', path)
+    assert counters['file_entities'] > 0
+    assert backend.received == 0
+    assert backend.entities == before
+    counters = run_main('--replay', path)
+    assert counters['orion_entities'] == backend.received == len(list(stores.replay(path)))
+    assert backend.entities != before
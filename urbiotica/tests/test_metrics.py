@@ -0,0 +1,35 @@
+"""Metrics of the ETL run"""
+
+import json
+
+import bench
+import instrumentation
+
+
+def test_summary_counts_entities_of_every_store():
+    metrics = instrumentation.Metrics()
+    metrics.count('file_entities', 10)
+    metrics.count('postgres_entities', 5)
+    metrics.count('urbiotica_events', 100)
+    metrics.started -= 5
+    summary = metrics.summary(spots=2)
+    assert 2.9 < summary['entities_per_second'] <= 3
+    assert summary['counters']['urbiotica_events'] == 100
+    assert summary['spots'] == 2
+
+
+def test_metrics_file(run_main, tmp_path):
+    path = tmp_path / 'metrics.json'
+    run_main('--store', 'file', '--store-path', str(tmp_path / 'entities.ndjson'), '--metrics-file', str(path))
+    summary = json.loads(path.read_text(encoding='utf-8'))
+    assert summary['counters']['file_entities'] == summary['entities'] > 0
+    assert summary['entities_per_second'] > 0
+    assert summary['timers']['urbiotica_request']['count'] == summary['counters']['urbiotica_requests']
+
+
+def test_prometheus_metrics_file(run_main, backend: bench.FakeBackend, tmp_path):
+    path = tmp_path / 'metrics.prom'
+    run_main('--metrics-file', str(path))
+    lines = path.read_text(encoding='utf-8').splitlines()
+    assert f'urbiotica_etl_orion_entities_total {backend.received}' in lines
+    assert any(line.startswith('urbiotica_etl_entities_per_second ') for line in lines)
@@ -0,0 +1,210 @@
+"""Requests to keystone and orion"""
+
+import json
+import os
+import stat
+import threading
+import time
+
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from typing import Any, Dict, List, Optional
+
+import pytest
+
+from limiter import get_limiter  # type: ignore
+
+import collect
+
+
+class Response:
+    """Enough of a requests.Response for OrionStore"""
+    def __init__(self, status_code: int, body: Any = None, headers: Optional[Dict[str, str]] = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+        self.text = json.dumps(body)
+
+    def json(self) -> Any:
+        return self.body
+
+
+def keystone(token: str, expires: datetime) -> Response:
+    return Response(201, {'token': {'expires_at': expires.isoformat()}}, {'X-Subject-Token': token})
+
+
+class Session:
+    """Session that answers with the given responses, in order, and records the requests"""
+    def __init__(self, *responses: Response):
+        self.responses = list(responses)
+        self.requests: List[Any] = list()
+
+    def get(self, url, **kwargs):
+        self.requests.append(('GET', url, kwargs))
+        return self.responses.pop(0)
+
+    def post(self, url, **kwargs):
+        self.requests.append(('POST', url, kwargs))
+        return self.responses.pop(0)
+
+
+def new_store(session: Session, **kwargs) -> collect.OrionStore:
+    return collect.OrionStore('http://keystone', 'http://orion', 'user', 'password', 'service',
+                              seconds_sleep=0, retries=2, session=session, token=dict(), **kwargs)
+
+
+def later(**kwargs) -> datetime:
+    return datetime.now(timezone.utc) + timedelta(**kwargs)
+
+
+def test_authenticates_once_until_the_token_expires():
+    session = Session(keystone('first', later(hours=1)), keystone('second', later(hours=1)))
+    orion = new_store(session, token_margin=300)
+    orion.ensure_token('/test')
+    orion.ensure_token('/test')
+    assert orion.token['/test'] == 'first'
+    assert len(session.requests) == 1
+    # Within the margin, a new token is requested before it expires
+    orion.token_expiry['/test'] = later(minutes=4)
+    orion.ensure_token('/test')
+    assert orion.token['/test'] == 'second'
+    assert len(session.requests) == 2
+
+
+def test_rejected_token_is_renewed_once():
+    session = Session(keystone('first', later(hours=1)), keystone('renewed', later(hours=1)))
+    orion = new_store(session)
+    orion.ensure_token('/test')
+    orion.renew_token('/test', 'first')
+    assert orion.token['/test'] == 'renewed'
+    # Another thread was rejected with the old token
+    orion.renew_token('/test', 'first')
+    assert len(session.requests) == 2
+
+
+def test_tokens_are_reused_across_runs(tmp_path):
+    path = str(tmp_path / 'tokens.json')
+    orion = new_store(Session(keystone('cached', later(hours=1))), token_cache=path)
+    orion.open()
+    orion.ensure_token('/test')
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+    session = Session()
+    reused = new_store(session, token_cache=path)
+    reused.open()
+    reused.ensure_token('/test')
+    assert reused.token['/test'] == 'cached'
+    assert not session.requests
+
+    other = collect.OrionStore('http://keystone', 'http://orion', 'other', 'password', 'service',
+                               seconds_sleep=0, retries=2, session=Session(), token=dict(), token_cache=path)
+    other.open()
+    assert not other.token
+
+
+@pytest.mark.parametrize('entry', [
+    {'token': 'expired', 'expires_at': '2020-01-01T00:00:00+00:00'},
+    {'token': 'malformed', 'expires_at': 'tomorrow'},
+    {'token': 'missing'},
+    'token',
+])
+def test_unusable_cached_tokens_are_ignored(tmp_path, entry):
+    path = tmp_path / 'tokens.json'
+    orion = new_store(Session())
+    path.write_text(json.dumps({orion.token_cache_key('/test'): entry}), encoding='utf-8')
+    orion.token_cache = str(path)
+    orion.open()
+    assert not orion.token
+
+
+def test_token_cache_shared_by_several_writers(tmp_path, caplog):
+    path = str(tmp_path / 'tokens.json')
+
+    def authenticate(shard: int):
+        for _ in range(50):
+            orion = new_store(Session(keystone(f'shard{shard}', later(hours=1))), token_cache=path)
+            orion.ensure_token(f'/shard{shard}')
+
+    writers = [threading.Thread(target=authenticate, args=(shard,)) for shard in range(4)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    with open(path, 'r', encoding='utf-8') as infile:
+        assert json.load(infile)
+    assert os.listdir(tmp_path) == ['tokens.json']
+    assert 'Failed to write' not in caplog.text
+
+
+def authenticated(session: Session, **kwargs) -> collect.OrionStore:
+    orion = new_store(session, **kwargs)
+    orion.token['/test'] = 'token'
+    orion.token_expiry['/test'] = later(hours=1)
+    return orion
+
+
+def spots(*pomids: int) -> List[Any]:
+    return [{'id': f'pomid:{pomid}', 'type': 'ParkingSpot',
+             'occupancyModified': {'type': 'DateTime', 'value': f'2024-01-01T00:00:{pomid:02d}+00:00'}}
+            for pomid in pomids]
+
+
+def test_load_checkpoints_pages_through_every_spot():
+    session = Session(Response(200, spots(1, 2), {'Fiware-Total-Count': '5'}),
+                      Response(200, spots(3, 4), {'Fiware-Total-Count': '5'}),
+                      Response(200, spots(5) + [{'id': 'pomid:6', 'type': 'ParkingSpot'}], {'Fiware-Total-Count': '6'}))
+    checkpoints = authenticated(session).load_checkpoints('/test', page_size=2)
+    assert sorted(checkpoints) == [f'pomid:{pomid}' for pomid in range(1, 6)]
+    assert checkpoints['pomid:3'] == datetime(2024, 1, 1, 0, 0, 3, tzinfo=timezone.utc)
+    assert [kwargs['params']['offset'] for _, _, kwargs in session.requests] == ['0', '2', '4']
+    assert all(kwargs['params']['limit'] == '2' for _, _, kwargs in session.requests)
+
+
+def test_load_checkpoints_stops_at_a_short_page():
+    session = Session(Response(200, spots(1), {}))
+    assert len(authenticated(session).load_checkpoints('/test', page_size=2)) == 1
+    assert len(session.requests) == 1
+
+
+def test_load_checkpoints_fails_on_errors():
+    session = Session(*[Response(400, {'error': 'BadRequest'})] * 4)
+    with pytest.raises(collect.NetworkException):
+        authenticated(session).load_checkpoints('/test')
+    # Retried until retries runs below 0, like the batches
+    assert len(session.requests) == 4
+
+
+@pytest.mark.parametrize('retry_after, delay', [
+    ('2', 2),
+    ('0.5', 0.5),
+    ('-3', 0),
+    ('600', 60),
+])
+def test_retry_delay_honours_retry_after(retry_after, delay):
+    orion = new_store(Session(), max_backoff=60)
+    assert orion.retry_delay(0, Response(503, headers={'Retry-After': retry_after})) == delay
+
+
+def test_retry_delay_honours_retry_after_dates():
+    orion = new_store(Session(), max_backoff=60)
+    retry_after = format_datetime(later(seconds=30), usegmt=True)
+    assert 28 <= orion.retry_delay(0, Response(429, headers={'Retry-After': retry_after})) <= 30
+
+
+@pytest.mark.parametrize('res', [None, Response(500), Response(503, headers={'Retry-After': 'soon'})])
+def test_retry_delay_backs_off_exponentially_with_jitter(res):
+    orion = new_store(Session(), max_backoff=60)
+    orion.seconds_sleep = 1
+    for attempt in range(8):
+        delays = [orion.retry_delay(attempt, res) for _ in range(20)]
+        assert all(0 <= delay <= min(60, 2 ** attempt) for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_orion_requests_wait_for_the_rate_limit():
+    session = Session(*[Response(200, spots(1))] * 5)
+    orion = authenticated(session, bucket=get_limiter(rate=50, capacity=1))
+    started = time.monotonic()
+    for _ in range(5):
+        orion.load_checkpoints('/test', page_size=2)
+    assert time.monotonic() - started >= 4 / 50 * 0.9
@@ -0,0 +1,84 @@
+"""Events pushed to the daemon"""
+
+import json
+import threading
+
+from typing import Dict, List
+
+import pytest
+import requests
+
+import collect
+
+
+def test_parse_push_of_api_responses_and_events():
+    payload = [
+        {'pomid': '1', 'phenomenon': 'vehicle_ctrl', 'measurements': [{'lstamp': 1000, 'value': 1}]},
+        {'pomid': 1, 'lstamp': '2000', 'value': '0'},
+        {'pomid': 2, 'phenomenon': 'battery', 'measurements': [{'lstamp': 1000, 'value': 90}]},
+    ]
+    assert collect.parse_push(payload) == {1: [{'lstamp': 1000, 'value': 1}, {'lstamp': 2000, 'value': 0}]}
+    assert collect.parse_push({'pomid': 3, 'lstamp': 1000, 'value': -1}) == {3: [{'lstamp': 1000, 'value': -1}]}
+
+
+@pytest.mark.parametrize('payload, error', [
+    ({'lstamp': 1000, 'value': 1}, KeyError),
+    ({'pomid': 1, 'value': 1}, KeyError),
+    ([1], TypeError),
+    ({'pomid': 1, 'measurements': ['x']}, TypeError),
+    ({'pomid': 'x', 'lstamp': 1000, 'value': 1}, ValueError),
+    ({'pomid': 1, 'lstamp': 1000, 'value': 2}, ValueError),
+    ({'pomid': 1, 'lstamp': 1000, 'value': 'on'}, ValueError),
+])
+def test_parse_push_rejects_malformed_payloads(payload, error):
+    with pytest.raises(error):
+        collect.parse_push(payload)
+
+
+class Service:
+    """Daemon that records the events pushed, or fails"""
+    def __init__(self):
+        self.events: List[Dict[int, collect.JsonList]] = list()
+        self.error = False
+
+    def push(self, events: Dict[int, collect.JsonList]) -> int:
+        if self.error:
+            raise RuntimeError('boom')
+        self.events.append(events)
+        return sum(len(measurements) for measurements in events.values())
+
+
+@pytest.fixture
+def service():
+    return Service()
+
+
+@pytest.fixture
+def push_url(service: Service):
+    server = collect.PushServer(('127.0.0.1', 0), service, token='secret')  # type: ignore
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/'
+    server.shutdown()
+    server.server_close()
+
+
+def post(url: str, payload, token: str = 'secret') -> requests.Response:
+    return requests.post(url, data=json.dumps(payload), headers={'Authorization': f'Bearer {token}'}, timeout=5)
+
+
+def test_push_server_forwards_events(push_url: str, service: Service):
+    response = post(push_url, {'pomid': 1, 'measurements': [{'lstamp': 1000, 'value': 1}, {'lstamp': 2000, 'value': 0}]})
+    assert response.status_code == 200
+    assert response.text == '2'
+    assert service.events == [{1: [{'lstamp': 1000, 'value': 1}, {'lstamp': 2000, 'value': 0}]}]
+
+
+def test_push_server_rejects_requests(push_url: str, service: Service):
+    assert post(push_url, {'pomid': 1, 'lstamp': 1000, 'value': 1}, token='wrong').status_code == 401
+    assert post(push_url, {'pomid': 1, 'lstamp': 1000, 'value': 5}).status_code == 400
+    assert requests.post(push_url, data=b'{', headers={'Authorization': 'Bearer secret'}, timeout=5).status_code == 400
+    assert not service.events
+    service.error = True
+    response = post(push_url, {'pomid': 1, 'lstamp': 1000, 'value': 1})
+    assert response.status_code == 500
+    assert response.text == 'Internal error'
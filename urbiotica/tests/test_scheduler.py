@@ -0,0 +1,58 @@
+"""Scheduling of the polls of each spot"""
+
+from datetime import datetime, timezone
+
+import checkpoints
+import collect
+
+
+def collected(start: float, end: float, entities: int) -> collect.Collected:
+    return collect.Collected(datetime.fromtimestamp(start, tz=timezone.utc), datetime.fromtimestamp(end, tz=timezone.utc),
+                             datetime.fromtimestamp(end, tz=timezone.utc), entities)
+
+
+def params(pomid: int, latest: float) -> collect.JsonDict:
+    return {'pom': {'pomid': pomid}, 'checkpoints': {f'pomid:{pomid}': datetime.fromtimestamp(latest, tz=timezone.utc)}}
+
+
+def test_new_spots_are_due_after_min_interval():
+    scheduler = collect.SpotScheduler(min_interval=60, max_staleness=3600)
+    assert scheduler.interval(1) == 60
+    assert not scheduler.due(1, 1000, 1059)
+    assert scheduler.due(1, 1000, 1060)
+
+
+def test_interval_follows_the_event_rate():
+    scheduler = collect.SpotScheduler(min_interval=60, max_staleness=3600, smoothing=0.5)
+    # One event every 10 minutes
+    scheduler.update(1, collected(0, 6000, 10))
+    assert scheduler.interval(1) == 600
+    # Polled at 6000, so not due until 6600 even with an older update
+    assert not scheduler.due(1, 0, 6599)
+    assert scheduler.due(1, 0, 6600)
+    # Averaged with the previous rate
+    scheduler.update(1, collected(6000, 12000, 0))
+    assert scheduler.interval(1) == 1200
+    # Quiet spots are still polled every max_staleness
+    scheduler.update(2, collected(0, 6000, 0))
+    assert scheduler.interval(2) == 3600
+
+
+def test_prioritise_polls_the_most_pending_events_first():
+    scheduler = collect.SpotScheduler(min_interval=60, max_staleness=3600)
+    now = datetime.now(timezone.utc).timestamp()
+    scheduler.update(1, collected(now - 7200, now - 3600, 3600))
+    scheduler.update(2, collected(now - 7200, now - 3600, 36))
+    scheduler.update(3, collected(now - 60, now - 10, 1))
+    order = [item['pom']['pomid'] for item in collect.prioritise(scheduler, [params(pomid, 0) for pomid in (2, 3, 1)])]
+    assert order == [1, 2]
+
+
+def test_statistics_are_kept_between_runs(tmp_path):
+    store = checkpoints.CheckpointStore(str(tmp_path / 'checkpoints.db'))
+    store.open()
+    collect.SpotScheduler(store=store).update(1, collected(0, 6000, 10))
+    scheduler = collect.SpotScheduler(store=store)
+    scheduler.open()
+    assert scheduler.stats[1] == checkpoints.SpotStats(6000, 10 / 6000)
+    store.close()
@@ -0,0 +1,46 @@
+"""Sharding of the POMs, and of the urbiotica rate limit"""
+
+import configargparse
+import pytest
+
+import collect
+
+
+def options(**kwargs) -> configargparse.Namespace:
+    defaults = {'shard_count': 1, 'backfill': False, 'backfill_share': 0.5, 'reserve_backfill': False}
+    return configargparse.Namespace(**{**defaults, **kwargs})
+
+
+def test_shard_of_is_stable_and_in_range():
+    shards = [collect.shard_of(pomid, 4) for pomid in range(10000, 10400)]
+    assert shards == [collect.shard_of(pomid, 4) for pomid in range(10000, 10400)]
+    assert set(shards) == {0, 1, 2, 3}
+    assert all(collect.shard_of(pomid, 1) == 0 for pomid in range(10000, 10010))
+
+
+@pytest.mark.parametrize('kwargs, cost', [
+    ({}, 1),
+    ({'shard_count': 4}, 4),
+    ({'backfill': True}, 2),
+    ({'backfill': True, 'backfill_share': 1}, 1),
+    ({'backfill': True, 'backfill_share': 0.3, 'shard_count': 3}, 10),
+    ({'backfill': True, 'backfill_share': 0.4}, 3),
+    ({'reserve_backfill': True, 'backfill_share': 0.25}, 2),
+    ({'reserve_backfill': True, 'backfill_share': 0.5, 'shard_count': 2}, 4),
+])
+def test_api_cost(kwargs, cost):
+    assert collect.api_cost(options(**kwargs)) == cost
+
+
+@pytest.mark.parametrize('args', [
+    ('--shard-count', '2', '--shard-index', '2'),
+    ('--shard-index', '-1'),
+    ('--shard-count', '101'),
+    ('--shard-count', '60', '--reserve-backfill'),
+    ('--orion-rate', '0'),
+    ('--reserve-backfill', '--backfill-share', '1'),
+])
+def test_main_rejects_invalid_options(run_main, capsys, args):
+    with pytest.raises(SystemExit):
+        run_main(*args)
+    assert 'error:' in capsys.readouterr().err
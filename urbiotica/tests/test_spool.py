@@ -0,0 +1,73 @@
+"""Spooling of the batches that could not be sent"""
+
+import collect
+import stores
+
+from conftest import RecordingStore, entity
+
+
+def failure() -> collect.NetworkException:
+    return collect.NetworkException(msg='unavailable', url='', status_code=503, text='')
+
+
+def test_spool_keeps_batches_in_order(tmp_path):
+    spool = stores.Spool(str(tmp_path))
+    spool.put('/test', [entity(1, 0), entity(2, 0)])
+    spool.put('/test', [entity(1, 5)])
+    batches = spool.batches('/test')
+    assert len(batches) == 2
+    assert [e.id for e in stores.replay(batches[0])] == ['pomid:1', 'pomid:2']
+    assert spool.load('/test') == {
+        'pomid:1': '2024-01-01T00:05:00+00:00',
+        'pomid:2': '2024-01-01T00:00:00+00:00',
+    }
+    assert not spool.batches('/other')
+
+
+def test_failed_batch_and_later_events_are_spooled(tmp_path, store: RecordingStore):
+    store.errors.append(failure())
+    spool = stores.Spool(str(tmp_path))
+    batcher = collect.Batcher(store=store, subservice='/test', stats=collect.RunStats(),
+                              max_entities=1, max_delay=60, spool=spool)
+    batcher.add(entity(1, 0))
+    batcher.add(entity(1, 1))
+    batcher.flush()
+    assert not store.batches
+    assert batcher.stats.unsent == 0
+    assert batcher.stats.spooled == 2
+    assert spool.load('/test') == {'pomid:1': '2024-01-01T00:01:00+00:00'}
+    # Spooled events are sent by drain, not recovered
+    assert batcher.recover('pomid:1') is None
+
+    assert batcher.drain()
+    assert store.sent() == ['2024-01-01T00:00:00+00:00', '2024-01-01T00:01:00+00:00']
+    assert not spool.batches('/test')
+    assert not batcher.failed_ids
+    batcher.add(entity(1, 2))
+    batcher.close()
+    assert store.sent()[-1] == '2024-01-01T00:02:00+00:00'
+
+
+def test_spool_is_resumed_by_the_next_run(tmp_path, store: RecordingStore):
+    spool = stores.Spool(str(tmp_path))
+    spool.put('/test', [entity(1, 3)])
+    batcher = collect.Batcher(store=store, subservice='/test', stats=collect.RunStats(),
+                              max_delay=60, spool=stores.Spool(str(tmp_path)))
+    # Already in the spool
+    batcher.add(entity(1, 2))
+    # Spooled too when sent, to follow the spooled events
+    batcher.add(entity(1, 4))
+    batcher.close()
+    assert store.sent() == ['2024-01-01T00:03:00+00:00', '2024-01-01T00:04:00+00:00']
+    assert batcher.stats.drained == 2
+
+
+def test_failed_drain_keeps_the_spool(tmp_path, store: RecordingStore):
+    spool = stores.Spool(str(tmp_path))
+    spool.put('/test', [entity(1, 0)])
+    store.errors.append(failure())
+    batcher = collect.Batcher(store=store, subservice='/test', stats=collect.RunStats(),
+                              max_delay=60, spool=spool)
+    assert not batcher.drain()
+    assert len(spool.batches('/test')) == 1
+    assert 'pomid:1' in batcher.failed_ids
@@ -0,0 +1,70 @@
+"""HTTP sessions shared by the requests to each API"""
+
+import socket
+import threading
+
+from typing import Iterator
+
+import configargparse
+import pytest
+import requests
+
+import bench
+import collect
+
+
+def test_sessions_pool_connections_and_retry_connection_errors():
+    session = collect.new_session(pool_size=32, retries=3)
+    for prefix in ('http://', 'https://'):
+        adapter = session.get_adapter(prefix + 'orion')
+        assert adapter._pool_maxsize == 32  # pylint: disable=protected-access
+        assert adapter.max_retries.connect == 3
+        assert adapter.max_retries.read == 0
+        assert adapter.max_retries.status == 0
+
+
+@pytest.mark.parametrize('workers, prefetch, http_pool_size, expected', [
+    (1, 1, 0, 10),
+    (8, 2, 0, 17),
+    (8, 0, 0, 10),
+    (8, 2, 4, 4),
+])
+def test_pool_size_covers_every_worker(workers, prefetch, http_pool_size, expected):
+    options = configargparse.Namespace(workers=workers, prefetch=prefetch, http_pool_size=http_pool_size)
+    assert collect.pool_size(options) == expected
+
+
+@pytest.fixture
+def silent_url() -> Iterator[str]:
+    """URL of a server that accepts connections but never answers"""
+    listener = socket.create_server(('127.0.0.1', 0))
+    accepted = list()
+
+    def accept():
+        try:
+            while True:
+                accepted.append(listener.accept()[0])
+        except OSError:
+            pass
+
+    threading.Thread(target=accept, daemon=True).start()
+    yield f'http://127.0.0.1:{listener.getsockname()[1]}/'
+    listener.close()
+    for conn in accepted:
+        conn.close()
+
+
+def test_requests_time_out_by_default(silent_url: str):
+    session = collect.new_session(read_timeout=0.2)
+    # Read timeouts are not retried
+    with pytest.raises(requests.exceptions.ConnectionError, match=r'read timeout=0\.2\)'):
+        session.get(silent_url)
+    # Unless the request sets its own
+    with pytest.raises(requests.exceptions.ConnectionError, match=r'read timeout=0\.1\)'):
+        session.get(silent_url, timeout=(0.2, 0.1))
+
+
+def test_batch_updates_can_be_compressed(backend: bench.FakeBackend, run_main):
+    counters = run_main('--orion-gzip')
+    assert backend.received == counters['orion_entities'] > 0
+    assert 0 < counters['orion_compressed_bytes'] < counters['orion_bytes'] / 4
@@ -0,0 +1,67 @@
+"""Catching up long ranges of vehicle_ctrl events in windows"""
+
+import threading
+
+from types import SimpleNamespace
+from datetime import datetime, timezone
+from typing import List, Optional, Set, Tuple
+
+import pytest
+
+import collect
+
+DAY = 24 * 60 * 60
+
+
+class WindowProject(collect.Project):
+    """Project whose windows hold an event at their start and end, except the failed ones"""
+    def __init__(self, failed: Optional[Set[int]] = None):
+        super().__init__(SimpleNamespace(endpoint='http://urbiotica'), 'project', 'Project', '', 'UTC')  # type: ignore
+        self.failed = failed or set()
+        self.windows: List[Tuple[int, int]] = list()
+        self.lock = threading.Lock()
+
+    def vehicles_window(self, pomid: int, from_ts: int, to_ts: int) -> Optional[collect.VehicleBatch]:
+        with self.lock:
+            self.windows.append((from_ts, to_ts))
+        if from_ts in self.failed:
+            return None
+        return collect.VehicleBatch.decode(pomid, [{'lstamp': to_ts * 1000, 'value': 1}, {'lstamp': from_ts * 1000, 'value': 0}])
+
+
+def at(seconds: int) -> datetime:
+    return datetime.fromtimestamp(seconds, tz=timezone.utc)
+
+
+def lstamps(project: WindowProject, *args, **kwargs) -> List[int]:
+    return [lstamp for batch in project.vehicles(1, *args, **kwargs) for lstamp in batch.lstamp.tolist()]
+
+
+@pytest.mark.parametrize('prefetch', [1, 3])
+def test_long_ranges_are_split_in_windows(prefetch):
+    project = WindowProject()
+    # Events at the boundaries shared by consecutive windows are returned once
+    assert lstamps(project, at(0), at(20 * DAY), prefetch) == [0, 7 * DAY, 14 * DAY, 20 * DAY]
+    assert sorted(project.windows) == [(0, 7 * DAY), (7 * DAY, 14 * DAY), (14 * DAY, 20 * DAY)]
+
+
+def test_short_ranges_take_a_single_window():
+    project = WindowProject()
+    assert lstamps(project, at(100), at(200), 4) == [100, 200]
+    assert project.windows == [(100, 200)]
+
+
+@pytest.mark.parametrize('prefetch', [1, 3])
+def test_events_after_a_failed_window_are_not_returned(prefetch):
+    project = WindowProject(failed={7 * DAY})
+    assert lstamps(project, at(0), at(20 * DAY), prefetch) == [0, 7 * DAY]
+    with pytest.raises(collect.NetworkException):
+        lstamps(WindowProject(failed={7 * DAY}), at(0), at(20 * DAY), prefetch, strict=True)
+
+
+def test_stopping_early_cancels_the_prefetched_windows():
+    project = WindowProject()
+    batches = project.vehicles(1, at(0), at(70 * DAY), prefetch=2)
+    assert next(batches).lstamp.tolist() == [0, 7 * DAY]
+    batches.close()
+    assert len(project.windows) <= 3